@@ -44,6 +44,9 @@
         'views/call.xml',
         'views/channel.xml',
         'views/channel_message.xml',
+        'views/ami_trace.xml',
+        'views/event_queue.xml',
+        'views/salt_job.xml',
         'views/templates.xml',
         'views/tag.xml',
         'views/conf.xml',
@@ -52,7 +55,11 @@
         'views/ir_cron.xml',
         # Wizards
         'wizard/add_note.xml',
+        'wizard/ami_replay.xml',
         'wizard/call.xml',
+        'wizard/call_load.xml',
+        'wizard/conf_diff.xml',
+        'wizard/conf_import.xml',
         # Reports
         'reports/reports.xml',
         'reports/calls_report.xml',
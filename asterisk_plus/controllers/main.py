@@ -1,9 +1,15 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import json
 import logging
+import time
 from odoo import http, SUPERUSER_ID, registry
 from odoo.api import Environment
-from werkzeug.exceptions import BadRequest
-from ..models.settings import debug
+from odoo.exceptions import AccessError
+from werkzeug.exceptions import BadRequest, NotFound
+from ..models.ingest import CONTENT_TYPES, CODEC_CONTENT_TYPES, \
+    decode_frame, dumps
+from ..models.tracing import trace
+from ..models.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +37,7 @@ class AsteriskPlusController(http.Controller):
     def _get_partner_by_number(self, db, number, country_code):
         # If db is passed init env for this db
         dst_partner_info = {'id': None}  # Defaults
+        started = time.time()
         if db:
             try:
                 with registry(db).cursor() as cr:
@@ -45,6 +52,10 @@ class AsteriskPlusController(http.Controller):
             dst_partner_info = http.request.env[
                 'res.partner'].sudo().get_partner_by_number(
                 number, country_code)
+        metrics_db = db or http.request.db
+        metrics.inc(metrics_db, 'asterisk_plus_caller_lookups_total')
+        metrics.observe(metrics_db, 'asterisk_plus_caller_lookup_seconds',
+                        time.time() - started)
         return dst_partner_info
 
     @http.route('/asterisk_plus/get_caller_name', type='http', auth='none')
@@ -58,8 +69,9 @@ class AsteriskPlusController(http.Controller):
             country_code = kw.get('country') or False
             if not number:
                 return BadRequest('Number not specified in request')
-            debug(http.request, 'CALLER NAME REQUEST FOR NUMBER {} country {}'.format(
-                number, country_code))
+            trace(http.request, 'partner',
+                  'CALLER NAME REQUEST FOR NUMBER %s country %s',
+                  number, country_code)
             dst_partner_info = self._get_partner_by_number(
                 db, number, country_code)
             if dst_partner_info['id']:
@@ -143,29 +155,138 @@ class AsteriskPlusController(http.Controller):
             else:
                 return 'Error'
 
-    @http.route('/asterisk_plus/ping', type='http', auth='none')
+    @http.route('/asterisk_plus/handler_stats', type='http', auth='none')
+    def handler_stats(self, **kw):
+        """Handler statistics of the worker serving the request as JSON."""
+        db = kw.get('db')
+        checked = self.check_ip(db=db)
+        if checked is not None:
+            return checked
+        try:
+            with registry(db or http.request.db).cursor() as cr:
+                env = Environment(cr, SUPERUSER_ID, {})
+                stats = env['asterisk_plus.server'].get_handler_stats()
+        except Exception:
+            logger.exception('Handler stats error:')
+            return BadRequest('Db error, check Odoo logs')
+        return http.Response(json.dumps(stats),
+                             content_type='application/json')
+
+    @http.route('/asterisk_plus/metrics', type='http', auth='none')
+    def metrics(self, **kw):
+        """Prometheus metrics of the worker serving the request, labeled with
+        its PID as worker, see metrics.Metrics.
+        """
+        db = kw.get('db')
+        checked = self.check_ip(db=db)
+        if checked is not None:
+            return checked
+        try:
+            with registry(db or http.request.db).cursor() as cr:
+                env = Environment(cr, SUPERUSER_ID, {})
+                data = env['asterisk_plus.server'].get_metrics()
+        except Exception:
+            logger.exception('Metrics error:')
+            return BadRequest('Db error, check Odoo logs')
+        return http.Response(
+            data, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @http.route('/asterisk_plus/ping', type='http', auth='user')
     def asterisk_ping(self):
-        with registry('odoopbx_14').cursor() as cr:
-            env = Environment(cr, SUPERUSER_ID, {})
-            try:
-                res = env['asterisk_plus.server'].browse(1).local_job(
-                    fun='test.ping', sync=True)
-                return http.Response('{}'.format(res))
-            except Exception as e:
-                logger.exception('Error:')
-                return '{}'.format(e)
-
-    @http.route('/asterisk_plus/asterisk_ping', type='http', auth='none')
+        """Returns the job handle at once, poll /asterisk_plus/job for the result."""
+        try:
+            res = http.request.env['asterisk_plus.server'].browse(1).submit_job(
+                fun='test.ping')
+            return http.Response(json.dumps(res),
+                                 content_type='application/json')
+        except Exception as e:
+            logger.exception('Error:')
+            return '{}'.format(e)
+
+    @http.route('/asterisk_plus/asterisk_ping', type='http', auth='user')
     def ping(self):
-        with registry('odoopbx_14').cursor() as cr:
-            env = Environment(cr, http.request.env.ref('base.user_admin').id, {})
-            try:
-                res = env['asterisk_plus.server'].browse(1).ami_action(
-                    {'Action': 'Ping'}, sync=True)
-                return http.Response('{}'.format(res))
-            except Exception as e:
-                logger.exception('Error:')
-                return '{}'.format(e)
+        """Returns the job handle at once, poll /asterisk_plus/job for the result."""
+        try:
+            server = http.request.env['asterisk_plus.server'].browse(1)
+            res = server.submit_job(
+                fun='asterisk.manager_action', arg={'Action': 'Ping'},
+                kwarg={'timeout': 5})
+            return http.Response(json.dumps(res),
+                                 content_type='application/json')
+        except Exception as e:
+            logger.exception('Error:')
+            return '{}'.format(e)
+
+    @http.route('/asterisk_plus/job/<int:job_id>', type='http', auth='user')
+    def job_result(self, job_id, **kw):
+        """Short-poll fallback of the job results pushed over the bus.
+        Only the user who has submitted the job and admins get its result.
+        """
+        checked = self.check_ip()
+        if checked is not None:
+            return checked
+        try:
+            res = http.request.env['asterisk_plus.salt_job'].get_result(job_id)
+        except AccessError:
+            return NotFound()
+        except Exception:
+            logger.exception('Salt job result error:')
+            return BadRequest('Job not found, check Odoo logs')
+        return http.Response(json.dumps(res), content_type='application/json')
+
+    @http.route('/asterisk_plus/ingest', type='http', auth='none',
+                methods=['POST'], csrf=False)
+    def ingest(self, **kw):
+        """Agent events and Salt returns in MessagePack or CBOR frames,
+        see models/ingest.py. Authenticated by the server ingest token:
+        Authorization: Bearer <token>.
+        """
+        db = kw.get('db')
+        checked = self.check_ip(db=db)
+        if checked is not None:
+            return checked
+        httprequest = http.request.httprequest
+        codec = CONTENT_TYPES.get(httprequest.mimetype)
+        if not codec:
+            return BadRequest('Unsupported content type {}'.format(
+                httprequest.mimetype))
+        auth = httprequest.headers.get('Authorization', '')
+        token = auth[7:].strip() if auth.startswith('Bearer ') else ''
+        data = httprequest.get_data()
+        try:
+            frame = decode_frame(data, codec)
+        except ValueError as e:
+            return BadRequest(str(e))
+        try:
+            with registry(db or http.request.db).cursor() as cr:
+                env = Environment(cr, SUPERUSER_ID, {})
+                server = env['asterisk_plus.server'].search(
+                    [('ingest_token', '=', token)]) if token else None
+                if not server:
+                    return http.Response('Bad token', status=401)
+                metrics.inc(cr.dbname, 'asterisk_plus_ingest_bytes_total',
+                            len(data), codec=codec)
+                res = server.with_user(server.user).ingest(frame)
+        except Exception:
+            logger.exception('Ingest error:')
+            return BadRequest('Ingest error, check Odoo logs')
+        return http.Response(dumps(res, codec),
+                             content_type=CODEC_CONTENT_TYPES[codec])
+
+    @http.route('/asterisk_plus/conf_archive/<int:server_id>', type='http',
+                auth='user')
+    def conf_archive(self, server_id, **kw):
+        """Conf files of the server as a tar.gz archive streamed from
+        a spooled temporary file."""
+        env = http.request.env
+        server = env['asterisk_plus.server'].browse(server_id).exists()
+        if not server:
+            return http.request.not_found()
+        fileobj = env['asterisk_plus.conf'].search(
+            [('server', '=', server.id)]).write_archive()
+        return http.send_file(
+            fileobj, mimetype='application/gzip', as_attachment=True,
+            filename='{}_conf.tar.gz'.format(server.server_id))
 
     @http.route('/asterisk_plus/signup', auth='user')
     def signup(self):
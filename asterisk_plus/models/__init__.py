@@ -3,6 +3,9 @@ from . import call
 from . import call_event
 from . import channel
 from . import channel_message
+from . import ami_trace
+from . import event_queue
+from . import mock_agent
 from . import recording
 from . import res_users
 from . import server
@@ -15,4 +18,5 @@ from . import tag
 from . import web_phone_settings
 from . import web_phone_user
 from . import conf
+from . import conf_revision
 from . import security
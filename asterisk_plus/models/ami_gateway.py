@@ -0,0 +1,237 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+#: Seconds to wait before reconnecting, doubled on every failure.
+RECONNECT_DELAY = 1
+#: Max seconds to wait before reconnecting.
+RECONNECT_MAX_DELAY = 30
+#: Seconds to connect and login.
+CONNECT_TIMEOUT = 5
+#: Threads running Odoo callbacks of the actions sent without waiting.
+CALLBACK_THREADS = 2
+
+
+def format_message(message):
+    """AMI message from a dictionary. List values are sent as repeated
+    headers, e.g. Variable."""
+    lines = []
+    for key, value in message.items():
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            lines.append('{}: {}'.format(key, item))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def parse_message(data):
+    """Dictionary from an AMI message. Repeated headers become a list."""
+    message = {}
+    for line in data.decode(errors='replace').split('\r\n'):
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key, value = key.strip(), value.strip()
+        if key in message:
+            if not isinstance(message[key], list):
+                message[key] = [message[key]]
+            message[key].append(value)
+        else:
+            message[key] = value
+    return message
+
+
+class AmiError(Exception):
+    """AMI connection or login error."""
+
+
+class AmiClient:
+    """Asyncio AMI client sending actions over one connection.
+
+    Actions are pipelined: every action gets its own ActionID and waits for
+    its response, so any number of callers share the connection. Responses
+    with an event list are collected until the list is complete, like
+    Salt asterisk.manager_action returns them.
+    """
+
+    def __init__(self, host, port, username, secret, loop=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+        self.loop = loop or asyncio.get_event_loop()
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    @property
+    def config(self):
+        return (self.host, self.port, self.username, self.secret)
+
+    def start(self):
+        self._task = self.loop.create_task(self._run())
+
+    async def close(self):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._fail_pending(AmiError('AMI client closed.'))
+
+    async def _run(self):
+        """Keep the connection up, reconnecting with backoff."""
+        delay = RECONNECT_DELAY
+        while not self._closed:
+            reader_task = None
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    CONNECT_TIMEOUT)
+                self._writer = writer
+                # Banner: Asterisk Call Manager/x.y.z
+                await asyncio.wait_for(reader.readline(), CONNECT_TIMEOUT)
+                reader_task = self.loop.create_task(self._read(reader))
+                res = await asyncio.wait_for(self.send_action({
+                    'Action': 'Login',
+                    'Username': self.username,
+                    'Secret': self.secret,
+                    'Events': 'off'}, connected=False), CONNECT_TIMEOUT)
+                if res[0].get('Response') != 'Success':
+                    raise AmiError('AMI login failed: {}'.format(
+                        res[0].get('Message')))
+                logger.info('AMI gateway connected to %s:%s.',
+                            self.host, self.port)
+                delay = RECONNECT_DELAY
+                self._connected.set()
+                await reader_task
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('AMI gateway %s:%s error: %s',
+                               self.host, self.port, e)
+            self._connected.clear()
+            if reader_task:
+                reader_task.cancel()
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            self._fail_pending(AmiError('AMI connection lost.'))
+            if self._closed:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _read(self, reader):
+        while True:
+            data = await reader.readuntil(b'\r\n\r\n')
+            message = parse_message(data)
+            pending = self._pending.get(message.get('ActionID'))
+            if not pending:
+                # Events are received by the agent, not here.
+                continue
+            future, messages = pending
+            messages.append(message)
+            if message.get('EventList', '').lower() == 'start' or (
+                    'Event' not in message and
+                    'will follow' in message.get('Message', '')):
+                continue
+            if 'Event' in message and \
+                    message.get('EventList', '').lower() != 'complete':
+                continue
+            del self._pending[message['ActionID']]
+            if not future.done():
+                future.set_result(messages)
+
+    def _fail_pending(self, error):
+        for future, _messages in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    async def send_action(self, action, timeout=5, connected=True):
+        """Send action and return its response messages."""
+        deadline = self.loop.time() + timeout
+        if connected:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        action = dict(action)
+        action_id = 'odoo-{}'.format(next(self._ids))
+        action['ActionID'] = action_id
+        future = self.loop.create_future()
+        self._pending[action_id] = (future, [])
+        try:
+            self._writer.write(format_message(action))
+            return await asyncio.wait_for(
+                future, max(0, deadline - self.loop.time()))
+        finally:
+            self._pending.pop(action_id, None)
+
+
+class AmiGateway:
+    """Per worker AMI clients running in one asyncio loop thread.
+
+    .. code:: python
+
+        ami_gateway.action(key, config, {'Action': 'Ping'})
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(CALLBACK_THREADS)
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever,
+                                 name='ami_gateway', daemon=True).start()
+
+    async def _get_client(self, key, config):
+        client = self._clients.get(key)
+        if client and client.config != config:
+            await client.close()
+            client = None
+        if not client:
+            client = AmiClient(*config, loop=self.loop)
+            client.start()
+            self._clients[key] = client
+        return client
+
+    async def _action(self, key, config, action, timeout):
+        client = await self._get_client(key, config)
+        return await client.send_action(action, timeout=timeout)
+
+    def submit(self, key, config, action, timeout=5):
+        """Send action without waiting.
+
+        Args:
+            key: Client key, e.g. (db, server ID).
+            config (tuple): host, port, username, secret.
+
+        Returns:
+            concurrent.futures.Future of the response messages.
+        """
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self._action(key, config, action, timeout), self.loop)
+
+    def action(self, key, config, action, timeout=5):
+        """Send action and wait for the response messages."""
+        return self.submit(key, config, action, timeout).result(timeout + 1)
+
+    def close(self, key):
+        client = self._clients.pop(key, None)
+        if client:
+            asyncio.run_coroutine_threadsafe(client.close(), self.loop)
+
+
+#: AMI clients of the worker.
+ami_gateway = AmiGateway()
@@ -0,0 +1,128 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from datetime import datetime, timedelta
+import json
+import logging
+import re
+from odoo import models, fields, api, _
+
+logger = logging.getLogger(__name__)
+
+#: Daily partitions are named asterisk_plus_ami_trace_YYYYMMDD.
+PARTITION_RE = re.compile(r'^asterisk_plus_ami_trace_(\d{8})$')
+#: Partitions known to exist by this worker: (db, partition name).
+known_partitions = set()
+
+
+class AmiTrace(models.Model):
+    """Append-only store of traced AMI events.
+
+    Events are kept in a table partitioned by day, written with plain
+    INSERT and expired by dropping whole partitions.
+    """
+    _name = 'asterisk_plus.ami_trace'
+    _description = 'AMI Trace'
+    _auto = False
+    _log_access = False
+    _order = 'received, id'
+    _rec_name = 'event'
+
+    received = fields.Datetime(readonly=True)
+    event = fields.Char(readonly=True)
+    uniqueid = fields.Char(readonly=True, string='Unique ID')
+    linkedid = fields.Char(readonly=True, string='Linked ID')
+    channel = fields.Char(readonly=True)
+    message = fields.Text(readonly=True)
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS asterisk_plus_ami_trace (
+                id bigserial,
+                received timestamp without time zone NOT NULL
+                    DEFAULT (now() at time zone 'UTC'),
+                event varchar(64),
+                uniqueid varchar(150),
+                linkedid varchar(150),
+                channel varchar(256),
+                message text
+            ) PARTITION BY RANGE (received)""")
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS asterisk_plus_ami_trace_linkedid_idx
+            ON asterisk_plus_ami_trace (linkedid)""")
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS asterisk_plus_ami_trace_uniqueid_idx
+            ON asterisk_plus_ami_trace (uniqueid)""")
+        self.create_partitions()
+
+    @api.model
+    def _ensure_partition(self, day):
+        name = 'asterisk_plus_ami_trace_{}'.format(day.strftime('%Y%m%d'))
+        key = (self.env.cr.dbname, name)
+        if key in known_partitions:
+            return
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    CREATE TABLE IF NOT EXISTS {} PARTITION OF
+                    asterisk_plus_ami_trace FOR VALUES FROM (%s) TO (%s)
+                    """.format(name), (day, day + timedelta(days=1)))
+        except Exception as e:
+            # Another worker has just created it.
+            logger.debug('Create AMI trace partition %s: %s', name, e)
+        self.env.cr.postcommit.add(lambda: known_partitions.add(key))
+
+    @api.model
+    def create_partitions(self):
+        """Cron job to create partitions of today and tomorrow in advance.
+        """
+        today = datetime.utcnow().date()
+        for day in (today, today + timedelta(days=1)):
+            self._ensure_partition(day)
+
+    @api.model
+    def add_events(self, events):
+        """Append AMI events to the trace.
+        """
+        if not events:
+            return
+        now = datetime.utcnow()
+        self._ensure_partition(now.date())
+        self.env.cr.executemany("""
+            INSERT INTO asterisk_plus_ami_trace
+                (received, event, uniqueid, linkedid, channel, message)
+            VALUES (%s, %s, %s, %s, %s, %s)""", [(
+                now, event.get('Event'), event.get('Uniqueid'),
+                event.get('Linkedid'), event.get('Channel'),
+                json.dumps(event, separators=(',', ':'))) for event in events])
+
+    @api.model
+    def vacuum(self, hours):
+        """Cron job to drop partitions older than hours.
+        """
+        expire_day = (datetime.utcnow() - timedelta(hours=hours)).date()
+        self.env.cr.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'asterisk_plus_ami_trace'""")
+        for (name,) in self.env.cr.fetchall():
+            match = PARTITION_RE.match(name)
+            # Partition of a day is dropped when the whole day is expired.
+            if match and datetime.strptime(
+                    match.group(1), '%Y%m%d').date() < expire_day:
+                logger.info('Dropping AMI trace partition %s.', name)
+                self.env.cr.execute('DROP TABLE IF EXISTS {}'.format(name))
+                known_partitions.discard((self.env.cr.dbname, name))
+
+    @api.model
+    def get_call_timeline(self, linkedid):
+        """Action to show all traced events of a call in order.
+        """
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'asterisk_plus.ami_trace',
+            'name': _('AMI Timeline'),
+            'view_mode': 'tree,form',
+            'domain': ['|', ('linkedid', '=', linkedid),
+                       ('uniqueid', '=', linkedid)],
+            'target': 'current',
+        }
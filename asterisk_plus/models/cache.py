@@ -0,0 +1,78 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import OrderedDict
+import threading
+import time
+
+#: Max number of entries kept per identity map.
+IDENTITY_MAP_SIZE = 10000
+#: Seconds after an entry is considered expired.
+IDENTITY_MAP_TTL = 3600
+
+
+class IdentityMap:
+    """Bounded per-worker map of live records: (db, key) -> record ID.
+
+    Entries are expired by TTL and the least recently used ones are
+    dropped when the map is full. Callers fall back to SQL on a miss.
+    """
+
+    def __init__(self, name, size=IDENTITY_MAP_SIZE, ttl=IDENTITY_MAP_TTL):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, db, key):
+        with self._lock:
+            entry = self._data.get((db, key))
+            if entry and entry[1] > time.monotonic():
+                self._data.move_to_end((db, key))
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._data[(db, key)]
+            self.misses += 1
+            return None
+
+    def set(self, db, key, res_id):
+        with self._lock:
+            self._data[(db, key)] = (res_id, time.monotonic() + self.ttl)
+            self._data.move_to_end((db, key))
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, db, key):
+        with self._lock:
+            self._data.pop((db, key), None)
+
+    def discard_ids(self, db, res_ids):
+        """Remove entries of deleted records."""
+        res_ids = set(res_ids)
+        with self._lock:
+            for k in [k for k, v in self._data.items()
+                      if k[0] == db and v[0] in res_ids]:
+                del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0,
+            }
+
+
+#: Live channels by Uniqueid.
+channel_map = IdentityMap('channel')
+#: Live calls by Linkedid (Uniqueid of the primary channel).
+call_map = IdentityMap('call')
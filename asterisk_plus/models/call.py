@@ -1,11 +1,13 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
 from datetime import datetime, timedelta
-import json
 import logging
 import phonenumbers
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
 from .server import debug
+from .cache import call_map
+from .list_updates import notify_list_update
+from .handler_stats import measured
 
 logger = logging.getLogger(__name__)
 
@@ -62,13 +64,33 @@ class Call(models.Model):
         string=_('Call Duration'),
         compute='_get_duration_human')
 
-    @api.model
-    def create(self, vals):
+    @api.model_create_multi
+    def create(self, vals_list):
         # Reload after call is created
-        call = super(Call, self.with_context(
-            mail_create_nosubscribe=True, mail_create_nolog=True)).create(vals)
-        self.reload_calls()
-        return call
+        calls = super(Call, self.with_context(
+            mail_create_nosubscribe=True, mail_create_nolog=True)).create(vals_list)
+        for rec in calls:
+            if rec.uniqueid:
+                self.env['asterisk_plus.channel']._remember_live_record(
+                    call_map, rec.uniqueid, rec.id)
+        calls._notify_list_update(created=True)
+        return calls
+
+    def write(self, vals):
+        res = super(Call, self).write(vals)
+        self._notify_list_update(field_names=list(vals))
+        return res
+
+    def unlink(self):
+        self.env['asterisk_plus.channel']._discard_live_records(
+            call_map, self.ids)
+        self._notify_list_update(removed=True)
+        return super(Call, self).unlink()
+
+    def _notify_list_update(self, **kwargs):
+        """Send changed calls to open call lists."""
+        if self.env['asterisk_plus.settings'].get_param('auto_reload_calls'):
+            notify_list_update(self, **kwargs)
 
     def _get_recording_icon(self):
         for rec in self:
@@ -82,15 +104,8 @@ class Call(models.Model):
         """
         self.ensure_one()
 
-    @api.constrains('is_active')
-    def reload_on_hangup(self):
-        """Reloads active calls list view after hangup.
-        """
-        for rec in self:
-            if not rec.is_active:
-                self.reload_calls()
-
     @api.constrains('called_user')
+    @measured('notify_called_user')
     def notify_called_user(self):
         """Notify user about incomming call.
         """
@@ -128,7 +143,7 @@ class Call(models.Model):
                 # Check user notify settings.
                 pbx_user = self.env['asterisk_plus.user'].search(
                     [('user', '=', rec.called_user.id),
-                     ('server', '=', self.server.id)], limit=1)
+                     ('server', '=', rec.server.id)], limit=1)
                 if pbx_user.call_popup_is_enabled:
                     self.env['res.users'].asterisk_plus_notify(
                         message,
@@ -199,22 +214,6 @@ class Call(models.Model):
             rec.direction_icon = '<span class="fa fa-arrow-left"/>' if rec.direction == 'in' else \
                 '<span class="fa fa-arrow-right"/>'
 
-    def reload_calls(self, data=None):
-        """Reloads active calls list view.
-        Returns: None.
-        """
-        auto_reload = self.env[
-            'asterisk_plus.settings'].get_param('auto_reload_calls')
-        if not auto_reload:
-            return
-        if data is None:
-            data = {}
-        msg = {
-            'action': 'reload_view',
-            'model': 'asterisk_plus.call'
-        }
-        self.env['bus.bus'].sendone('asterisk_plus_actions', json.dumps(msg))
-
     def move_to_history(self):
         self.is_active = False
 
@@ -228,6 +227,11 @@ class Call(models.Model):
             'context': {'default_notes': self.notes}
         }
 
+    def open_ami_timeline(self):
+        self.ensure_one()
+        return self.env['asterisk_plus.ami_trace'].get_call_timeline(
+            self.uniqueid)
+
     @api.model
     def delete_calls(self):
         """Cron job to delete calls history.
@@ -252,15 +256,15 @@ class Call(models.Model):
             rec.duration_human = str(timedelta(seconds=rec.duration))
 
     @api.constrains('is_active')
+    @measured('register_call')
     def register_call(self):
-        self.ensure_one()
         # Missed calls to users
         for rec in self:
             if rec.is_active:
                 continue
             # Check if user has missed_calls_notify enabled.
             pbx_user = self.env['asterisk_plus.user'].search(
-                [('user', '=', rec.called_user.id), ('server', '=', self.server.id)], limit=1)
+                [('user', '=', rec.called_user.id), ('server', '=', rec.server.id)], limit=1)
             if rec.status != 'answered' and pbx_user.missed_calls_notify:
                 rec.sudo().message_post(
                     subject=_('Missed call notification'),
@@ -303,7 +307,6 @@ class Call(models.Model):
 
     @api.constrains('is_active')
     def register_reference_call(self):
-        self.ensure_one()
         for rec in self:
             if rec.is_active:
                 continue
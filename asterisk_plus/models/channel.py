@@ -1,14 +1,54 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import partial
 import json
 import logging
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
-from .server import debug
+from odoo.tools.safe_eval import safe_eval
+from .tracing import trace
+from .cache import channel_map, call_map
+from .list_updates import notify_list_update
+from .handler_stats import measure, measured
+from .metrics import metrics
 
 
 logger = logging.getLogger(__name__)
 
+#: Transaction data key of the live records put to identity maps on commit.
+LIVE_RECORDS_KEY = 'asterisk_plus.live_records'
+
+
+def get_event_linkedid(event):
+    """Linkedid groups all events of one call."""
+    return event.get('Linkedid') or event.get('Uniqueid') or ''
+
+
+def remember_live_records(db, pending):
+    """Put the live records of a committed transaction to the maps."""
+    for (identity_map, uniqueid), res_id in pending.items():
+        identity_map.set(db, uniqueid, res_id)
+
+
+@contextmanager
+def live_records_savepoint(cr):
+    """Savepoint that also drops the live records remembered inside it
+    when it is rolled back.
+    """
+    pending = cr.postcommit.data.get(LIVE_RECORDS_KEY)
+    saved = dict(pending) if pending else {}
+    try:
+        with cr.savepoint():
+            yield
+    except Exception:
+        pending = cr.postcommit.data.get(LIVE_RECORDS_KEY)
+        if pending is not None:
+            pending.clear()
+            pending.update(saved)
+        raise
+
 
 class Channel(models.Model):
     _name = 'asterisk_plus.channel'
@@ -83,8 +123,7 @@ class Channel(models.Model):
         for rec in self:
             if rec.uniqueid != rec.linkedid:
                 # Asterisk bound channels
-                rec.parent_channel = self.search(
-                    [('uniqueid', '=', rec.linkedid)], limit=1)
+                rec.parent_channel = self._find_channel(rec.linkedid)
             else:
                 rec.parent_channel = False
 
@@ -97,21 +136,99 @@ class Channel(models.Model):
                 [('linkedid', '=', rec.uniqueid), ('id', '!=', rec.id)])
 
     @api.model
-    def reload_channels(self, data=None):
-        """Reloads channels list view.
+    def _find_channel(self, uniqueid):
+        """Get channel by Uniqueid. Channels prefetched by on_ami_events
+        or kept in the worker's identity map are taken without a search.
+        """
+        return self._find_live_record(
+            'asterisk_plus.channel', channel_map, uniqueid)
+
+    @api.model
+    def _find_call(self, uniqueid):
+        """Get call by Uniqueid of its primary channel (Linkedid).
+        """
+        return self._find_live_record(
+            'asterisk_plus.call', call_map, uniqueid)
+
+    @api.model
+    def _find_live_record(self, model, identity_map, uniqueid):
+        batch = self.env.context.get('ami_batch')
+        key = 'channels' if model == 'asterisk_plus.channel' else 'calls'
+        if batch is not None and uniqueid in batch[key]:
+            return batch[key][uniqueid]
+        db = self.env.cr.dbname
+        res_id = identity_map.get(db, uniqueid)
+        if res_id:
+            return self.env[model].browse(res_id)
+        rec = self.env[model].search([('uniqueid', '=', uniqueid)], limit=1)
+        if rec and not (rec.hangup_date if key == 'channels'
+                        else not rec.is_active):
+            self._remember_live_record(identity_map, uniqueid, rec.id)
+        return rec
+
+    @api.model
+    def _remember_live_record(self, identity_map, uniqueid, res_id):
+        # Records become visible to other transactions after commit.
+        data = self.env.cr.postcommit.data
+        if LIVE_RECORDS_KEY not in data:
+            data[LIVE_RECORDS_KEY] = {}
+            self.env.cr.postcommit.add(partial(
+                remember_live_records, self.env.cr.dbname,
+                data[LIVE_RECORDS_KEY]))
+        data[LIVE_RECORDS_KEY][(identity_map, uniqueid)] = res_id
+
+    @api.model
+    def _forget_live_records(self, uniqueid, linkedid):
+        db = self.env.cr.dbname
+        pending = self.env.cr.postcommit.data.get(LIVE_RECORDS_KEY, {})
+        maps = [channel_map, call_map] if uniqueid == linkedid \
+            else [channel_map]
+        for identity_map in maps:
+            identity_map.pop(db, uniqueid)
+            pending.pop((identity_map, uniqueid), None)
+
+    @api.model
+    def _discard_live_records(self, identity_map, ids):
+        identity_map.discard_ids(self.env.cr.dbname, ids)
+        pending = self.env.cr.postcommit.data.get(LIVE_RECORDS_KEY, {})
+        for key in [k for k, v in pending.items()
+                    if k[0] is identity_map and v in ids]:
+            del pending[key]
+
+    @api.model
+    def get_identity_map_stats(self):
+        """Hit / miss counters of this worker's channel and call maps.
         """
-        auto_reload = self.env[
-            'asterisk_plus.settings'].get_param('auto_reload_channels')
-        if not auto_reload:
-            return
-        if data is None:
-            data = {}
-        msg = {
-            'action': 'reload_view',
-            'model': 'asterisk_plus.channel'
+        return {
+            'channel': channel_map.stats(),
+            'call': call_map.stats(),
         }
-        self.env['bus.bus'].sendone('asterisk_plus_actions', json.dumps(msg))
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        channels = super(Channel, self).create(vals_list)
+        for rec in channels:
+            if rec.uniqueid:
+                self._remember_live_record(channel_map, rec.uniqueid, rec.id)
+        channels._notify_list_update(created=True)
+        return channels
+
+    def write(self, vals):
+        res = super(Channel, self).write(vals)
+        self._notify_list_update(field_names=list(vals))
+        return res
+
+    def unlink(self):
+        self._discard_live_records(channel_map, self.ids)
+        self._notify_list_update(removed=True)
+        return super(Channel, self).unlink()
+
+    def _notify_list_update(self, **kwargs):
+        """Send changed channels to open channel lists."""
+        if self.env['asterisk_plus.settings'].get_param('auto_reload_channels'):
+            notify_list_update(self, **kwargs)
+
+    @measured('update_call_data')
     def update_call_data(self):
         """Updates call data to set: calling/called user,
             call direction, partner (if found) and call reference."""
@@ -119,7 +236,7 @@ class Channel(models.Model):
         # First check the channel owner.
         user_channel = self.env['asterisk_plus.user_channel'].get_user_channel(
             self.channel, self.system_name)
-        debug(self, 'User channel: {}'.format(user_channel.name))
+        trace(self, 'ami', 'User channel: %s', user_channel.name)
         data = {}
         if user_channel:
             if len(self.call.channels) == 1: # This is the primary channel.
@@ -143,10 +260,10 @@ class Channel(models.Model):
             if not self.call.partner:
                 # Check if there is a reference with partner ID
                 if self.call.ref and getattr(self.call.ref, 'partner_id', False):
-                    debug(self, 'Taking partner from ref')
+                    trace(self, 'ami', 'Taking partner from ref')
                     data['partner'] = self.call.ref.partner_id
                 else:
-                    debug(self, 'Matching partner by number')
+                    trace(self, 'ami', 'Matching partner by number')
                     data['partner'] = self.env[
                         'res.partner'].search_by_caller_number(self.callerid_num)
             if data:
@@ -159,33 +276,27 @@ class Channel(models.Model):
 
     ########################### AMI Event handlers ############################
     @api.model
-    def on_ami_new_channel(self, event):
-        """AMI NewChannel event is processed to create a new channel in Odoo.
+    def _get_new_call_data(self, event):
+        """Values of a call created by the primary channel's Newchannel event.
+        """
+        return {
+            'uniqueid': event['Uniqueid'],
+            'calling_number': event['CallerIDNum'],
+            'called_number': event['Exten'],
+            'started': datetime.now(),
+            'is_active': True,
+            'status': 'progress',
+            'server': self.env.user.asterisk_server.id,
+        }
+
+    @api.model
+    def _get_new_channel_data(self, event, call):
+        """Values of a channel taken from Newchannel event.
         """
-        debug(self, json.dumps(event, indent=2))
-        # Create a call for the primary channel.
-        if event['Uniqueid'] == event['Linkedid']:
-            # Check if call already exists
-            call = self.env['asterisk_plus.call'].search(
-                [('uniqueid', '=', event['Uniqueid'])], limit=1)
-            if not call:                
-                call = self.env['asterisk_plus.call'].create({
-                    'uniqueid': event['Uniqueid'],
-                    'calling_number': event['CallerIDNum'],
-                    'called_number': event['Exten'],
-                    'started': datetime.now(),
-                    'is_active': True,
-                    'status': 'progress',
-                    'server': self.env.user.asterisk_server.id,
-                })
-        else:
-            # There is already a parent channel and the call
-            call = self.env['asterisk_plus.call'].search(
-                [('uniqueid', '=', event['Linkedid'])], limit=1)
         # Match channel owner
         user_channel = self.env['asterisk_plus.user_channel'].get_user_channel(
-            event['Channel'], event['SystemName'])            
-        data = {
+            event['Channel'], event['SystemName'])
+        return {
             'call': call.id,
             'user': user_channel.user.id,
             'event': event['Event'],
@@ -206,14 +317,201 @@ class Channel(models.Model):
             'linkedid': event['Linkedid'],
             'system_name': event['SystemName'],
         }
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
+
+    @api.model
+    def on_ami_events(self, events):
+        """Process a burst of AMI events in one call and one transaction.
+
+        Handlers are taken from enabled AMI events (asterisk_plus.event) by
+        event name and their conditions are checked here. Events of the same
+        call (Linkedid) are processed in the order received. Existing channels
+        and calls are fetched with one search and new ones are created in bulk
+        before the handlers are run. When the bulk create fails, for example on
+        a malformed event, the records are created in the savepoint of every
+        call so that only the broken call fails.
+
+        Args:
+            events (list): AMI events as dictionaries.
+
+        Returns:
+            A list with a result for every event in the same order. False is
+            set for events without a handler or when the handler failed.
+        """
+        results, errors = self._process_ami_events(events)
+        return results
+
+    @api.model
+    def _process_ami_events(self, events):
+        """Implementation of on_ami_events.
+
+        Returns:
+            A tuple of the results list and a dictionary of errors by Linkedid
+            of the calls whose events were rolled back.
+        """
+        results = [False] * len(events)
+        errors = {}
+        if not events:
+            return results, errors
+        handlers = {}
+        for handler in self.env['asterisk_plus.event'].sudo().search([
+                ('source', '=', 'AMI'), ('is_enabled', '=', True),
+                ('name', 'in', list({k.get('Event') for k in events}))]):
+            handlers.setdefault(handler.name, []).append(handler)
+        # Keep events order inside every call.
+        calls_events = OrderedDict()
+        for pos, event in enumerate(events):
+            calls_events.setdefault(
+                get_event_linkedid(event), []).append((pos, event))
+        batch = self._prefetch_ami_events(events)
+        new_channel_events = self._get_new_channel_events(
+            batch, events, handlers.get('Newchannel', []))
+        try:
+            # Create new calls and channels of all the calls at once.
+            with live_records_savepoint(self.env.cr):
+                self._create_ami_events_records(
+                    batch, new_channel_events.values())
+            new_channel_events.clear()
+        except Exception:
+            logger.warning('AMI events bulk create error, creating records '
+                           'per call:', exc_info=True)
+        calls_new_channel_events = {}
+        for event in new_channel_events.values():
+            calls_new_channel_events.setdefault(
+                get_event_linkedid(event), []).append(event)
+        env = self.with_context(ami_batch=batch).env
+        for linkedid, call_events in calls_events.items():
+            created = {}
+            try:
+                # One savepoint per call so that a broken call
+                # does not roll back the others.
+                with live_records_savepoint(self.env.cr):
+                    created = self._create_ami_events_records(
+                        batch, calls_new_channel_events.get(linkedid, []))
+                    for pos, event in call_events:
+                        results[pos] = self._run_ami_event_handlers(
+                            env, handlers.get(event.get('Event'), []), event)
+            except Exception as e:
+                logger.exception('AMI events of call %s error:', linkedid)
+                errors[linkedid] = str(e)
+                for key, uniqueids in created.items():
+                    for uniqueid in uniqueids:
+                        batch[key].pop(uniqueid, None)
+                for pos, event in call_events:
+                    results[pos] = False
+        return results, errors
+
+    @api.model
+    def _run_ami_event_handlers(self, env, handlers, event):
+        metrics.inc(self.env.cr.dbname, 'asterisk_plus_ami_events_total',
+                    event=event.get('Event'))
+        res = False
+        for handler in handlers:
+            if handler.condition and not safe_eval(
+                    handler.condition, {'event': event}):
+                continue
+            with measure(env, 'ami:{}'.format(handler.method), flush=True):
+                res = getattr(env[handler.model], handler.method)(event)
+        # JSON-RPC requires a serializable result.
+        return res.id if isinstance(res, models.BaseModel) else res
+
+    @api.model
+    def _prefetch_ami_events(self, events):
+        """Search channels and calls of the events at once.
+
+        Returns:
+            A dictionary with channels and calls by Uniqueid.
+        """
+        uniqueids = {k['Uniqueid'] for k in events if k.get('Uniqueid')}
+        linkedids = {k['Linkedid'] for k in events if k.get('Linkedid')}
+        batch = {'channels': {}, 'calls': {}}
+        for channel in self.env['asterisk_plus.channel'].search(
+                [('uniqueid', 'in', list(uniqueids))]):
+            batch['channels'].setdefault(channel.uniqueid, channel)
+        for call in self.env['asterisk_plus.call'].search(
+                [('uniqueid', 'in', list(linkedids | uniqueids))]):
+            batch['calls'].setdefault(call.uniqueid, call)
+        return batch
+
+    @api.model
+    def _get_new_channel_events(self, batch, events, handlers):
+        """Newchannel events of channels not found in the batch that pass
+        the condition of a new channel handler.
+
+        Returns:
+            An ordered dictionary of the events by Uniqueid.
+        """
+        handlers = [k for k in handlers if k.model == self._name and
+                    k.method == 'on_ami_new_channel']
+        res = OrderedDict()
+        for event in events if handlers else []:
+            uniqueid = event.get('Uniqueid')
+            if event.get('Event') != 'Newchannel' or not uniqueid or \
+                    uniqueid in batch['channels'] or uniqueid in res:
+                continue
+            try:
+                if not any(not k.condition or safe_eval(
+                        k.condition, {'event': event}) for k in handlers):
+                    continue
+            except Exception:
+                # Reported by the handler of the call.
+                continue
+            res[uniqueid] = event
+        return res
+
+    @api.model
+    def _create_ami_events_records(self, batch, new_channel_events):
+        """Create calls and channels of Newchannel events in bulk and add
+        them to the batch.
+
+        Returns:
+            A dictionary with Uniqueids of the created calls and channels.
+        """
+        new_channel_events = list(new_channel_events)
+        calls = dict(batch['calls'])
+        # Calls are created by primary channels.
+        new_calls_data = [
+            self._get_new_call_data(k) for k in new_channel_events
+            if k['Uniqueid'] == k['Linkedid'] and k['Uniqueid'] not in calls]
+        new_calls = self.env['asterisk_plus.call']
+        if new_calls_data:
+            new_calls = new_calls.with_context(
+                ami_batch=batch).create(new_calls_data)
+            calls.update({k.uniqueid: k for k in new_calls})
+        Call = self.env['asterisk_plus.call']
+        new_channels_data = [
+            self._get_new_channel_data(k, calls.get(k['Linkedid'], Call))
+            for k in new_channel_events]
+        new_channels = self.browse()
+        if new_channels_data:
+            new_channels = self.create(new_channels_data)
+        batch['calls'].update({k.uniqueid: k for k in new_calls})
+        batch['channels'].update({k.uniqueid: k for k in new_channels})
+        return {'calls': new_calls.mapped('uniqueid'),
+                'channels': new_channels.mapped('uniqueid')}
+
+    @api.model
+    def on_ami_new_channel(self, event):
+        """AMI NewChannel event is processed to create a new channel in Odoo.
+        """
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
+        # Create a call for the primary channel.
+        if event['Uniqueid'] == event['Linkedid']:
+            # Check if call already exists
+            call = self._find_call(event['Uniqueid'])
+            if not call:
+                call = self.env['asterisk_plus.call'].create(
+                    self._get_new_call_data(event))
+        else:
+            # There is already a parent channel and the call
+            call = self._find_call(event['Linkedid'])
+        data = self._get_new_channel_data(event, call)
+        channel = self._find_channel(event['Uniqueid'])
         if not channel:
             channel = self.create(data)
         else:
             channel.write(data)
         # Update call based on channel.
         channel.update_call_data()
-        self.reload_channels()
         if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
             data['channel_id'] = channel.id
             self.env['asterisk_plus.channel_message'].create_from_event(channel, event)
@@ -225,7 +523,7 @@ class Channel(models.Model):
             create channel message and call event log records.
             Processed when channel's state changes.
         """
-        debug(self, json.dumps(event, indent=2))
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
         get = event.get
         data = {
             'server': self.env.user.asterisk_server.id,
@@ -247,7 +545,7 @@ class Channel(models.Model):
             'language': get('Language'),
             'event': get('Event'),
         }
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', get('Uniqueid'))], limit=1)
+        channel = self._find_channel(get('Uniqueid'))
         if not channel:
             channel = self.create(data)
         else:
@@ -271,13 +569,13 @@ class Channel(models.Model):
     def on_ami_hangup(self, event):
         """AMI Hangup event.
         """
-        debug(self, json.dumps(event, indent=2))            
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
         # TODO: Limit search domain by create_date less then one day.
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
+        channel = self._find_channel(event['Uniqueid'])
         if not channel:
-            debug(self, 'Channel {} not found for hangup.'.format(event['Channel']))
+            trace(self, 'ami', 'Channel %s not found for hangup.', event['Channel'])
             return False
-        debug(self, 'Found {} channel(s) {}'.format(len(channel), event['Channel']))
+        trace(self, 'ami', 'Found %s channel(s) %s', len(channel), event['Channel'])
         data = {
             'event': event['Event'],
             'channel': event['Channel'],
@@ -320,12 +618,12 @@ class Channel(models.Model):
             'create_date': datetime.now(),
             'event': 'Channel {} hangup'.format(channel.channel_short),
         })
-        self.reload_channels()
         if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
             # Remove and add fields according to the message
             data['channel_id'] = channel.id
             self.env['asterisk_plus.channel_message'].create_from_event(channel, event)
         self.env['asterisk_plus.recording'].save_call_recording(event)
+        self._forget_live_records(event['Uniqueid'], event['Linkedid'])
         return channel.id
 
     @api.model
@@ -337,9 +635,9 @@ class Channel(models.Model):
         if event['Response'] != 'Failure':
             logger.error(self, 'Response', 'UNEXPECTED ORIGINATE RESPONSE FROM ASTERISK!')
             return False
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
+        channel = self._find_channel(event['Uniqueid'])
         if not channel:
-            debug(self, 'CHANNEL NOT FOUND FOR ORIGINATE RESPONSE!')
+            trace(self, 'ami', 'CHANNEL NOT FOUND FOR ORIGINATE RESPONSE!')
             return False
         if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
             event['channel_id'] = channel.id
@@ -363,11 +661,11 @@ class Channel(models.Model):
     def update_recording_filename(self, event):
         """AMI VarSet event.
         """
-        debug(self, json.dumps(event, indent=2))
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
         if event.get('Variable') == 'MIXMONITOR_FILENAME':
             file_path = event['Value']
             uniqueid = event['Uniqueid']
-            channel = self.search([('uniqueid', '=', uniqueid)], limit=1)
+            channel = self._find_channel(uniqueid)
             channel.recording_file_path = file_path
             return True
         return False
@@ -30,6 +30,10 @@ class ChannelMessage(models.Model):
 
     @api.model
     def create_from_event(self, channel, event):
+        if self.env['asterisk_plus.settings'].sudo().get_param(
+                'trace_ami_storage') == 'partitions':
+            self.env['asterisk_plus.ami_trace'].add_events([event])
+            return
         data = {
             'channel_id': channel.id,
             'event': event['Event'],
@@ -1,12 +1,24 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 import base64
+from contextlib import contextmanager
+import io
 import logging
+import tarfile
+import tempfile
+from psycopg2 import IntegrityError
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
+from odoo.tools import split_every
+from .conf_archive import ARCHIVE_BATCH_SIZE, ARCHIVE_SPOOL_SIZE, \
+    decode_conf, file_hash, iter_archive
 from .server import get_default_server
 
 logger = logging.getLogger(__name__)
 
+#: Partial unique index of active file names, archived files do not block
+#: the name.
+CONF_NAME_INDEX = 'asterisk_plus_conf_server_name_uniq'
+
 
 class AsteriskConf(models.Model):
     _name = 'asterisk_plus.conf'
@@ -25,23 +37,61 @@ class AsteriskConf(models.Model):
     sync_uid = fields.Many2one('res.users', readonly=True, string='Sync by')
     version = fields.Integer(
         default=1, required=True, index=True, readonly=True)
+    revisions = fields.One2many('asterisk_plus.conf_revision', 'conf',
+                                readonly=True)
+    content_hash = fields.Char(
+        compute='_compute_content_hash', store=True,
+        help='SHA-256 of the file written on Asterisk, compared with the '
+             'hashes reported by the Agent to sync only changed files.')
 
-    @api.model
-    def create(self, vals):
+    @api.model_create_multi
+    def create(self, vals_list):
         if not self.env.context.get('conf_no_update'):
-            vals['is_updated'] = True
-        rec = super(AsteriskConf, self).create(vals)
-        return rec
+            for vals in vals_list:
+                vals['is_updated'] = True
+        with self._check_unique_name():
+            recs = super(AsteriskConf, self).create(vals_list)
+        self.env['asterisk_plus.conf_revision'].sudo().add_revisions(
+            (rec, rec.content, None, None) for rec in recs.filtered('content'))
+        return recs
 
-    @api.constrains('name', 'active')
-    def check_name(self):
+    @api.depends('content')
+    def _compute_content_hash(self):
+        # Files downloaded in another encoding keep the hash of their bytes,
+        # see decode_conf.
         for rec in self:
-            existing = self.env[
-                'asterisk_plus.conf'].search(
-                [('name', '=', rec.name), ('server', '=', rec.server.id)])
-            if len(existing) > 1:
-                raise ValidationError(
-                    'This filename is already used!')
+            rec.content_hash = file_hash(
+                rec.content.encode()) if rec.content else False
+
+    def init(self):
+        # Archive duplicate active files but the last written one.
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_conf SET active = false WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, row_number() OVER (
+                        PARTITION BY server, name
+                        ORDER BY write_date DESC NULLS LAST, id DESC) AS pos
+                    FROM asterisk_plus_conf WHERE active) AS dups
+                WHERE pos > 1)
+            RETURNING id, name""")
+        for conf_id, name in self.env.cr.fetchall():
+            logger.warning('Duplicate conf file %s (ID %s) archived.',
+                           name, conf_id)
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS {}
+            ON asterisk_plus_conf (server, name) WHERE active""".format(
+            CONF_NAME_INDEX))
+
+    @contextmanager
+    def _check_unique_name(self):
+        """Show the unique file name violation as a validation error."""
+        try:
+            with self.env.cr.savepoint():
+                yield
+        except IntegrityError as e:
+            if e.diag.constraint_name == CONF_NAME_INDEX:
+                raise ValidationError(_('This filename is already used!'))
+            raise
 
     def write(self, vals):
         if 'name' in vals:
@@ -51,13 +101,27 @@ class AsteriskConf(models.Model):
             'content') and self.env.context.get('conf_no_update')
         if 'content' in vals and not no_update:
             vals['is_updated'] = True
-        if 'content' in vals and 'version' not in vals and not no_update:
-            # Inc version
-            for rec in self:
-                vals['version'] = rec.version + 1
-                super(AsteriskConf, rec).write(vals)
+        previous = {rec.id: (rec.content, rec.version)
+                    for rec in self} if 'content' in vals else {}
+        if 'active' in vals:
+            # Flushed to check the name index at once.
+            with self._check_unique_name():
+                super(AsteriskConf, self).write(vals)
+                self.flush(['active'], self)
         else:
             super(AsteriskConf, self).write(vals)
+        if 'content' in vals and 'version' not in vals and not no_update \
+                and self.ids:
+            # Inc version of all the records in one statement.
+            self.flush(['version'], self)
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_conf SET version = version + 1
+                WHERE id IN %s""", (tuple(self.ids),))
+            self.invalidate_cache(['version'], self.ids)
+        self.env['asterisk_plus.conf_revision'].sudo().add_revisions(
+            (rec, rec.content) + previous[rec.id]
+            for rec in self.filtered(lambda r: r.id in previous)
+            if (rec.content or '') != (previous[rec.id][0] or ''))
         return True
 
     def unlink(self):
@@ -74,11 +138,12 @@ class AsteriskConf(models.Model):
         """
         names = self.mapped('name')
         servers = self.mapped('server')
-        for server in servers:
-            server.local_job(
-                fun='asterisk.delete_config',
-                arg=[names],
-                res_notify_uid=self.env.uid)
+        with servers.salt_batch():
+            for server in servers:
+                server.local_job(
+                    fun='asterisk.delete_config',
+                    arg=[names],
+                    res_notify_uid=self.env.uid)
 
     def refresh_button(self):
         return True
@@ -101,6 +166,92 @@ class AsteriskConf(models.Model):
             conf = self.env['asterisk_plus.conf'].create(data)
         return conf
 
+    def write_archive(self, fileobj=None, update_hashes=False):
+        """Write the files as a gzip tar stream reading ARCHIVE_BATCH_SIZE
+        files at a time.
+
+        Args:
+            update_hashes (bool): Files are uploaded to Asterisk, set the
+                hash of the written bytes on files downloaded in another
+                encoding than UTF-8.
+
+        Returns:
+            The archive file object at position 0.
+        """
+        if fileobj is None:
+            fileobj = tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE)
+        with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+            for ids in split_every(ARCHIVE_BATCH_SIZE, self.ids):
+                for row in self.browse(ids).read(['name', 'content',
+                                                  'write_date',
+                                                  'content_hash']):
+                    data = (row['content'] or '').encode()
+                    info = tarfile.TarInfo(row['name'])
+                    info.size = len(data)
+                    info.mtime = row['write_date'].timestamp()
+                    tar.addfile(info, io.BytesIO(data))
+                    if update_hashes:
+                        self.browse(row['id'])._update_file_hash(
+                            row['content_hash'], data)
+                # Do not keep the contents in the cache.
+                self.flush()
+                self.invalidate_cache(ids=ids)
+        fileobj.seek(0)
+        return fileobj
+
+    def _update_file_hash(self, content_hash, data):
+        """Set the hash of the file bytes uploaded to Asterisk."""
+        digest = file_hash(data)
+        if content_hash != digest:
+            self.write({'content_hash': digest})
+
+    @api.model
+    def apply_archive(self, server, fileobj, sync=True):
+        """Create or update the server files from a tar stream."""
+        return self.apply_files(server, iter_archive(fileobj), sync=sync)
+
+    @api.model
+    def apply_files(self, server, files, sync=True):
+        """Create or update the server files with one prefetch of the
+        existing files and batched creates. Unchanged files are skipped.
+
+        Args:
+            files: Iterable of (name, content, hash of the file bytes).
+            sync (bool): Files come from Asterisk, they are not changed in Odoo.
+
+        Returns:
+            Names of the created or updated files.
+        """
+        existing = {k['name']: k for k in self.search_read(
+            [('server', '=', server.id)], ['name', 'content_hash'])}
+        changed = []
+        for batch in split_every(ARCHIVE_BATCH_SIZE, files):
+            changed.extend(self._apply_files_batch(server, batch, existing,
+                                                   sync))
+        return changed
+
+    def _apply_files_batch(self, server, batch, existing, sync):
+        vals = {'sync_date': fields.Datetime.now(), 'sync_uid': self.env.uid,
+                'is_updated': False} if sync else {}
+        confs = self.with_context(conf_no_update=True) if sync else self
+        new, changed = [], []
+        for name, content, digest in batch:
+            current = existing.get(name)
+            if current and current['content_hash'] == digest:
+                continue
+            changed.append(name)
+            file_vals = dict(vals, content=content, content_hash=digest)
+            if current:
+                confs.browse(current['id']).write(file_vals)
+            else:
+                new.append(dict(file_vals, server=server.id, name=name))
+        if new:
+            confs.create(new)
+        # Do not keep the contents in memory.
+        self.flush()
+        self.invalidate_cache()
+        return changed
+
     def include_from(self, from_name):
         self.ensure_one()
         from_conf = self.env['asterisk_plus.conf'].search(
@@ -141,6 +292,7 @@ class AsteriskConf(models.Model):
                     uid=pass_back['uid'])
             return False
         conf = self.browse(pass_back['res_id'])
+        conf._update_file_hash(conf.content_hash, (conf.content or '').encode())
         conf.write({
             'is_updated': False,
             'sync_date': fields.Datetime.now(),
@@ -151,7 +303,7 @@ class AsteriskConf(models.Model):
             uid=pass_back['uid'])
         return True
 
-    def download_conf(self, notify_uid=None):
+    def download_conf(self, notify_uid=None, notify=True):
         """Download conf from server.
         """
         self.ensure_one()
@@ -164,6 +316,7 @@ class AsteriskConf(models.Model):
                 'res_id': self.id,
                 'uid': self.env.uid,
                 'name': self.name,
+                'notify': notify,
             })
 
     @api.model
@@ -177,13 +330,16 @@ class AsteriskConf(models.Model):
                     uid=pass_back['uid'])
             return False
         conf = self.browse(pass_back['res_id'])
+        content, digest = decode_conf(response['file_data'])
         conf.with_context({'conf_no_update': True}).write({
-            'content': base64.b64decode(
-                response['file_data'].encode()).decode('latin-1'),
+            'content': content,
+            'content_hash': digest,
             'sync_date': fields.Datetime.now(),
             'sync_uid': self.env.user.id,
             'is_updated': False,
         })
+        if not pass_back.get('notify', True):
+            return True
         self.env.user.asterisk_plus_notify(
             'File {} downloaded.'.format(
                 pass_back['name']),
@@ -0,0 +1,65 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+import hashlib
+import tarfile
+import tempfile
+
+#: Files read or written at once when moving conf archives.
+ARCHIVE_BATCH_SIZE = 100
+#: Archive bytes kept in memory before spooling to a temporary file.
+ARCHIVE_SPOOL_SIZE = 1024 * 1024
+#: Bytes of an archive base64 encoded at once, a multiple of 3.
+BASE64_CHUNK = 3 * 65536
+
+
+def decode_content(data):
+    """Conf content from file bytes."""
+    try:
+        return data.decode()
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def file_hash(data):
+    """SHA-256 of file bytes as reported by asterisk.get_config_hashes."""
+    return hashlib.sha256(data).hexdigest() if data else False
+
+
+def decode_conf(data):
+    """Conf content and the hash of the file bytes from base64 file data
+    of the Agent. The hash is taken before decoding so that files not in
+    UTF-8 match the hash of the Agent.
+    """
+    data = base64.b64decode(data.encode())
+    return decode_content(data), file_hash(data)
+
+
+def archive_to_base64(fileobj):
+    """Base64 of an archive for a Salt job, encoded chunk by chunk."""
+    fileobj.seek(0)
+    parts = []
+    for chunk in iter(lambda: fileobj.read(BASE64_CHUNK), b''):
+        parts.append(base64.b64encode(chunk).decode())
+    return ''.join(parts)
+
+
+def base64_to_archive(data):
+    """Archive file from the base64 data of a Salt return."""
+    fileobj = tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE)
+    step = BASE64_CHUNK // 3 * 4
+    for pos in range(0, len(data), step):
+        fileobj.write(base64.b64decode(data[pos:pos + step]))
+    fileobj.seek(0)
+    return fileobj
+
+
+def iter_archive(fileobj):
+    """(name, content, hash) of the files of a tar stream, one at a time."""
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = member.name[2:] if member.name.startswith('./') \
+                else member.name
+            data = tar.extractfile(member).read()
+            yield name, decode_content(data), file_hash(data)
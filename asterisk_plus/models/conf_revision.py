@@ -0,0 +1,197 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+import difflib
+import json
+import logging
+import zlib
+from odoo import models, fields, api, _
+from odoo.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+#: A revision after SNAPSHOT_INTERVAL deltas keeps the full content.
+SNAPSHOT_INTERVAL = 20
+
+
+def make_delta(old, new):
+    """Line delta from old to new content: [[start, end, new lines]]."""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    return [[i1, i2, new_lines[j1:j2]] for tag, i1, i2, j1, j2 in
+            difflib.SequenceMatcher(
+                None, old_lines, new_lines, autojunk=False).get_opcodes()
+            if tag != 'equal']
+
+
+def apply_delta(old, delta):
+    """New content from old content and make_delta result."""
+    old_lines = old.splitlines(keepends=True)
+    lines, pos = [], 0
+    for start, end, new_lines in delta:
+        lines.extend(old_lines[pos:start])
+        lines.extend(new_lines)
+        pos = end
+    lines.extend(old_lines[pos:])
+    return ''.join(lines)
+
+
+def pack(value):
+    """Compressed JSON as base64 for the binary field."""
+    return base64.b64encode(zlib.compress(json.dumps(value).encode()))
+
+
+def unpack(data):
+    return json.loads(zlib.decompress(base64.b64decode(data)).decode())
+
+
+class ConfRevision(models.Model):
+    """Content history of a conf file.
+
+    Every content change is kept as a compressed line delta from the
+    previous revision. After SNAPSHOT_INTERVAL deltas the full content is
+    kept, so any revision is rebuilt from one snapshot and at most
+    SNAPSHOT_INTERVAL deltas.
+    """
+    _name = 'asterisk_plus.conf_revision'
+    _description = 'Conf File Revision'
+    _order = 'id desc'
+    _rec_name = 'version'
+
+    conf = fields.Many2one('asterisk_plus.conf', required=True,
+                           ondelete='cascade', index=True, readonly=True)
+    version = fields.Integer(readonly=True)
+    snapshot = fields.Boolean(readonly=True)
+    data = fields.Binary(attachment=False, readonly=True)
+    size = fields.Integer(readonly=True, string='Stored Bytes')
+    content = fields.Text(compute='_get_content')
+
+    @api.model
+    def add_revisions(self, changes):
+        """Record the new contents of the confs with one create and one
+        retention pass for the batch.
+
+        Args:
+            changes: Iterable of (conf, content, previous content, previous
+                version). The previous content is saved first if the conf
+                has no history yet.
+        """
+        changes = list(changes)
+        if not changes:
+            return self
+        conf_ids = tuple(change[0].id for change in changes)
+        self.flush(['conf', 'snapshot'])
+        # Revisions and deltas after the last snapshot by conf.
+        self.env.cr.execute("""
+            SELECT conf, COUNT(*), COUNT(*) FILTER (
+                WHERE NOT snapshot AND id > COALESCE((
+                    SELECT MAX(s.id) FROM asterisk_plus_conf_revision s
+                    WHERE s.conf = r.conf AND s.snapshot), 0))
+            FROM asterisk_plus_conf_revision r
+            WHERE conf IN %s GROUP BY conf""", (conf_ids,))
+        history = {conf_id: (count, deltas) for conf_id, count, deltas
+                   in self.env.cr.fetchall()}
+        vals_list = []
+        for conf, content, previous, previous_version in changes:
+            count, deltas = history.get(conf.id, (0, 0))
+            if not count and previous:
+                vals_list.append(self._revision_vals(
+                    conf, previous, True, version=previous_version))
+                count = 1
+            vals_list.append(self._revision_vals(
+                conf, content, not count or deltas >= SNAPSHOT_INTERVAL,
+                previous))
+        revs = self.create(vals_list)
+        self._vacuum(conf_ids)
+        return revs
+
+    def _revision_vals(self, conf, content, snapshot, previous='',
+                       version=None):
+        data = pack(content or '')
+        if not snapshot:
+            delta = pack(make_delta(previous or '', content or ''))
+            if len(delta) < len(data):
+                data = delta
+            else:
+                snapshot = True
+        return {
+            'conf': conf.id,
+            'version': version or conf.version,
+            'snapshot': snapshot,
+            'data': data,
+            'size': len(base64.b64decode(data)),
+        }
+
+    def _vacuum(self, conf_ids):
+        """Retention: keep the last conf_revisions_keep revisions of the confs
+        and the snapshot they are built from.
+        """
+        keep = self.env['asterisk_plus.settings'].get_param(
+            'conf_revisions_keep')
+        if not keep:
+            return
+        self.flush()
+        self.env.cr.execute("""
+            WITH ranked AS (
+                SELECT id, conf, snapshot, row_number() OVER (
+                    PARTITION BY conf ORDER BY id DESC) AS pos
+                FROM asterisk_plus_conf_revision WHERE conf IN %s),
+            base AS (
+                SELECT conf, MAX(id) AS id FROM ranked
+                WHERE snapshot AND pos >= %s GROUP BY conf)
+            DELETE FROM asterisk_plus_conf_revision r USING base
+            WHERE r.conf = base.conf AND r.id < base.id""",
+                            (tuple(conf_ids), keep))
+        if self.env.cr.rowcount:
+            self.invalidate_cache()
+
+    @api.depends('data')
+    def _get_content(self):
+        for rec in self:
+            rec.content = rec._build_content()
+
+    def _build_content(self):
+        """Content from the last snapshot and the deltas after it."""
+        self.ensure_one()
+        # Not the size of the data in form views.
+        chain = self.with_context(bin_size=False).search(
+            [('conf', '=', self.conf.id), ('id', '<=', self.id)])
+        base = next((k for k in chain if k.snapshot), None)
+        if not base:
+            logger.warning('Conf %s revision %s snapshot not found.',
+                           self.conf.name, self.id)
+            return False
+        content = unpack(base.data)
+        for rev in chain.filtered(lambda r: r.id > base.id).sorted('id'):
+            content = apply_delta(content, unpack(rev.data))
+        return content
+
+    def open_diff(self):
+        """Compare with the current content of the conf."""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'asterisk_plus.conf_diff_wizard',
+            'name': _('Compare {}').format(self.conf.name),
+            'view_mode': 'form',
+            'target': 'new',
+            'context': {
+                'default_conf': self.conf.id,
+                'default_from_revision': self.id,
+            },
+        }
+
+    def rollback(self):
+        """Restore the revision content and upload it to Asterisk."""
+        self.ensure_one()
+        conf = self.conf
+        if not conf.active:
+            raise ValidationError(_('Restore file {} first.').format(conf.name))
+        content = self._build_content()
+        if content is False:
+            raise ValidationError(_('Revision {} can not be restored.').format(
+                self.version))
+        conf.content = content
+        with conf.server.salt_batch():
+            conf.upload_conf()
+            conf.server.reload_confs([conf.name])
+        return True
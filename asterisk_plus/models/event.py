@@ -34,6 +34,35 @@ class Event(models.Model):
             else:
                 rec.icon = '<span class="fa fa-lock"></span>'
 
+    def read(self, fields=None, load='_classic_read'):
+        res = super(Event, self).read(fields=fields, load=load)
+        if self.env.user.asterisk_server and self.env[
+                'asterisk_plus.settings'].sudo().get_param('queue_ami_events'):
+            self._route_to_queue(res)
+        return res
+
+    def _route_to_queue(self, res):
+        """Point the AMI handlers read by the Agent to the event queue.
+        The first handler of every event name sends all its events, the
+        consumers check the conditions, other handlers are never called.
+        """
+        first_ids = {}
+        for rec in self.sudo().search([('source', '=', 'AMI'),
+                                       ('is_enabled', '=', True)],
+                                      order='id'):
+            first_ids.setdefault(rec.name, rec.id)
+        names = {k.id: k.name for k in self.sudo() if k.source == 'AMI'}
+        for row in res:
+            if row['id'] not in names:
+                continue
+            is_first = first_ids.get(names[row['id']]) == row['id']
+            row.update({k: v for k, v in {
+                'model': 'asterisk_plus.event_queue',
+                'method': 'enqueue',
+                'delay': 0,
+                'condition': False if is_first else 'False',
+            }.items() if k in row})
+
     def write(self, vals):
         # Prevent record update if update = 'no'. If statement hack to allow overwrite update value
         if self.update == 'no' and vals.get('update', 'no') == 'no':
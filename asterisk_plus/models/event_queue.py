@@ -0,0 +1,175 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import OrderedDict
+import json
+import logging
+import time
+from odoo import models, fields, api, _
+from .channel import get_event_linkedid, live_records_savepoint
+
+logger = logging.getLogger(__name__)
+
+#: Advisory lock class key used to serialize consumers of the same call.
+QUEUE_LOCK_KEY = 5061
+
+
+class EventQueue(models.Model):
+    """Durable inbox of AMI events. The Agent only appends events here,
+    consumers (cron jobs) drain the queue with FOR UPDATE SKIP LOCKED so
+    that events of different calls are processed in parallel while events
+    of the same call (Linkedid) keep their order.
+    """
+    _name = 'asterisk_plus.event_queue'
+    _description = 'AMI Event Queue'
+    _order = 'id'
+    _rec_name = 'event'
+
+    linkedid = fields.Char(size=64, index=True, string='Linked ID')
+    event = fields.Char(size=64)
+    data = fields.Text(required=True)
+    #: Account of the Agent that has sent the event. Handlers run under it.
+    user = fields.Many2one('res.users', required=True, ondelete='cascade')
+    state = fields.Selection([('pending', 'Pending'), ('failed', 'Failed')],
+                             default='pending', required=True, index=True)
+    error = fields.Text()
+
+    @api.model
+    def enqueue(self, events):
+        """Called by the Agent instead of event handlers when Queue AMI
+        Events is set, see Event.read.
+
+        Args:
+            events (list): AMI event or a list of AMI events in the order received.
+
+        Returns:
+            Number of events added.
+        """
+        if isinstance(events, dict):
+            events = [events]
+        if not events:
+            return 0
+        self.sudo().create([{
+            'linkedid': get_event_linkedid(event),
+            'event': event.get('Event'),
+            'data': json.dumps(event),
+            'user': self.env.uid,
+        } for event in events])
+        self._trigger_consumers()
+        return len(events)
+
+    @api.model
+    def _trigger_consumers(self):
+        for cron in self.env['ir.cron'].sudo().search(
+                [('model_id.model', '=', self._name)]):
+            cron._trigger()
+
+    @api.model
+    def process_queue(self, limit=500, time_limit=50):
+        """Cron job to drain the queue. Several consumers run in parallel.
+
+        Args:
+            limit (int): Max events taken in one transaction.
+            time_limit (int): Seconds after the consumer stops.
+        """
+        started = time.monotonic()
+        processed = 0
+        while time.monotonic() - started < time_limit:
+            done = self._process_queue_batch(limit)
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if not done:
+                break
+            processed += done
+        if processed:
+            logger.info('Processed %s queued AMI events.', processed)
+        return processed
+
+    @api.model
+    def _process_queue_batch(self, limit):
+        cr = self.env.cr
+        cr.execute("""SELECT id, linkedid FROM asterisk_plus_event_queue
+                      WHERE state = 'pending' ORDER BY id LIMIT %s
+                      FOR UPDATE SKIP LOCKED""", (limit,))
+        calls = OrderedDict()
+        for row_id, linkedid in cr.fetchall():
+            calls.setdefault(linkedid or '', []).append(row_id)
+        ready = []
+        for linkedid, row_ids in calls.items():
+            # Only one consumer may process a call and it must own the
+            # oldest pending event of the call.
+            cr.execute('SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))',
+                       (QUEUE_LOCK_KEY, linkedid))
+            if not cr.fetchone()[0]:
+                continue
+            cr.execute("""SELECT 1 FROM asterisk_plus_event_queue
+                          WHERE linkedid = %s AND state = 'pending' AND id < %s
+                          LIMIT 1""", (linkedid, row_ids[0]))
+            if cr.fetchone():
+                continue
+            ready.append(row_ids)
+        if not ready:
+            return 0
+        rows = self.sudo().browse(sorted(sum(ready, [])))
+        try:
+            with live_records_savepoint(cr):
+                self._process_rows(rows)
+        except Exception:
+            # Dead letter: failed calls are kept aside so that the batch
+            # is not retried forever.
+            logger.exception('AMI event queue batch error, processing '
+                             'calls one by one:')
+            self.invalidate_cache()
+            for row_ids in ready:
+                call_rows = rows.browse(row_ids)
+                try:
+                    with live_records_savepoint(cr):
+                        self._process_rows(call_rows)
+                except Exception as e:
+                    logger.exception('AMI event queue call error:')
+                    self.invalidate_cache()
+                    call_rows.write({'state': 'failed', 'error': str(e)})
+        self.invalidate_cache()
+        return len(rows)
+
+    def _process_rows(self, rows):
+        """Run handlers of the queued events and delete the processed rows.
+        Calls failed by the handlers are marked as failed.
+        """
+        by_user = OrderedDict()
+        for row in rows:
+            by_user.setdefault(row.user.id, []).append(row.id)
+        for uid, row_ids in by_user.items():
+            user_rows = rows.browse(row_ids)
+            _, errors = self.env['asterisk_plus.channel'].with_user(
+                uid)._process_ami_events(
+                [json.loads(k.data) for k in user_rows])
+            failed = user_rows.filtered(lambda r: r.linkedid in errors)
+            for row in failed:
+                row.write({'state': 'failed', 'error': errors[row.linkedid]})
+            done_ids = tuple((user_rows - failed).ids)
+            if done_ids:
+                self.flush()
+                self.env.cr.execute('DELETE FROM asterisk_plus_event_queue '
+                                    'WHERE id IN %s', (done_ids,))
+
+    def retry(self):
+        """Put failed events back to the queue.
+        """
+        self.write({'state': 'pending', 'error': False})
+        self._trigger_consumers()
+
+    @api.model
+    def get_queue_stats(self):
+        """Returns queue depth and lag in seconds of the oldest pending event.
+        """
+        self.env.cr.execute("""
+            SELECT count(*),
+                   EXTRACT(EPOCH FROM (now() at time zone 'UTC') - min(create_date))
+            FROM asterisk_plus_event_queue WHERE state = 'pending'""")
+        depth, lag = self.env.cr.fetchone()
+        self.env.cr.execute("""SELECT count(*) FROM asterisk_plus_event_queue
+                               WHERE state = 'failed'""")
+        return {
+            'depth': depth,
+            'lag': round(float(lag or 0), 3),
+            'failed': self.env.cr.fetchone()[0],
+        }
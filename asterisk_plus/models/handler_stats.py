@@ -0,0 +1,200 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from contextlib import contextmanager
+import cProfile
+from functools import wraps
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Upper bounds of latency histogram buckets in seconds.
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0, float('inf')]
+#: Minutes kept in rolling histograms.
+ROLLING_MINUTES = 15
+#: Number of functions kept in a handler profile.
+PROFILE_LINES = 25
+
+
+class Histogram:
+    """Latency histogram with SQL queries and rows written sums."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, seconds, queries, rows, error=False):
+        self.count += 1
+        self.errors += int(error)
+        self.time_sum += seconds
+        self.time_max = max(self.time_max, seconds)
+        self.queries += queries
+        self.rows += rows
+        for pos, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[pos] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.queries += other.queries
+        self.rows += other.rows
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, pct):
+        """Upper bound of the bucket of the percentile."""
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for pos, bound in enumerate(LATENCY_BUCKETS):
+            seen += self.buckets[pos]
+            if seen >= rank and seen:
+                return min(bound, self.time_max)
+        return self.time_max
+
+    def to_dict(self):
+        count = self.count or 1
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.time_sum / count * 1000, 2),
+            'p50_ms': round(self.percentile(50) * 1000, 2),
+            'p95_ms': round(self.percentile(95) * 1000, 2),
+            'p99_ms': round(self.percentile(99) * 1000, 2),
+            'max_ms': round(self.time_max * 1000, 2),
+            'queries_per_call': round(self.queries / count, 1),
+            'rows_per_call': round(self.rows / count, 1),
+        }
+
+
+class HandlerStats:
+    """Per worker handler statistics: rolling per minute histograms and
+    totals since the worker start.
+    """
+
+    def __init__(self, minutes=ROLLING_MINUTES):
+        self.minutes = minutes
+        self._slots = {}
+        self._totals = {}
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def record(self, db, name, seconds, queries, rows=0, error=False):
+        minute = int(time.time() // 60)
+        with self._lock:
+            slots = self._slots.setdefault((db, name), [])
+            if not slots or slots[-1][0] != minute:
+                slots.append((minute, Histogram()))
+                while slots[0][0] <= minute - self.minutes:
+                    slots.pop(0)
+            slots[-1][1].add(seconds, queries, rows, error)
+            self._totals.setdefault((db, name), Histogram()).add(
+                seconds, queries, rows, error)
+
+    def get_rolling(self, db):
+        """Histograms of the last minutes by handler name."""
+        since = int(time.time() // 60) - self.minutes
+        res = {}
+        with self._lock:
+            for (slot_db, name), slots in self._slots.items():
+                if slot_db != db:
+                    continue
+                hist = Histogram()
+                for minute, slot in slots:
+                    if minute > since:
+                        hist.merge(slot)
+                if hist.count:
+                    res[name] = hist
+        return res
+
+    def get_totals(self, db):
+        """Histograms since the worker start by handler name."""
+        with self._lock:
+            return {name: hist for (hist_db, name), hist in
+                    self._totals.items() if hist_db == db}
+
+    def set_profile(self, db, name, profile):
+        self._profiles[(db, name)] = profile
+
+    def get_profiles(self, db):
+        return {name: profile for (profile_db, name), profile in
+                self._profiles.items() if profile_db == db}
+
+
+#: Statistics of the worker.
+handler_stats = HandlerStats()
+
+
+def get_rows_written(cr):
+    cr.execute("""SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0)
+                  FROM pg_stat_xact_user_tables""")
+    return cr.fetchone()[0]
+
+
+@contextmanager
+def measure(env, name, flush=False):
+    """Record wall time, SQL queries and rows written by the block.
+    Set flush to count the deferred writes of the block in it.
+
+    .. code:: python
+
+        with measure(self.env, 'ami:on_ami_hangup'):
+            self.on_ami_hangup(event)
+    """
+    enabled, count_rows, profiled, profile_rate = env[
+        'asterisk_plus.settings']._get_stats_config()
+    if not enabled:
+        yield
+        return
+    cr = env.cr
+    rows = get_rows_written(cr) if count_rows else 0
+    profiler = None
+    if profiled and any(name.endswith(k) for k in profiled) and \
+            random.random() < profile_rate:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    queries = cr.sql_log_count
+    started = time.time()
+    try:
+        yield
+        if flush:
+            env['base'].flush()
+    except Exception:
+        handler_stats.record(cr.dbname, name, time.time() - started,
+                             cr.sql_log_count - queries, error=True)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+    seconds = time.time() - started
+    queries = cr.sql_log_count - queries
+    if count_rows:
+        rows = get_rows_written(cr) - rows
+    handler_stats.record(cr.dbname, name, seconds, queries, rows)
+    if profiler:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(
+            'cumulative').print_stats(PROFILE_LINES)
+        handler_stats.set_profile(cr.dbname, name, out.getvalue())
+
+
+def measured(name):
+    """Decorator of model methods recorded by measure()."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with measure(self.env, name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
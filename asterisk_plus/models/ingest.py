@@ -0,0 +1,222 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+"""Compact binary frames of AMI events and Salt returns sent by the Agent
+to /asterisk_plus/ingest.
+
+A frame is a MessagePack or CBOR map:
+
+.. code:: python
+
+    {'events': [AMI event, ...], 'returns': [Salt return, ...]}
+
+Keys of events and returns found in HEADERS are sent as their index and
+binary data (e.g. recordings) is sent raw, not base64 encoded. Run this
+file to compare the codecs with the JSON-RPC payload.
+"""
+import base64
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+    MSGPACK = True
+except ImportError:
+    logger.info('MessagePack ingestion not available. '
+                'To enable pip3 install msgpack.')
+    MSGPACK = False
+try:
+    import cbor2
+    CBOR = True
+except ImportError:
+    logger.info('CBOR ingestion not available. To enable pip3 install cbor2.')
+    CBOR = False
+
+#: Codec by request Content-Type.
+CONTENT_TYPES = {
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/cbor': 'cbor',
+}
+#: Content-Type by codec.
+CODEC_CONTENT_TYPES = {
+    'msgpack': 'application/msgpack',
+    'cbor': 'application/cbor',
+}
+#: Header names sent as their index. Append only, the Agent and Odoo must
+#: share the same list.
+HEADERS = (
+    # AMI
+    'Event', 'Privilege', 'SystemName', 'Channel', 'ChannelState',
+    'ChannelStateDesc', 'CallerIDNum', 'CallerIDName', 'ConnectedLineNum',
+    'ConnectedLineName', 'Language', 'AccountCode', 'Context', 'Exten',
+    'Priority', 'Uniqueid', 'Linkedid', 'DestChannel', 'DestChannelState',
+    'DestChannelStateDesc', 'DestCallerIDNum', 'DestCallerIDName',
+    'DestConnectedLineNum', 'DestConnectedLineName', 'DestLanguage',
+    'DestAccountCode', 'DestContext', 'DestExten', 'DestPriority',
+    'DestUniqueid', 'DestLinkedid', 'DialString', 'DialStatus', 'Cause',
+    'Cause-txt', 'Variable', 'Value', 'Application', 'AppData',
+    'BridgeUniqueid', 'BridgeType', 'BridgeTechnology', 'BridgeCreator',
+    'BridgeName', 'BridgeNumChannels', 'Response', 'ActionID', 'Message',
+    'Timestamp', 'Status', 'Queue', 'Interface', 'MemberName',
+    'Peer', 'PeerStatus', 'Address', 'Device', 'State',
+    # Salt returns
+    'jid', 'return', 'retcode', 'id', 'fun', 'fun_args', 'success',
+    'file_data',
+)
+HEADER_IDS = {name: pos for pos, name in enumerate(HEADERS)}
+
+
+def pack_keys(message):
+    """Replace known header names with their index."""
+    return {HEADER_IDS.get(key, key): value for key, value in message.items()}
+
+
+def unpack_keys(message):
+    """Header names from their index."""
+    try:
+        return {HEADERS[key] if isinstance(key, int) else key: value
+                for key, value in message.items()}
+    except IndexError as e:
+        raise ValueError('Unknown header index: {}'.format(e))
+
+
+def binary_to_base64(value):
+    """Base64 encode raw binary values for Odoo handlers."""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if isinstance(value, dict):
+        return {key: binary_to_base64(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [binary_to_base64(item) for item in value]
+    return value
+
+
+def dumps(obj, codec):
+    if codec == 'msgpack' and MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    if codec == 'cbor' and CBOR:
+        return cbor2.dumps(obj)
+    raise ValueError('Codec {} is not available.'.format(codec))
+
+
+def loads(data, codec):
+    if codec == 'msgpack' and MSGPACK:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    if codec == 'cbor' and CBOR:
+        return cbor2.loads(data)
+    raise ValueError('Codec {} is not available.'.format(codec))
+
+
+def encode_frame(events=None, returns=None, codec='msgpack'):
+    """Agent side: frame of AMI events and Salt returns."""
+    frame = {}
+    if events:
+        frame['events'] = [pack_keys(k) for k in events]
+    if returns:
+        frame['returns'] = [pack_keys(k) for k in returns]
+    return dumps(frame, codec)
+
+
+def decode_frame(data, codec):
+    """Odoo side: events and returns as the JSON-RPC handlers get them.
+
+    Raises:
+        ValueError: Frame can not be decoded.
+    """
+    try:
+        frame = loads(data, codec)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError('Bad {} frame: {}'.format(codec, e))
+    if not isinstance(frame, dict):
+        raise ValueError('Frame is not a map.')
+    return {
+        'events': [binary_to_base64(unpack_keys(k))
+                   for k in frame.get('events') or []],
+        'returns': [binary_to_base64(unpack_keys(k))
+                    for k in frame.get('returns') or []],
+    }
+
+
+def sample_frame(events=100, recording_size=160000):
+    """Typical Agent traffic: call events and one recording return."""
+    event = {
+        'Event': 'Newchannel', 'Privilege': 'call,all',
+        'SystemName': 'asterisk', 'Channel': 'PJSIP/1001-00000001',
+        'ChannelState': '0', 'ChannelStateDesc': 'Down',
+        'CallerIDNum': '1001', 'CallerIDName': 'John Smith',
+        'ConnectedLineNum': '<unknown>', 'ConnectedLineName': '<unknown>',
+        'Language': 'en', 'AccountCode': '', 'Context': 'users',
+        'Exten': '+15551234567', 'Priority': '1',
+        'Uniqueid': '1631707333.1234', 'Linkedid': '1631707333.1234',
+    }
+    ret = {
+        'jid': '20210916150939079024', 'id': 'asterisk',
+        'fun': 'asterisk.get_file', 'fun_args': ['/var/spool/1.wav'],
+        'retcode': 0, 'success': True,
+        'return': {'file_data': bytes(range(256)) * (recording_size // 256)},
+    }
+    return [dict(event) for _ in range(events)], [ret]
+
+
+def json_rpc_payload(events, returns):
+    """Current JSON-RPC requests of the Agent: base64 data, string keys."""
+    return [json.dumps({
+        'jsonrpc': '2.0', 'method': 'call', 'params': {
+            'service': 'object', 'method': 'execute_kw',
+            'args': ['odoo', 2, 'password', model, method, [data]]}}).encode()
+        for model, method, data in [
+            ('asterisk_plus.event_queue', 'enqueue', events),
+            ('asterisk_plus.salt_job', 'returner_bulk',
+             binary_to_base64(returns))]]
+
+
+def benchmark(events=None, returns=None, rounds=100):
+    """Size and encode / decode time per frame of every available codec
+    compared with JSON-RPC.
+
+    Returns:
+        {codec: {'bytes': size, 'encode': seconds, 'decode': seconds}}
+    """
+    if events is None and returns is None:
+        events, returns = sample_frame()
+    res = {}
+    started = time.perf_counter()
+    for _ in range(rounds):
+        payload = json_rpc_payload(events, returns)
+    encoded = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in payload:
+            json.loads(data)
+    res['json-rpc'] = {
+        'bytes': sum(len(k) for k in payload),
+        'encode': encoded / rounds,
+        'decode': (time.perf_counter() - started) / rounds,
+    }
+    for codec, available in [('msgpack', MSGPACK), ('cbor', CBOR)]:
+        if not available:
+            continue
+        started = time.perf_counter()
+        for _ in range(rounds):
+            data = encode_frame(events, returns, codec)
+        encoded = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(rounds):
+            decode_frame(data, codec)
+        res[codec] = {
+            'bytes': len(data),
+            'encode': encoded / rounds,
+            'decode': (time.perf_counter() - started) / rounds,
+        }
+    return res
+
+
+if __name__ == '__main__':
+    for name, stats in benchmark().items():
+        print('{:10} {:>10} bytes  encode {:8.3f} ms  decode {:8.3f} ms'.format(
+            name, stats['bytes'], stats['encode'] * 1000,
+            stats['decode'] * 1000))
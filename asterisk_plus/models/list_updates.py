@@ -0,0 +1,99 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import logging
+import threading
+from odoo import api, registry, SUPERUSER_ID
+
+logger = logging.getLogger(__name__)
+
+#: Seconds to collect list changes before they are sent to browsers.
+LIST_UPDATE_WINDOW = 1.0
+
+
+def get_list_channel(model):
+    """Bus channel of a list view. Browsers listen to it only while
+    the list of the model is open.
+    """
+    return 'asterisk_plus_list_{}'.format(model)
+
+
+class ListUpdateCoalescer:
+    """Collects created / updated / removed record IDs per database and model
+    and sends them as one 'update_list' bus message per window.
+    """
+
+    def __init__(self, window=LIST_UPDATE_WINDOW):
+        self.window = window
+        self._pending = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def add(self, db, model, created=(), updated=None, removed=()):
+        with self._lock:
+            delta = self._pending.setdefault((db, model), {
+                'created': set(), 'updated': {}, 'removed': set()})
+            delta['created'].update(created)
+            for res_id, field_names in (updated or {}).items():
+                delta['updated'].setdefault(res_id, set()).update(field_names)
+            delta['removed'].update(removed)
+            if db not in self._timers:
+                timer = threading.Timer(self.window, self.flush, args=(db,))
+                timer.daemon = True
+                self._timers[db] = timer
+                timer.start()
+
+    def flush(self, db):
+        with self._lock:
+            self._timers.pop(db, None)
+            deltas = {k[1]: self._pending.pop(k) for k in list(self._pending)
+                      if k[0] == db}
+        if not deltas:
+            return
+        try:
+            with registry(db).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                for model, delta in deltas.items():
+                    removed = delta['removed']
+                    env['bus.bus'].sendone(get_list_channel(model), {
+                        'action': 'update_list',
+                        'model': model,
+                        'created': sorted(delta['created'] - removed),
+                        'updated': {
+                            res_id: sorted(field_names)
+                            for res_id, field_names in delta['updated'].items()
+                            if res_id not in removed},
+                        'removed': sorted(removed),
+                    })
+        except Exception:
+            logger.exception('Send list updates error:')
+
+
+#: Coalescer of the worker.
+list_updates = ListUpdateCoalescer()
+
+
+def notify_list_update(records, created=False, removed=False, field_names=None):
+    """Schedule a list update of records sent after the transaction commit.
+
+    Args:
+        records: Created, updated or removed records.
+        created (bool): Records are created.
+        removed (bool): Records are removed.
+        field_names (list): Changed fields of updated records.
+    """
+    if not records:
+        return
+    cr = records.env.cr
+    data = cr.postcommit.data.setdefault('asterisk_plus.list_updates', {})
+    if not data:
+        cr.postcommit.add(lambda: [
+            list_updates.add(cr.dbname, model, **delta)
+            for model, delta in data.items()])
+    delta = data.setdefault(records._name, {
+        'created': set(), 'updated': {}, 'removed': set()})
+    if created:
+        delta['created'].update(records.ids)
+    elif removed:
+        delta['removed'].update(records.ids)
+    else:
+        for res_id in records.ids:
+            delta['updated'].setdefault(res_id, set()).update(field_names or [])
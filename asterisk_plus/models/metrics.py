@@ -0,0 +1,139 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import logging
+import os
+import threading
+import time
+from .handler_stats import Histogram, LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+#: Seconds gauges taken from the database are cached by every worker.
+METRICS_CACHE_TTL = 15
+#: Exported metrics: name -> (type, help).
+METRICS = {
+    'asterisk_plus_active_calls': (
+        'gauge', 'Calls in progress.'),
+    'asterisk_plus_active_channels': (
+        'gauge', 'Channels not hung up yet.'),
+    'asterisk_plus_ami_events_total': (
+        'counter', 'AMI events processed by type.'),
+    'asterisk_plus_event_queue_depth': (
+        'gauge', 'AMI events waiting in the event queue.'),
+    'asterisk_plus_salt_jobs_pending': (
+        'gauge', 'Salt jobs of the last hour without a return.'),
+    'asterisk_plus_salt_job_roundtrip_seconds': (
+        'histogram', 'Time from Salt job submission to its return.'),
+    'asterisk_plus_recording_upload_bytes_total': (
+        'counter', 'Bytes of call recordings received from Asterisk.'),
+    'asterisk_plus_recording_encode_seconds': (
+        'histogram', 'Time to encode call recordings to MP3.'),
+    'asterisk_plus_caller_lookups_total': (
+        'counter', 'Caller ID name lookups.'),
+    'asterisk_plus_caller_lookup_misses_total': (
+        'counter', 'Caller ID name lookups not found in the cache.'),
+    'asterisk_plus_caller_lookup_hit_rate': (
+        'gauge', 'Share of caller ID name lookups found in the cache.'),
+    'asterisk_plus_caller_lookup_seconds': (
+        'histogram', 'Caller ID name lookup time.'),
+    'asterisk_plus_handler_seconds': (
+        'histogram', 'AMI handlers and Salt callbacks time.'),
+    'asterisk_plus_server_up': (
+        'gauge', 'Minion health: 1 if replying to pings and jobs.'),
+    'asterisk_plus_ingest_bytes_total': (
+        'counter', 'Bytes of binary Agent frames received by codec.'),
+    'asterisk_plus_saltapi_circuit_open': (
+        'gauge', 'Salt API circuit of the worker is open.'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for key, value in sorted(labels)))
+
+
+class Metrics:
+    """Per worker counters and histograms rendered in Prometheus text format.
+
+    Every series has the worker label with the PID of the worker serving the
+    scrape, so series of different workers are not mixed up. Odoo balances
+    the requests across workers: scrape often enough to reach all of them,
+    sum counters by worker with ``sum without (worker)`` and take database
+    gauges with ``max without (worker)``.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._cached = {}
+        self._lock = threading.Lock()
+
+    def inc(self, db, name, value=1, **labels):
+        key = (db, name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, db, name, seconds, **labels):
+        key = (db, name, tuple(labels.items()))
+        with self._lock:
+            self._histograms.setdefault(key, Histogram()).add(seconds, 0, 0)
+
+    def get(self, db, name, **labels):
+        return self._counters.get((db, name, tuple(labels.items())), 0)
+
+    def cached(self, db, name, compute, ttl=METRICS_CACHE_TTL):
+        """Value of compute() kept for ttl seconds."""
+        expire, value = self._cached.get((db, name), (0, None))
+        if expire < time.time():
+            value = compute()
+            self._cached[(db, name)] = (time.time() + ttl, value)
+        return value
+
+    def render(self, db, gauges=None, histograms=None):
+        """Prometheus text exposition of the database metrics.
+
+        Args:
+            gauges (dict): Extra gauges: name -> value or [(labels, value)].
+            histograms (dict): Extra histograms: name -> [(labels, Histogram)].
+        """
+        samples = {}
+        with self._lock:
+            for (key_db, name, labels), value in self._counters.items():
+                if key_db == db:
+                    samples.setdefault(name, []).append((labels, value))
+            hists = {}
+            for (key_db, name, labels), hist in self._histograms.items():
+                if key_db == db:
+                    hists.setdefault(name, []).append((labels, hist))
+        for name, value in (gauges or {}).items():
+            samples[name] = value if isinstance(value, list) else [((), value)]
+        for name, items in (histograms or {}).items():
+            hists.setdefault(name, []).extend(items)
+        worker = (('worker', os.getpid()),)
+        lines = []
+        for name in sorted(set(samples) | set(hists)):
+            metric_type, metric_help = METRICS.get(name, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(name, metric_help))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in samples.get(name, []):
+                lines.append('{}{} {}'.format(
+                    name, format_labels(tuple(labels) + worker), value))
+            for labels, hist in hists.get(name, []):
+                labels = tuple(labels) + worker
+                seen = 0
+                for bound, count in zip(LATENCY_BUCKETS, hist.buckets):
+                    seen += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(
+                        labels + (('le', '+Inf' if bound == float('inf')
+                                   else bound),)), seen))
+                lines.append('{}_sum{} {}'.format(
+                    name, format_labels(labels), hist.time_sum))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+#: Metrics of the worker.
+metrics = Metrics()
@@ -0,0 +1,310 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+from datetime import datetime
+from functools import partial
+import hashlib
+import io
+import json
+import logging
+import math
+import random
+import struct
+import tarfile
+import threading
+import time
+import uuid
+import wave
+from odoo import fields, models, api, registry
+
+logger = logging.getLogger(__name__)
+
+#: Hangup causes of generated calls: (cause, cause text, weight).
+CALL_CAUSES = [
+    ('16', 'Normal Clearing', 70),
+    ('17', 'User busy', 15),
+    ('19', 'No answer', 15),
+]
+#: Seconds a not answered call is ringing.
+RING_TIME = 2.0
+#: Asterisk .conf files of the mock servers: (db, server ID) -> {name: bytes}.
+MOCK_CONFIGS = {}
+
+
+def generate_wav(seconds=1.0, rate=8000):
+    """Generate a mono 16 bit WAV file with a 440 Hz tone."""
+    buf = io.BytesIO()
+    wav = wave.open(buf, 'wb')
+    wav.setnchannels(1)
+    wav.setsampwidth(2)
+    wav.setframerate(rate)
+    wav.writeframes(b''.join(
+        struct.pack('<h', int(8000 * math.sin(2 * math.pi * 440 * i / rate)))
+        for i in range(int(seconds * rate))))
+    wav.close()
+    return buf.getvalue()
+
+
+def random_cause():
+    return random.choices(
+        [k[:2] for k in CALL_CAUSES], [k[2] for k in CALL_CAUSES])[0]
+
+
+def generate_call_events(uniqueid, other_uniqueid, channel, other_channel,
+                         calling_number, called_number, cause=('16', 'Normal Clearing'),
+                         talk_time=5.0, recording_path=None,
+                         system_name='asterisk'):
+    """AMI events of a two legs call as Asterisk sends them.
+
+    Returns:
+        A list of (offset in seconds, event) pairs.
+    """
+    def event(name, leg_uniqueid, leg_channel, state='4', state_desc='Ring', **kwargs):
+        data = {
+            'Event': name,
+            'Channel': leg_channel,
+            'ChannelState': state,
+            'ChannelStateDesc': state_desc,
+            'CallerIDNum': calling_number,
+            'CallerIDName': calling_number,
+            'ConnectedLineNum': called_number,
+            'ConnectedLineName': '',
+            'Language': 'en',
+            'AccountCode': '',
+            'Context': 'from-internal',
+            'Exten': called_number,
+            'Priority': '1',
+            'Uniqueid': leg_uniqueid,
+            'Linkedid': uniqueid,
+            'SystemName': system_name,
+        }
+        data.update(kwargs)
+        return data
+
+    cause, cause_txt = cause
+    answered = cause == '16'
+    hangup_at = 1 + (talk_time if answered else RING_TIME)
+    res = [
+        (0, event('Newchannel', uniqueid, channel)),
+        (0.1, event('Newchannel', other_uniqueid, other_channel,
+                    state='0', state_desc='Down')),
+    ]
+    if answered:
+        res.append((1, event('Newstate', other_uniqueid, other_channel,
+                             state='6', state_desc='Up')))
+        res.append((1, event('Newstate', uniqueid, channel,
+                             state='6', state_desc='Up')))
+        if recording_path:
+            res.append((1, event('VarSet', uniqueid, channel,
+                                 Variable='MIXMONITOR_FILENAME',
+                                 Value=recording_path)))
+    for leg_uniqueid, leg_channel in [(other_uniqueid, other_channel),
+                                      (uniqueid, channel)]:
+        res.append((hangup_at, event(
+            'Hangup', leg_uniqueid, leg_channel, state='6' if answered else '5',
+            state_desc='Up' if answered else 'Ringing',
+            Cause=cause, **{'Cause-txt': cause_txt})))
+    return res
+
+
+def get_channel_name(name):
+    """Asterisk channel name of a peer, e.g. SIP/1001-0000001a."""
+    return '{}-{:08x}'.format(name, random.getrandbits(32))
+
+
+class MockAgent(models.AbstractModel):
+    """Local stand-in for the Salt agent and Asterisk used for load testing.
+
+    Enabled by Mock Agent setting or mock_agent context key. Jobs are
+    answered by _mock_<fun> methods and originated calls are played back
+    as AMI events.
+    """
+    _name = 'asterisk_plus.mock_agent'
+    _description = 'Mock Agent'
+
+    @api.model
+    def local_job(self, server, fun, arg=None, kwarg=None, res_model=None,
+                  res_method=None, res_notify_uid=None, pass_back=None,
+                  sync=False, **kwargs):
+        """Same as Server.local_job without Salt API."""
+        method = getattr(self, '_mock_{}'.format(fun.replace('.', '_')), None)
+        arg = self.env['asterisk_plus.salt_job']._resolve_arg(arg)
+        ret = method(server, arg, kwarg or {}) if method else True
+        if sync:
+            return {'return': [{server.server_id: ret}]}
+        jid = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        job = self.env['asterisk_plus.salt_job'].sudo().create({
+            'server': server.id,
+            'fun': fun,
+            'jid': jid,
+            'state': 'sent',
+            'sent_date': fields.Datetime.now(),
+            'res_model': res_model,
+            'res_method': res_method,
+            'res_notify_uid': res_notify_uid,
+            'pass_back': json.dumps(pass_back) if pass_back else False,
+        })
+        job_ret = {
+            'jid': jid,
+            'return': ret,
+            'retcode': 0,
+            'id': server.server_id,
+            'fun': fun,
+            'fun_args': [arg] if arg else [],
+            'success': True,
+        }
+        if self.env.context.get('no_commit'):
+            self.env['asterisk_plus.salt_job'].with_user(
+                server.user).returner(job_ret)
+        else:
+            # The returner is called by the agent when the job is visible.
+            self.env.cr.postcommit.add(partial(
+                self._call_returner, self.env.cr.dbname, server.user.id, job_ret))
+        return job
+
+    @api.model
+    def _call_returner(self, db, uid, job_ret):
+        try:
+            with registry(db).cursor() as cr:
+                env = api.Environment(cr, uid, {})
+                env['asterisk_plus.salt_job'].returner(job_ret)
+        except Exception:
+            logger.exception('Mock agent returner error:')
+
+    ############################ Salt functions ###############################
+
+    def _mock_test_ping(self, server, arg, kwarg):
+        return True
+
+    def _mock_asterisk_get_file(self, server, arg, kwarg):
+        return {'file_data': base64.b64encode(generate_wav()).decode()}
+
+    def _mock_asterisk_delete_file(self, server, arg, kwarg):
+        return True
+
+    def _mock_configs(self, server):
+        return MOCK_CONFIGS.setdefault((self.env.cr.dbname, server.id), {})
+
+    def _mock_asterisk_get_config_hashes(self, server, arg, kwarg):
+        return {name: hashlib.sha256(data).hexdigest()
+                for name, data in self._mock_configs(server).items()}
+
+    def _mock_asterisk_get_config(self, server, arg, kwarg):
+        data = self._mock_configs(server).get(arg[0])
+        if data is None:
+            return 'File {} not found.'.format(arg[0])
+        return {'file_data': base64.b64encode(data).decode()}
+
+    def _mock_asterisk_get_all_configs(self, server, arg, kwarg):
+        return {name: {'file_data': base64.b64encode(data).decode()}
+                for name, data in self._mock_configs(server).items()}
+
+    def _mock_asterisk_get_configs_archive(self, server, arg, kwarg):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name, data in sorted(self._mock_configs(server).items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return {'file_data': base64.b64encode(buf.getvalue()).decode()}
+
+    def _mock_asterisk_put_configs_archive(self, server, arg, kwarg):
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(arg[0]))) as tar:
+            for member in tar.getmembers():
+                self._mock_configs(server)[member.name] = tar.extractfile(
+                    member).read()
+        return True
+
+    def _mock_asterisk_put_config(self, server, arg, kwarg):
+        self._mock_configs(server)[arg[0]] = base64.b64decode(arg[1].strip("'"))
+        return True
+
+    def _mock_asterisk_put_all_configs(self, server, arg, kwarg):
+        for name, data in arg[0].items():
+            self._mock_configs(server)[name] = base64.b64decode(data)
+        return True
+
+    def _mock_asterisk_manager_action(self, server, action, kwarg):
+        if isinstance(action, (list, tuple)):
+            action = action[0]
+        action_id = 'mock/{}'.format(uuid.uuid4().hex)
+        if action.get('Action') == 'Ping':
+            return [{'Response': 'Success', 'ActionID': action_id,
+                     'Ping': 'Pong', 'Timestamp': str(time.time())}]
+        if action.get('Action') == 'Originate':
+            self._originate(server, action)
+            return [{'Response': 'Success', 'ActionID': action_id,
+                     'Message': 'Originate successfully queued'}]
+        return [{'Response': 'Success', 'ActionID': action_id}]
+
+    @api.model
+    def _originate(self, server, action):
+        uniqueid = action.get('ChannelId') or uuid.uuid4().hex
+        events = generate_call_events(
+            uniqueid, action.get('OtherChannelId') or uuid.uuid4().hex,
+            get_channel_name(action['Channel']),
+            get_channel_name('SIP/trunk'),
+            action['Channel'].split('/')[-1], action.get('Exten', ''),
+            cause=random_cause(), talk_time=self.env.context.get(
+                'mock_agent_talk_time', 5.0),
+            recording_path='/var/spool/asterisk/monitor/{}.wav'.format(uniqueid),
+            system_name=server.server_id)
+        if self.env.context.get('no_commit'):
+            self.with_user(server.user)._play_events(events)
+            return
+        play = partial(self._play_call, self.env.cr.dbname, server.user.id,
+                       events, self.env.context.get('mock_agent_timings'),
+                       self.env.context.get('mock_agent_talk_time'))
+        if self.env.context.get('mock_agent_wait'):
+            self.env.cr.postcommit.add(play)
+        else:
+            self.env.cr.postcommit.add(
+                lambda: threading.Thread(target=play, daemon=True).start())
+
+    ############################ Call playback ################################
+
+    @api.model
+    def _play_events(self, events):
+        """Send events to the handlers in this transaction without delays."""
+        for offset, event in events:
+            self.env['asterisk_plus.channel'].on_ami_events([event])
+
+    @api.model
+    def _play_call(self, db, uid, events, timings=None, talk_time=None):
+        """Send call events one by one in their own transactions
+        as the agent does. Jobs sent by the handlers (e.g. recording
+        download) are answered by the mock agent.
+
+        Args:
+            db (str): Database name.
+            uid (int): Server's user ID.
+            events (list): (offset, event) pairs of generate_call_events.
+            timings (dict): Updated with created and finalised seconds, i.e.
+                the time to commit the primary Newchannel and Hangup.
+            talk_time (float): Talk time of calls originated by the handlers.
+        """
+        timings = {} if timings is None else timings
+        context = {'mock_agent': True, 'mock_agent_timings': timings}
+        if talk_time is not None:
+            context['mock_agent_talk_time'] = talk_time
+        started = time.time()
+        for offset, event in events:
+            delay = started + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            event_started = time.time()
+            try:
+                with registry(db).cursor() as cr:
+                    env = api.Environment(cr, uid, context)
+                    env['asterisk_plus.channel'].on_ami_events([event])
+            except Exception:
+                logger.exception('Mock agent event %s error:', event['Event'])
+                timings['error'] = True
+                continue
+            if event['Uniqueid'] == event['Linkedid']:
+                spent = time.time() - event_started
+                if event['Event'] == 'Newchannel':
+                    timings['created'] = spent
+                elif event['Event'] == 'Hangup':
+                    timings['finalised'] = spent
+                    timings['cause'] = event['Cause']
+        return timings
@@ -0,0 +1,116 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import asyncio
+import logging
+import threading
+import time
+from .ami_gateway import format_message, parse_message
+
+logger = logging.getLogger(__name__)
+
+#: Seconds the mock takes to queue an Originate, answered after faster actions.
+ORIGINATE_DELAY = 0.05
+
+
+class MockAmiServer:
+    """Minimal AMI server to test the AMI gateway without Asterisk.
+
+    Every action is answered by its own task, so slow actions (Originate)
+    are answered after the faster ones sent later, like Asterisk does.
+
+    .. code:: python
+
+        server = MockAmiServer('odoo', 'secret')
+        port = server.run_in_thread()
+    """
+
+    def __init__(self, username, secret, channels=None):
+        self.username = username
+        self.secret = secret
+        self.channels = channels or []
+        self.actions = []
+        self.loop = None
+        self._server = None
+        self._writers = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    def run_in_thread(self, host='127.0.0.1', port=0):
+        """Start in a new loop thread. Returns the listening port."""
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='mock_ami',
+                         daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(
+            self.start(host, port), self.loop).result(5)
+
+    def drop_connections(self):
+        """Close client connections to test reconnects."""
+        for writer in list(self._writers):
+            self.loop.call_soon_threadsafe(writer.close)
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        writer.write(b'Asterisk Call Manager/5.0.1\r\n')
+        logged_in = False
+        try:
+            while True:
+                action = parse_message(await reader.readuntil(b'\r\n\r\n'))
+                self.actions.append(action)
+                if action.get('Action', '').lower() == 'login':
+                    logged_in = action.get('Username') == self.username and \
+                        action.get('Secret') == self.secret
+                    self._reply(writer, action, [{
+                        'Response': 'Success' if logged_in else 'Error',
+                        'Message': 'Authentication accepted' if logged_in
+                        else 'Authentication failed'}])
+                elif not logged_in:
+                    self._reply(writer, action, [{
+                        'Response': 'Error',
+                        'Message': 'Permission denied'}])
+                else:
+                    asyncio.ensure_future(self._action(writer, action))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _action(self, writer, action):
+        name = action.get('Action', '').lower()
+        if name == 'ping':
+            messages = [{'Response': 'Success', 'Ping': 'Pong',
+                         'Timestamp': '{:.6f}'.format(time.time())}]
+        elif name == 'reload':
+            messages = [{'Response': 'Success',
+                         'Message': 'Module Reloaded'}]
+        elif name == 'originate':
+            await asyncio.sleep(ORIGINATE_DELAY)
+            messages = [{'Response': 'Success',
+                         'Message': 'Originate successfully queued'}]
+        elif name == 'coreshowchannels':
+            messages = [{'Response': 'Success', 'EventList': 'start',
+                         'Message': 'Channels will follow'}]
+            for channel in self.channels:
+                messages.append(dict(channel, Event='CoreShowChannel'))
+            messages.append({'Event': 'CoreShowChannelsComplete',
+                             'EventList': 'Complete',
+                             'ListItems': str(len(self.channels))})
+        else:
+            messages = [{'Response': 'Error',
+                         'Message': 'Invalid/unknown command'}]
+        self._reply(writer, action, messages)
+
+    def _reply(self, writer, action, messages):
+        for message in messages:
+            if 'ActionID' in action:
+                message['ActionID'] = action['ActionID']
+            writer.write(format_message(message))
@@ -5,7 +5,8 @@ import time
 import wave
 import logging
 from odoo import models, fields, api, _
-from .server import debug
+from .tracing import trace
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -99,23 +100,23 @@ class Recording(models.Model):
         uniqueid = event.get('Uniqueid')
         # This is called a few seconds after call Hangup, so filter calls
         # by time first.
-        recently = datetime.utcnow() - timedelta(seconds=60)        
-        found = self.env['asterisk_plus.channel'].search(
-            [('create_date', '>=', recently.strftime('%Y-%m-%d %H:%M:%S')),
-             ('uniqueid', '=', uniqueid)], limit=1)
+        recently = datetime.utcnow() - timedelta(seconds=60)
+        found = self.env['asterisk_plus.channel']._find_channel(uniqueid)
+        if found and found.create_date < recently:
+            found = self.env['asterisk_plus.channel']
         if not found:
-            debug(self, 'Recording was not activated for '
-                        'channel {}'.format(found.channel))
+            trace(self, 'recording', 'Recording was not activated for '
+                  'channel %s', uniqueid)
             return False
         if not found.recording_file_path:
-            debug(self, 'File path not specified for channel {}'.format(found.channel))
+            trace(self, 'recording', 'File path not specified for channel %s', found.channel)
             return False
         if found.cause != '16':
-            debug(self, 
-                'Call Recording was activated but call was not answered'
-                ' on {}'.format(found.channel))
+            trace(self, 'recording',
+                  'Call Recording was activated but call was not answered'
+                  ' on %s', found.channel)
             return False
-        debug(self, 'Save call recording for channel {}.'.format(found.channel))
+        trace(self, 'recording', 'Save call recording for channel %s.', found.channel)
         # Transfer the file.
         found.server.local_job(
             fun='asterisk.get_file',
@@ -134,9 +135,16 @@ class Recording(models.Model):
             msg = data['error'].get('message', data['error'])
             logger.error('Call recording data error: %s', msg)
             return False
+        if input_data:
+            # Decoded size of base64 data.
+            padding = input_data[-2:].count(
+                '=' if isinstance(input_data, str) else b'=')
+            metrics.inc(self.env.cr.dbname,
+                        'asterisk_plus_recording_upload_bytes_total',
+                        len(input_data) * 3 // 4 - padding)
         channel = self.env['asterisk_plus.channel'].browse(channel_id)
-        debug(self, 'Call recording upload for channel {}'.format(
-            channel.channel))
+        trace(self, 'recording', 'Call recording upload for channel %s',
+              channel.channel)
         mp3_encode = self.env['asterisk_plus.settings'].get_param(
             'use_mp3_encoder')
         transcipt_recording = self.env['asterisk_plus.settings'].get_param(
@@ -144,8 +152,8 @@ class Recording(models.Model):
         # Transcript
         transcript = None
         if SR and transcipt_recording:
-            debug(self, 'Transcript call recording for channel {}'.format(
-                channel.channel))
+            trace(self, 'recording', 'Transcript call recording for channel %s',
+                  channel.channel)
             key = self.env['asterisk_plus.settings'].get_param(
                 'google_sr_api_key') or None
             lang = self.env['asterisk_plus.settings'].get_param(
@@ -200,7 +208,7 @@ class Recording(models.Model):
         })
         # Delete recording from the Asterisk server
         if self.env['asterisk_plus.settings'].get_param('delete_recordings'):
-            debug(self, 'DELETE RECORDING {}'.format(rec.file_path))
+            trace(self, 'recording', 'DELETE RECORDING %s', rec.file_path)
             channel.server.local_job(
                 fun='asterisk.delete_file',
                 arg=rec.file_path)
@@ -215,10 +223,10 @@ class Recording(models.Model):
         sample_rate = wav_data.getframerate()
         num_frames = wav_data.getnframes()
         pcm_data = wav_data.readframes(num_frames)
-        debug(self,
+        trace(self, 'recording',
               'Encoding Wave file. Number of channels: '
-              '{}. Sample rate: {}, Number of frames: {}'.format(
-                num_channels, sample_rate, num_frames))
+              '%s. Sample rate: %s, Number of frames: %s',
+              num_channels, sample_rate, num_frames)
         wav_data.close()
 
         encoder = lameenc.Encoder()
@@ -230,6 +238,9 @@ class Recording(models.Model):
         mp3_data += encoder.flush()
         logger.info('Recording convert .wav -> .mp3 took %.2f seconds.',
                     time.time() - started)
+        metrics.observe(self.env.cr.dbname,
+                        'asterisk_plus_recording_encode_seconds',
+                        time.time() - started)
         return mp3_data
 
     @api.model
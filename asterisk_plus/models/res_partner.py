@@ -4,7 +4,8 @@ import re
 import phonenumbers
 from phonenumbers import phonenumberutil
 from odoo import models, fields, api, tools, _
-from .settings import debug
+from .tracing import trace
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -117,11 +118,11 @@ class Partner(models.Model):
             '|',
             ('phone_normalized', '=', number),
             ('mobile_normalized', '=', number)])
-        debug(self, 'SEARCH_PARTNER_BY_NUMBER {} FOUND: {}'.format(number, found))
+        trace(self, 'partner', 'SEARCH_PARTNER_BY_NUMBER %s FOUND: %s', number, found)
         parents = found.mapped('parent_id')
         # 1-st case: just one partner, perfect!
         if len(found) == 1:
-            debug(self, 'FOUND PARTNER {} BY NUMBER {}'.format(found.name, number))
+            trace(self, 'partner', 'FOUND PARTNER %s BY NUMBER %s', found.name, number)
             return found[0]
         # 2-nd case: Many partners, no parent company / many companies
         elif len(parents) == 0 and len(found) > 1:
@@ -136,17 +137,17 @@ class Partner(models.Model):
         elif len(parents) == 1 and len(found) == 2 and len(
                 found.filtered(
                     lambda r: r.parent_id.id in [k.id for k in parents])) == 1:
-            debug(self, 'ONE PARTNER FROM ONE PARENT FOUND')
+            trace(self, 'partner', 'ONE PARTNER FROM ONE PARENT FOUND')
             return found.filtered(
                 lambda r: r.parent_id.id in [k.id for k in parents])[0]
         # 5-rd case: many partners same parent company
         elif len(parents) == 1 and len(found) > 1 and len(found.filtered(
                 lambda r: r.parent_id.id in [k.id for k in parents])) > 1:
-            debug(self, 'MANY PARTNERS SAME PARENT COMPANY {}'.format(number))
+            trace(self, 'partner', 'MANY PARTNERS SAME PARENT COMPANY %s', number)
             return parents[0]
         # 6-rd case: Nothing found
         else:
-            debug(self, 'NO PARTNERS FOUND FOR NUMBER {}'.format(number))
+            trace(self, 'partner', 'NO PARTNERS FOUND FOR NUMBER %s', number)
 
     def search_by_caller_number(self, number):
         # Called from AMI events.fields.
@@ -155,15 +156,15 @@ class Partner(models.Model):
         try:
             phone_nbr = phonenumbers.parse(number, country_code)
             if not phonenumbers.is_possible_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT POSSIBLE'.format(number))
+                trace(self, 'partner', 'PHONE NUMBER %s NOT POSSIBLE', number)
             elif not phonenumbers.is_valid_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT VALID'.format(number))
+                trace(self, 'partner', 'PHONE NUMBER %s NOT VALID', number)
             # We have a parsed number, let check what format to return.
             number = phonenumbers.format_number(
                 phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-            debug(self, 'E164 FORMATTED NUMBER: {}'.format(number))
+            trace(self, 'partner', 'E164 FORMATTED NUMBER: %s', number)
         except phonenumberutil.NumberParseException:
-            debug(self, 'PHONE NUMBER {} PARSE ERROR'.format(number))
+            trace(self, 'partner', 'PHONE NUMBER %s PARSE ERROR', number)
         except Exception:
             logger.exception('FORMAT NUMBER ERROR:')
         finally:            
@@ -187,28 +188,28 @@ class Partner(models.Model):
     @api.model
     def _format_number(self, number, country_code=None,
                        format_type='e164'):
-        debug(self, 'FORMAT_NUMBER {} COUNTRY {} FORMAT {}'.format(number, country_code, format_type))
+        trace(self, 'partner', 'FORMAT_NUMBER %s COUNTRY %s FORMAT %s', number, country_code, format_type)
         # Strip formatting if present
         number = strip_number(number)
         if len(self) == 1 and not country_code:
             # Called from partner object
             country_code = self._get_country_code()
-            debug(self, 'GOT COUNTRY FOR PARTNER {} CODE {}'.format(self, country_code))
+            trace(self, 'partner', 'GOT COUNTRY FOR PARTNER %s CODE %s', self, country_code)
         elif not country_code:
             # Get country code for requesting account
             country_code = self.env.user.partner_id._get_country_code()
-            debug(self, 'GOT COUNTRY CODE {} FROM ENV USER'.format(country_code))
+            trace(self, 'partner', 'GOT COUNTRY CODE %s FROM ENV USER', country_code)
         elif not country_code:
-            debug(self, 'COULD NOT GET COUNTRY CODE')
+            trace(self, 'partner', 'COULD NOT GET COUNTRY CODE')
         if country_code is False:
             # False -> None
             country_code = None
         try:
             phone_nbr = phonenumbers.parse(number, country_code)
             if not phonenumbers.is_possible_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT POSSIBLE'.format(number))
+                trace(self, 'partner', 'PHONE NUMBER %s NOT POSSIBLE', number)
             elif not phonenumbers.is_valid_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT VALID'.format(number))
+                trace(self, 'partner', 'PHONE NUMBER %s NOT VALID', number)
             # We have a parsed number, let check what format to return.
             elif format_type == 'out_of_country':
                 # For out of country format we must get the Asterisk
@@ -216,19 +217,19 @@ class Partner(models.Model):
                 country_code = self.env.user.partner_id._get_country_code()
                 number = phonenumbers.format_out_of_country_calling_number(
                     phone_nbr, country_code)
-                debug(self, 'OUT OF COUNTRY FORMATTED NUMBER: {}'.format(number))
+                trace(self, 'partner', 'OUT OF COUNTRY FORMATTED NUMBER: %s', number)
             elif format_type == 'e164':
                 number = phonenumbers.format_number(
                     phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-                debug(self, 'E164 FORMATTED NUMBER: {}'.format(number))
+                trace(self, 'partner', 'E164 FORMATTED NUMBER: %s', number)
             elif format_type == 'international':
                 number = phonenumbers.format_number(
                     phone_nbr, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
-                debug(self, 'INTERN FORMATTED NUMBER: {}'.format(number))
+                trace(self, 'partner', 'INTERN FORMATTED NUMBER: %s', number)
             else:
                 logger.error('WRONG FORMATTING PASSED: %s', format_type)
         except phonenumberutil.NumberParseException:
-            debug(self, 'PHONE NUMBER {} PARSE ERROR'.format(number))
+            trace(self, 'partner', 'PHONE NUMBER %s PARSE ERROR', number)
         except Exception:
             logger.exception('FORMAT NUMBER ERROR:')
         finally:
@@ -239,12 +240,15 @@ class Partner(models.Model):
     def get_partner_by_number(self, number, country_code=None):
         # Default values
         partner_info = {'name': _('Unknown'), 'id': False}
-        debug(self, 'GET_PARTNER_BY_NUMBER {} COUNTRY {}'.format(number, country_code))
+        # Only called on cache miss.
+        metrics.inc(self.env.cr.dbname,
+                    'asterisk_plus_caller_lookup_misses_total')
+        trace(self, 'partner', 'GET_PARTNER_BY_NUMBER %s COUNTRY %s', number, country_code)
         if not number:
-            debug(self, 'NO NUMBER PASSED')
+            trace(self, 'partner', 'NO NUMBER PASSED')
             return partner_info
         if 'unknown' in number or number == 's':
-            debug(self, '<UNKNOWN>/s NUMBER PASSED')
+            trace(self, 'partner', '<UNKNOWN>/s NUMBER PASSED')
             return partner_info
         partner = None
         # 1. Convert to E.164 and make a search
@@ -267,9 +271,9 @@ class Partner(models.Model):
             else:
                 partner_info['name'] = partner.name
                 # On Odoo 10 we have to use unicode formatting!
-                debug(self, u'FOUND PARTNER {}'.format(partner_info['name']))
+                trace(self, 'partner', 'FOUND PARTNER %s', partner_info['name'])
         else:
-            debug(self, 'NO PARTNER FOUND')
+            trace(self, 'partner', 'NO PARTNER FOUND')
         return partner_info
 
     def _get_call_count(self):
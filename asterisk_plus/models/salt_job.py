@@ -1,24 +1,424 @@
+from datetime import datetime, timedelta
 import json
 import logging
-from odoo import fields, models, api
-from .settings import debug
+import threading
+from odoo import fields, models, api, registry, SUPERUSER_ID, _
+from odoo.exceptions import AccessError, ValidationError
+from .handler_stats import measure
+from .metrics import metrics
+from .saltapi import SaltApiUnavailable
+from .tracing import trace
 
 logger = logging.getLogger(__name__)
 
+#: Advisory lock namespace serializing dispatch and return of a job ID.
+SALT_JOB_LOCK_KEY = 5062
+#: Seconds a queued job waits for its dispatch thread before the cron sends it.
+OUTBOX_SWEEP_AGE = 30
+#: Hours a return without a job is kept.
+PARKED_RETURN_HOURS = 1
+#: Max jobs sent in one Salt API request.
+OUTBOX_BATCH_SIZE = 50
+#: Max size of a return kept in the job.
+RET_MAX_SIZE = 4096
+#: Result passed to callbacks of jobs that never returned.
+TIMEOUT_RESULT = 'Salt job timeout'
+#: Key of a positional argument read from the ir.attachment ID at dispatch
+#: time as base64, keeps large arguments out of the job.
+ATTACHMENT_ARG = '__attachment__'
+#: Jobs deleted in one transaction by vacuum.
+VACUUM_CHUNK_SIZE = 1000
+
+
+def dispatch_outbox(db, ids=None):
+    """Send queued jobs in a new transaction."""
+    try:
+        with registry(db).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['asterisk_plus.salt_job'].dispatch_outbox(ids)
+    except Exception:
+        logger.exception('Salt job dispatch error:')
+
 
 class SaltJob(models.Model):
     _name = 'asterisk_plus.salt_job'
     _description = 'Salt job'
 
+    server = fields.Many2one('asterisk_plus.server', ondelete='cascade')
+    #: Fan-out job targeting the servers of its children.
+    parent = fields.Many2one('asterisk_plus.salt_job', ondelete='cascade')
+    children = fields.One2many('asterisk_plus.salt_job', inverse_name='parent',
+                               string='Servers')
+    minion_count = fields.Integer(compute='_get_minion_stats', string='Servers')
+    returned_count = fields.Integer(compute='_get_minion_stats', string='Returned')
+    failed_count = fields.Integer(compute='_get_minion_stats', string='Failed')
     fun = fields.Char()
-    jid = fields.Char(required=True)
+    arg = fields.Text()
+    kwarg = fields.Text()
+    timeout = fields.Integer()
+    jid = fields.Char(index=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('returned', 'Returned'),
+        ('parked', 'Parked Return'),
+        ('failed', 'Failed'),
+        ('timeout', 'Timed Out')], default='sent', index=True)
+    error = fields.Text()
+    sent_date = fields.Datetime(string='Sent')
+    returned_date = fields.Datetime(string='Returned')
+    duration = fields.Float(group_operator='avg', help='Seconds from send to return.')
     ret = fields.Text()
     full_ret = fields.Text()
     success = fields.Char()
     res_model = fields.Char()
     res_method = fields.Char()
+    #: res_method handles TIMEOUT_RESULT, other callbacks are not called on
+    #: timeout.
+    res_on_timeout = fields.Boolean()
     pass_back = fields.Text()
     res_notify_uid = fields.Integer()
+    #: User receiving the full result over the bus, see Server.submit_job.
+    res_push_uid = fields.Integer()
+
+    @api.depends('children.state', 'children.success')
+    def _get_minion_stats(self):
+        for rec in self:
+            rec.minion_count = len(rec.children)
+            rec.returned_count = len(rec.children.filtered(
+                lambda r: r.state == 'returned'))
+            rec.failed_count = len(rec.children.filtered(
+                lambda r: r.state == 'failed' or r.success == 'False'))
+
+    def _dispatch_after_commit(self):
+        """Send the queued jobs when the current transaction is committed.
+        One dispatch thread is started per transaction.
+        """
+        cr, db = self.env.cr, self.env.cr.dbname
+        ids = cr.postcommit.data.setdefault('asterisk_plus.salt_job.outbox', [])
+        if not ids:
+            cr.postcommit.add(lambda: threading.Thread(
+                target=dispatch_outbox, args=(db, list(ids)),
+                daemon=True).start())
+        ids.extend(self.ids)
+
+    @api.model
+    def dispatch_outbox(self, ids=None):
+        """Send queued jobs to Salt API in batches of lowstate chunks, one
+        request per batch. Every batch is committed as soon as its job IDs
+        are known so that the returner can find them.
+
+        Args:
+            ids (list): Jobs to send. All queued jobs if not set.
+        """
+        no_commit = self.env.context.get('no_commit')
+        while True:
+            self.env.cr.execute("""
+                SELECT id FROM asterisk_plus_salt_job
+                WHERE state = 'queued' AND parent IS NULL {}
+                    AND (server IS NULL OR server NOT IN (
+                        SELECT id FROM asterisk_plus_server
+                        WHERE health = 'down'))
+                ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""".format(
+                    'AND id IN %s' if ids else ''),
+                ((tuple(ids),) if ids else ()) + (OUTBOX_BATCH_SIZE,))
+            jobs = self.browse([k[0] for k in self.env.cr.fetchall()])
+            if not jobs:
+                break
+            if not jobs._dispatch():
+                # Salt API is down, the jobs wait for the sweeper.
+                break
+            jids = sorted(set(jobs.filtered('jid').mapped('jid')))
+            if not no_commit:
+                self.env.cr.commit()
+            if jids:
+                # Returns parked while the Salt API call was in flight are
+                # visible in the new transaction only.
+                self._claim_parked_returns(jids)
+                if not no_commit:
+                    self.env.cr.commit()
+        return True
+
+    def _get_lowstate(self):
+        self.ensure_one()
+        low = {
+            'client': 'local_async',
+            'tgt': self.server.server_id,
+            'fun': self.fun,
+            'ret': 'odoo',
+        }
+        if self.children:
+            low['tgt'] = self.children.mapped('server.server_id')
+            low['tgt_type'] = 'list'
+        if self.arg:
+            low['arg'] = self._resolve_arg(json.loads(self.arg))
+        if self.kwarg:
+            low['kwarg'] = json.loads(self.kwarg)
+        if self.timeout:
+            low['timeout'] = self.timeout
+        return low
+
+    @api.model
+    def _resolve_arg(self, arg):
+        """Positional arguments with the ATTACHMENT_ARG references replaced
+        by the base64 data of the attachments.
+        """
+        if not isinstance(arg, list):
+            return arg
+        attachments = self.env['ir.attachment'].sudo().with_context(
+            bin_size=False)
+        return [attachments.browse(k[ATTACHMENT_ARG]).datas.decode()
+                if isinstance(k, dict) and ATTACHMENT_ARG in k else k
+                for k in arg]
+
+    def _dispatch(self):
+        """Send the jobs in one Salt API request and register their job IDs."""
+        lowstate = [job._get_lowstate() for job in self]
+        try:
+            with self.env.cr.savepoint():
+                ret = self.env['asterisk_plus.server']._call_saltapi(
+                    'low', lowstate=lowstate)
+                trace(self, 'salt', lambda: json.dumps(ret, indent=2))
+                returns = ret['return']
+        except SaltApiUnavailable as e:
+            logger.warning('Salt jobs are not sent: %s', e)
+            return False
+        except Exception as e:
+            logger.exception('Salt jobs dispatch error:')
+            self._set_failed(str(e))
+            return True
+        sent = {}
+        for pos, job in enumerate(self):
+            job_ret = returns[pos] if pos < len(returns) else None
+            if not isinstance(job_ret, dict) or not job_ret.get('jid'):
+                job._set_failed('No job ID was returned. Check Minion ID!')
+                continue
+            # Servers not matched by Salt will never return.
+            targets = job.children or job
+            lost = targets.filtered(
+                lambda r: 'minions' in job_ret and
+                r.server.server_id not in job_ret['minions'])
+            lost.mapped('server')._set_health('down', 'Minion is not connected.')
+            if lost == targets:
+                job._set_failed('Minions are not connected.')
+                continue
+            lost.write({'state': 'failed', 'error': 'Minion is not connected.'})
+            sent[job.id] = job_ret['jid']
+        if not sent:
+            return True
+        # A return that came before this commit waits parked, it is claimed
+        # after the commit, see dispatch_outbox.
+        self._lock_jids(sorted(set(sent.values())))
+        self.flush()
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_salt_job j
+            SET jid = v.jid, state = 'sent', sent_date = now() at time zone 'UTC'
+            FROM unnest(%s, %s) AS v(id, jid)
+            WHERE j.id = v.id""", (list(sent), list(sent.values())))
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_salt_job c
+            SET jid = p.jid, state = 'sent', sent_date = p.sent_date
+            FROM asterisk_plus_salt_job p
+            WHERE c.parent = p.id AND c.state = 'queued' AND p.id IN %s""",
+            (tuple(sent),))
+        self.invalidate_cache(['jid', 'state', 'sent_date'])
+        return True
+
+    def _set_failed(self, error):
+        (self | self.mapped('children')).write(
+            {'state': 'failed', 'error': error})
+        for job in self.filtered('res_push_uid'):
+            job._push_result(job, error)
+        for job in self.filtered('res_notify_uid'):
+            self.env['res.users'].asterisk_plus_notify(
+                '{}: {}'.format(job.fun, error), uid=job.res_notify_uid,
+                warning=True)
+
+    @api.model
+    def _lock_jid(self, jid):
+        self.env.cr.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))',
+                            (SALT_JOB_LOCK_KEY, jid))
+
+    @api.model
+    def _lock_jids(self, jids):
+        """Lock job IDs in one query, jids must be sorted."""
+        self.env.cr.execute("""
+            SELECT pg_advisory_xact_lock(%s, hashtext(jid))
+            FROM unnest(%s::text[]) AS jid""", (SALT_JOB_LOCK_KEY, jids))
+
+    @api.model
+    def _claim_parked_returns(self, jids=None):
+        """Process returns parked before their job was committed.
+
+        Cursors run in REPEATABLE READ: call it first in a transaction
+        started after the jobs are committed, so that the query sees both
+        the jobs and the returns parked meanwhile.
+
+        Returns:
+            Number of claimed returns.
+        """
+        self.env.cr.execute("""
+            SELECT p.id, p.full_ret, p.create_uid
+            FROM asterisk_plus_salt_job p
+            WHERE p.state = 'parked' {} AND EXISTS (
+                SELECT 1 FROM asterisk_plus_salt_job j
+                WHERE j.jid = p.jid AND j.state = 'sent'
+                    AND j.parent IS NULL)
+            ORDER BY p.id FOR UPDATE SKIP LOCKED""".format(
+                'AND p.jid IN %s' if jids else ''),
+            (tuple(jids),) if jids else ())
+        claimed = 0
+        for parked_id, full_ret, uid in self.env.cr.fetchall():
+            job_ret = json.loads(full_ret)
+            try:
+                # Kept parked for the next sweep when its return fails.
+                with self.env.cr.savepoint():
+                    self.env.cr.execute(
+                        'DELETE FROM asterisk_plus_salt_job WHERE id = %s',
+                        (parked_id,))
+                    # Callbacks run as the server account that sent it.
+                    self.with_user(uid or SUPERUSER_ID).returner(job_ret)
+                claimed += 1
+            except Exception:
+                logger.exception('Salt job %s return error:', job_ret['jid'])
+        if claimed:
+            self.invalidate_cache()
+        return claimed
+
+    @api.model
+    def sweep_outbox(self):
+        """Cron job sending queued jobs lost by their dispatch thread,
+        claiming parked returns of sent jobs and removing returns never
+        claimed by a job.
+        """
+        if not self.env.context.get('no_commit'):
+            # Start a new snapshot that sees the recently parked returns.
+            self.env.cr.commit()
+        claimed = self._claim_parked_returns()
+        if claimed:
+            logger.info('Claimed %s parked Salt returns.', claimed)
+        self.env.cr.execute("""
+            SELECT id FROM asterisk_plus_salt_job
+            WHERE state = 'queued' AND parent IS NULL AND create_date < %s""",
+            (datetime.utcnow() - timedelta(seconds=OUTBOX_SWEEP_AGE),))
+        ids = [k[0] for k in self.env.cr.fetchall()]
+        if ids:
+            logger.info('Sending %s queued Salt jobs.', len(ids))
+            self.dispatch_outbox(ids)
+        expired = self.search([
+            ('state', '=', 'parked'),
+            ('create_date', '<', datetime.utcnow() - timedelta(
+                hours=PARKED_RETURN_HOURS))])
+        for rec in expired:
+            logger.error('NO JOB FOUND FOR JID: %s', rec.jid)
+        expired.unlink()
+        return True
+
+    @api.model
+    def expire_jobs(self, seconds=300):
+        """Cron job to time out jobs without a return. Callbacks of the
+        servers that did not return get TIMEOUT_RESULT when res_on_timeout
+        is set. Jobs sent before sent_date existed expire from create_date.
+
+        Args:
+            seconds (int): Time to wait for a return after the job timeout.
+        """
+        self.env.cr.execute("""
+            SELECT id FROM asterisk_plus_salt_job
+            WHERE state = 'sent' AND parent IS NULL
+                AND COALESCE(sent_date, create_date) + make_interval(
+                    secs => %s + COALESCE(timeout, 0))
+                    < now() at time zone 'UTC'
+            ORDER BY id""", (seconds,))
+        jobs = self.browse([k[0] for k in self.env.cr.fetchall()])
+        for job in jobs:
+            # Do not race with a returner of the job.
+            self._lock_jid(job.jid)
+            job.invalidate_cache()
+            job.children.invalidate_cache()
+            pending = (job | job.children).filtered(lambda r: r.state == 'sent')
+            if not pending:
+                continue
+            logger.warning('Salt job %s %s timed out.', job.jid, job.fun)
+            now = fields.Datetime.now()
+            pending.write({'state': 'timeout', 'error': TIMEOUT_RESULT,
+                           'returned_date': now})
+            if job.children:
+                job.write({'state': 'timeout', 'success': 'False'})
+            for rec in pending.filtered('server'):
+                if job.res_notify_uid:
+                    self.env['res.users'].asterisk_plus_notify(
+                        '{} {}: TIMEOUT'.format(rec.server.name, job.fun),
+                        uid=job.res_notify_uid, warning=True)
+                if job.res_push_uid:
+                    job._push_result(rec, TIMEOUT_RESULT)
+                if not job.res_on_timeout:
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        job._run_callback(TIMEOUT_RESULT, self.env(
+                            user=rec.server.user.id, su=False))
+                except Exception:
+                    logger.exception('Salt job %s timeout callback error:',
+                                     job.jid)
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+        return True
+
+    @api.model
+    def vacuum(self, days):
+        """Cron job to delete completed jobs older than days in chunks.
+        """
+        expire_date = datetime.utcnow() - timedelta(days=days)
+        deleted = 0
+        while True:
+            # Server jobs of fan-out jobs are deleted by cascade.
+            self.env.cr.execute("""
+                DELETE FROM asterisk_plus_salt_job WHERE id IN (
+                    SELECT id FROM asterisk_plus_salt_job
+                    WHERE parent IS NULL
+                        AND state IN ('returned', 'failed', 'timeout')
+                        AND create_date < %s
+                    LIMIT %s)""", (expire_date, VACUUM_CHUNK_SIZE))
+            count = self.env.cr.rowcount
+            deleted += count
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if count < VACUUM_CHUNK_SIZE:
+                break
+        self.invalidate_cache()
+        if deleted:
+            logger.info('Deleted %s Salt jobs.', deleted)
+        return deleted
+
+    @api.model
+    def get_latency_stats(self, hours=24):
+        """Job latency in seconds by function for the last hours."""
+        self.env.cr.execute("""
+            SELECT fun, COUNT(*),
+                AVG(duration),
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY duration),
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY duration),
+                MAX(duration),
+                COUNT(*) FILTER (WHERE state = 'failed'),
+                COUNT(*) FILTER (WHERE state = 'timeout')
+            FROM asterisk_plus_salt_job
+            WHERE parent IS NULL AND state != 'parked' AND create_date > %s
+            GROUP BY fun ORDER BY fun""",
+            (datetime.utcnow() - timedelta(hours=hours),))
+        res = {}
+        for fun, count, avg, p50, p95, max_, failed, timeout in \
+                self.env.cr.fetchall():
+            res[fun] = {
+                'count': count,
+                'avg_sec': round(avg or 0, 3),
+                'p50_sec': round(p50 or 0, 3),
+                'p95_sec': round(p95 or 0, 3),
+                'max_sec': round(max_ or 0, 3),
+                'failed': failed,
+                'timeout': timeout,
+            }
+        return res
 
     @api.model
     def returner(self, ret):
@@ -32,27 +432,161 @@ class SaltJob(models.Model):
             'fun_args': [],
             'success': True}
         """
-        ret_txt = json.dumps(ret, indent=2)
-        # Debug only first 1kb of return.
-        debug(self, ret_txt[:1024])
-        job = self.sudo().search([('jid', '=', ret['jid'])])
+        # Trace only first 1kb of return.
+        trace(self, 'salt', lambda: json.dumps(ret, indent=2)[:1024])
+        # Wait for the dispatcher writing this job ID.
+        self._lock_jid(ret['jid'])
+        return self._process_return(ret, self._get_jobs([ret['jid']]).get(ret['jid']))
+
+    @api.model
+    def returner_bulk(self, rets):
+        """Called by Salt returner with a list of returns, see returner.
+        All jobs are found with one query, callbacks are called grouped by
+        res_model / res_method and a failing return does not affect others.
+
+        Returns:
+            A list of {'jid': jid, 'result': callback result} or
+            {'jid': jid, 'error': error message} in the order of rets.
+        """
+        trace(self, 'salt', 'BULK RETURN OF %s JOBS', len(rets))
+        jids = sorted({ret['jid'] for ret in rets})
+        self._lock_jids(jids)
+        jobs = self._get_jobs(jids)
+
+        def callback_key(item):
+            job = jobs.get(item[1]['jid'])
+            return (job.res_model or '', job.res_method or '') if job else ('', '')
+
+        results = [None] * len(rets)
+        for pos, ret in sorted(enumerate(rets), key=callback_key):
+            try:
+                with self.env.cr.savepoint():
+                    results[pos] = {
+                        'jid': ret['jid'],
+                        'result': self._process_return(ret, jobs.get(ret['jid']))}
+            except Exception as e:
+                logger.exception('Salt job %s return error:', ret['jid'])
+                results[pos] = {'jid': ret['jid'], 'error': str(e)}
+        return results
+
+    @api.model
+    def _get_jobs(self, jids):
+        """Jobs by job ID."""
+        return {job.jid: job for job in self.sudo().search([
+            ('jid', 'in', jids), ('state', '!=', 'parked'),
+            ('parent', '=', False)])}
+
+    @api.model
+    def _process_return(self, ret, job):
+        """Complete the job with its return and call its callback."""
         if not job:
-            logger.error('NO JOB FOUND FOR JID: %s', ret['jid'])
+            # The job is not committed yet, the dispatcher will process it.
+            logger.info('Parking return of job %s.', ret['jid'])
+            self.sudo().create({
+                'jid': ret['jid'],
+                'fun': ret.get('fun'),
+                'state': 'parked',
+                'full_ret': json.dumps(ret),
+            })
+            return False
+        now = fields.Datetime.now()
+        target = job
+        fun = ret.get('fun')
+        if job.children:
+            # Fan-out job: every server returns separately.
+            target = job.children.filtered(
+                lambda r: r.server.server_id == ret.get('id'))
+            fun = '{} {}'.format(target.server.name or ret.get('id'), fun)
+        if target.filtered(lambda r: r.state == 'timeout'):
+            logger.warning('Late return of timed out job %s from %s.',
+                           ret['jid'], ret.get('id'))
             return False
+        if target.server and target.server.health != 'ok':
+            # The minion is alive.
+            target.server._set_health('ok')
+        sent_date = job[0].sent_date or job[0].create_date
+        metrics.observe(self.env.cr.dbname,
+                        'asterisk_plus_salt_job_roundtrip_seconds',
+                        (now - sent_date).total_seconds(),
+                        fun=ret.get('fun'))
+        target.write({
+            'state': 'returned',
+            'success': str(ret.get('success')),
+            'returned_date': now,
+            'duration': (now - sent_date).total_seconds(),
+            'ret': json.dumps(ret.get('return'))[:RET_MAX_SIZE],
+        })
+        if job.res_push_uid:
+            target.full_ret = json.dumps(ret.get('return'))
+        if job.children and all(
+                k.state != 'sent' for k in job.children):
+            job.write({
+                'state': 'returned',
+                'success': str(all(k.success == 'True' for k in job.children)),
+                'returned_date': now,
+                'duration': (now - sent_date).total_seconds(),
+            })
+        if job.res_push_uid:
+            job._push_result(target, ret.get('return'))
         # Check if return shoud be sent in notification box.
         if job.res_notify_uid:
             if ret['success']:
                 self.env['res.users'].asterisk_plus_notify(
-                    '{}: OK'.format(ret['fun']), uid=job.res_notify_uid)
+                    '{}: OK'.format(fun), uid=job.res_notify_uid)
             else:
                 self.env.user.asterisk_plus_notify(
-                    '{}: FAIL'.format(ret['fun']), uid=job.res_notify_uid, warning=True)
-
-        # Check if return is sent to callback method.
-        if job.res_model and job.res_method:
-            method = getattr(self.env[job.res_model], job.res_method)
-            res = method(ret['return'], json.loads(job.pass_back) if job.pass_back else None)
-            # JSON-RPC requires a result to be returned.
-            return res if res else False
-        # If no res model / method is specified.
-        return False
+                    '{}: FAIL'.format(fun), uid=job.res_notify_uid, warning=True)
+        return job._run_callback(ret['return'], self.env)
+
+    def _push_result(self, target, result):
+        """Send the return of the target job to the requesting user."""
+        self.env['bus.bus'].sendone(
+            'asterisk_plus_actions_{}'.format(self.res_push_uid), {
+                'action': 'salt_result',
+                'job': self.id,
+                'fun': self.fun,
+                'server': target.server.server_id,
+                'state': target.state,
+                'success': target.success == 'True',
+                'done': self.state not in ('queued', 'sent'),
+                'result': result,
+            })
+
+    @api.model
+    def get_result(self, job_id):
+        """Short-poll the result of a job returned by Server.submit_job.
+
+        Returns:
+            Job state and result, by minion ID for fan-out jobs, e.g.:
+            {'id': 1, 'state': 'returned', 'success': True, 'result': True}
+        """
+        job = self.sudo().browse(job_id).exists()
+        if not job or (job.res_push_uid != self.env.uid and not self.env.su and
+                       not self.env.user.has_group('asterisk_plus.group_asterisk_admin')):
+            raise AccessError(_('Salt job {} not found.').format(job_id))
+        if job.children:
+            result = {k.server.server_id: json.loads(k.full_ret)
+                      for k in job.children if k.full_ret}
+        else:
+            result = json.loads(job.full_ret) if job.full_ret else None
+        return {
+            'id': job.id,
+            'fun': job.fun,
+            'state': job.state,
+            'success': job.success == 'True',
+            'done': job.state not in ('queued', 'sent'),
+            'error': job.error or None,
+            'result': result,
+        }
+
+    def _run_callback(self, response, env):
+        """Pass the job result to its res_model / res_method called in env."""
+        if not (self.res_model and self.res_method):
+            # If no res model / method is specified.
+            return False
+        method = getattr(env[self.res_model], self.res_method)
+        with measure(env, 'salt:{}.{}'.format(
+                self.res_model, self.res_method), flush=True):
+            res = method(response, json.loads(self.pass_back) if self.pass_back else None)
+        # JSON-RPC requires a result to be returned.
+        return res if res else False
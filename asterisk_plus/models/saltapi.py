@@ -0,0 +1,197 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import urllib
+import pepper
+from pepper.exceptions import PepperException
+import requests
+from odoo.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+#: Idle Salt API sessions kept by every worker per Salt API URL and user.
+SALTAPI_POOL_SIZE = 4
+#: Seconds before the token expiration to login again.
+SALTAPI_REFRESH_MARGIN = 300
+#: Salt API request timeout in seconds.
+SALTAPI_TIMEOUT = 60
+#: Connection failures in a row opening the circuit.
+CIRCUIT_FAILURES = 3
+#: Seconds the circuit stays open before a trial request.
+CIRCUIT_RESET_TIMEOUT = 30
+
+
+class SaltApiUnavailable(ValidationError):
+    """Salt API can not be reached or its circuit is open."""
+
+
+class CircuitBreaker:
+    """Per worker circuit breaker failing fast while Salt API is down.
+
+    After CIRCUIT_FAILURES connection errors in a row the circuit opens and
+    requests fail at once. After CIRCUIT_RESET_TIMEOUT one trial request
+    is let through (half-open), its result closes or opens the circuit.
+    """
+
+    def __init__(self, failures=CIRCUIT_FAILURES,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            failures, opened = self._state.get(key, (0, None))
+            if opened is None:
+                return True
+            if time.time() - opened < self.reset_timeout:
+                return False
+            # Half-open: let one request through, others wait for it.
+            self._state[key] = (failures, time.time())
+            return True
+
+    def success(self, key):
+        with self._lock:
+            self._state.pop(key, None)
+
+    def failure(self, key):
+        with self._lock:
+            failures, opened = self._state.get(key, (0, None))
+            failures += 1
+            if failures >= self.failures:
+                if opened is None:
+                    logger.warning('Salt API circuit %s opened.', key)
+                opened = time.time()
+            self._state[key] = (failures, opened)
+
+    def is_open(self, key):
+        return self._state.get(key, (0, None))[1] is not None
+
+
+class SaltApiSession(pepper.Pepper):
+    """Pepper client sending all requests over one keep-alive connection.
+    """
+
+    def __init__(self, api_url, **kwargs):
+        super(SaltApiSession, self).__init__(api_url, **kwargs)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest',
+        })
+
+    def req(self, path, data=None):
+        headers = {}
+        if path != '/run' and self.auth and self.auth.get('token'):
+            headers['X-Auth-Token'] = self.auth['token']
+        try:
+            if data is not None:
+                resp = self.session.post(
+                    self._construct_url(path), json=data, headers=headers,
+                    verify=self._ssl_verify, timeout=SALTAPI_TIMEOUT)
+            else:
+                resp = self.session.get(
+                    self._construct_url(path), headers=headers,
+                    verify=self._ssl_verify, timeout=SALTAPI_TIMEOUT)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            # Keep urllib errors of plain Pepper for the callers.
+            raise urllib.error.URLError(str(e))
+        if resp.status_code == 401:
+            raise PepperException('Authentication denied')
+        if resp.status_code == 500:
+            raise PepperException('Server error.')
+        resp.raise_for_status()
+        if not self.salt_version and 'x-salt-version' in resp.headers:
+            self._parse_salt_version(resp.headers['x-salt-version'])
+        try:
+            return resp.json()
+        except ValueError:
+            raise PepperException('Unable to parse the server response.')
+
+    def close(self):
+        self.session.close()
+
+
+class SaltApiPool:
+    """Per worker pool of Salt API sessions sharing one auth token
+    per Salt API URL and user.
+
+    The token is kept in memory and renewed before it expires. Only one
+    thread logs in at a time, the others take its token.
+    """
+
+    def __init__(self, size=SALTAPI_POOL_SIZE):
+        self.size = size
+        self._idle = {}
+        self._auth = {}
+        self._login_locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self, url, user, password, eauth='file'):
+        """Authenticated Salt API session returned to the pool after use."""
+        key = (url, user)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            saltapi = idle.pop() if idle else None
+        if saltapi is None:
+            saltapi = SaltApiSession(url)
+        saltapi.auth = self.get_auth(saltapi, key, password, eauth)
+        try:
+            yield saltapi
+        except Exception:
+            # The connection can be broken.
+            saltapi.close()
+            raise
+        with self._lock:
+            if len(self._idle[key]) < self.size:
+                self._idle[key].append(saltapi)
+                return
+        saltapi.close()
+
+    def get_auth(self, saltapi, key, password, eauth, denied=None):
+        """Get the cached token or login.
+
+        Args:
+            denied (dict): Token rejected by Salt API, login again unless
+                another thread has already replaced it.
+        """
+        auth = self._auth.get(key)
+        if auth and auth is not denied and \
+                auth['expire'] - SALTAPI_REFRESH_MARGIN > time.time():
+            return auth
+        with self._lock:
+            login_lock = self._login_locks.setdefault(key, threading.Lock())
+        with login_lock:
+            auth = self._auth.get(key)
+            if auth and auth is not denied and \
+                    auth['expire'] - SALTAPI_REFRESH_MARGIN > time.time():
+                return auth
+            logger.info('SALT API LOGIN.')
+            saltapi.auth = {}
+            saltapi.login(key[1], password, eauth)
+            self._auth[key] = saltapi.auth
+            return saltapi.auth
+
+    def relogin(self, saltapi, url, user, password, eauth='file'):
+        """Replace the token denied by Salt API."""
+        saltapi.auth = self.get_auth(
+            saltapi, (url, user), password, eauth, denied=saltapi.auth)
+
+    def clear(self):
+        with self._lock:
+            for sessions in self._idle.values():
+                for saltapi in sessions:
+                    saltapi.close()
+            self._idle.clear()
+            self._auth.clear()
+
+
+#: Salt API sessions of the worker.
+saltapi_pool = SaltApiPool()
+#: Salt API circuits of the worker by URL.
+saltapi_breaker = CircuitBreaker()
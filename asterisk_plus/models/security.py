@@ -63,21 +63,22 @@ class AccessList(models.Model):
         """Update access rules for server.
         """
         servers_domain = [] if not server_id else [('id', '=', server_id)]
-        for server in self.env['asterisk_plus.server'].search(servers_domain):
-            entries = self.search([('server', '=', server.id),
-                                   ('is_enabled', '=', True)])
-            rules = []
-            for entry in entries:
-                rules.append({
-                    'address': entry.address,
-                    'comment': entry.comment,
-                    'netmask': entry.netmask,
-                    'address_type': entry.address_type,
-                    'access_type': entry.access_type})
-            server.local_job(
-                fun='asterisk.update_access_rules',
-                arg=[rules],
-                res_notify_uid=self.env.uid)
+        with self.env['asterisk_plus.server'].salt_batch():
+            for server in self.env['asterisk_plus.server'].search(servers_domain):
+                entries = self.search([('server', '=', server.id),
+                                       ('is_enabled', '=', True)])
+                rules = []
+                for entry in entries:
+                    rules.append({
+                        'address': entry.address,
+                        'comment': entry.comment,
+                        'netmask': entry.netmask,
+                        'address_type': entry.address_type,
+                        'access_type': entry.access_type})
+                server.local_job(
+                    fun='asterisk.update_access_rules',
+                    arg=[rules],
+                    res_notify_uid=self.env.uid)
 
 
 class Ban(models.Model):
@@ -97,15 +98,14 @@ class Ban(models.Model):
     def reload_bans(self, delay=0):
         """Get banned IPs from server.
         """
-        for server in self.env['asterisk_plus.server'].search([]):
-            server.local_job(
-                fun='asterisk.get_banned',
-                timeout=delay,
-                res_model='asterisk_plus.access_ban',
-                res_method='reload_bans_response',
-                pass_back={
-                    'notify_uid': self.env.uid,
-                })
+        self.env['asterisk_plus.server'].search([]).fan_out(
+            fun='asterisk.get_banned',
+            timeout=delay,
+            res_model='asterisk_plus.access_ban',
+            res_method='reload_bans_response',
+            pass_back={
+                'notify_uid': self.env.uid,
+            })
 
     @api.model
     def reload_bans_response(self, response, pass_back):
@@ -150,11 +150,12 @@ class Ban(models.Model):
         res = super(Ban, self).unlink()
         # Now send to agent
         if res:
-            for server in entries.keys():
-                server.local_job(
-                    fun='asterisk.remove_banned_addresses',
-                    arg=[entries[server]],
-                    res_notify_uid=self.env.uid)
+            with self.env['asterisk_plus.server'].salt_batch():
+                for server in entries.keys():
+                    server.local_job(
+                        fun='asterisk.remove_banned_addresses',
+                        arg=[entries[server]],
+                        res_notify_uid=self.env.uid)
         return res
 
     def add_to_whitelist(self):
@@ -1,7 +1,8 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 # -*- coding: utf-8 -*-
 import base64
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import json
 import logging
 import time
@@ -17,10 +18,25 @@ except ImportError:
     HUMANIZE = False
 import pepper
 from .settings import debug, FORMAT_TYPE
+from .tracing import trace, get_recent_traces
+from .handler_stats import handler_stats, ROLLING_MINUTES
+from .metrics import metrics
+from .saltapi import saltapi_pool, saltapi_breaker, SaltApiUnavailable
+from .ami_gateway import ami_gateway
+from .conf_archive import archive_to_base64, base64_to_archive, decode_conf
 from .res_partner import strip_number
+from .salt_job import ATTACHMENT_ARG
 
 logger = logging.getLogger(__name__)
 
+#: Transaction data key of the jobs collected by Server.salt_batch().
+SALT_BATCH_KEY = 'asterisk_plus.salt_batch'
+#: Seconds minions have to reply to the health ping.
+HEALTH_PING_TIMEOUT = 5
+#: Seconds to wait for Asterisk on the direct AMI connection.
+AMI_DIRECT_TIMEOUT = 5
+#: Attachment of the server with the last conf archive uploaded.
+CONF_ARCHIVE_NAME = 'asterisk_configs.tar.gz'
 
 #: Click-to-call originate number format.
 ORIGINATE_FORMAT_TYPES = [
@@ -30,6 +46,33 @@ ORIGINATE_FORMAT_TYPES = [
 ]
 
 
+def ami_action_done(future, dbname, uid, res_model=None, res_method=None,
+                    res_notify_uid=None, pass_back=None):
+    """Pass the result of an action sent by the AMI gateway to its callback.
+    Runs in a gateway thread as the server user.
+    """
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.warning('AMI gateway action error: %s', e)
+        result, error = None, str(e) or e.__class__.__name__
+    else:
+        error = result[0].get('Message') \
+            if result[0].get('Response') == 'Error' else None
+    try:
+        with registry(dbname).cursor() as cr:
+            env = api.Environment(cr, uid, {})
+            if res_notify_uid:
+                env['res.users'].asterisk_plus_notify(
+                    'asterisk.manager_action: {}'.format(
+                        'FAIL {}'.format(error) if error else 'OK'),
+                    uid=res_notify_uid, warning=bool(error))
+            if result is not None and res_model and res_method:
+                getattr(env[res_model], res_method)(result, pass_back)
+    except Exception:
+        logger.exception('AMI gateway action callback error:')
+
+
 def get_default_server(rec):
     return rec.env.ref('asterisk_plus.default_server')
 
@@ -72,6 +115,43 @@ class Server(models.Model):
     cli_area = fields.Char(string="Console", compute='_get_cli_area')
     console_url = fields.Char(default='wss://agent:30000/')
     console_auth_token = fields.Char()
+    identity_map_stats = fields.Text(compute='_get_identity_map_stats',
+                                     string='Identity Map')
+    event_queue_depth = fields.Integer(compute='_get_event_queue_stats',
+                                       string='Queued Events')
+    event_queue_lag = fields.Float(compute='_get_event_queue_stats',
+                                   string='Queue Lag (sec)')
+    event_queue_failed = fields.Integer(compute='_get_event_queue_stats',
+                                        string='Failed Events')
+    recent_traces = fields.Text(compute='_get_recent_traces')
+    handler_stats = fields.Text(compute='_get_handler_stats',
+                                string='Handler Statistics')
+    handler_profiles = fields.Text(compute='_get_handler_stats')
+    salt_job_stats = fields.Text(compute='_get_salt_job_stats',
+                                 string='Salt Job Latency')
+    health = fields.Selection([
+        ('unknown', 'Unknown'),
+        ('ok', 'Up'),
+        ('down', 'Down')], default='unknown', readonly=True,
+        help='Minion health from periodic pings and Salt job results. '
+             'Jobs to a server that is down are held until it is up.')
+    health_checked = fields.Datetime(readonly=True, string='Health Checked')
+    health_latency = fields.Float(readonly=True, string='Ping Latency (sec)')
+    health_error = fields.Char(readonly=True)
+    ami_transport = fields.Selection([
+        ('salt', 'Salt'),
+        ('direct', 'Direct AMI')], default='salt', required=True,
+        string='AMI Transport',
+        help='Direct AMI sends actions over a persistent AMI connection '
+             'from Odoo instead of a Salt job.')
+    ami_host = fields.Char(string='AMI Host')
+    ami_port = fields.Integer(string='AMI Port', default=5038)
+    ami_username = fields.Char(string='AMI Username')
+    ami_secret = fields.Char(string='AMI Secret')
+    ingest_token = fields.Char(
+        copy=False, groups='asterisk_plus.group_asterisk_admin',
+        help='Bearer token of the Agent posting binary frames to '
+             '/asterisk_plus/ingest.')
 
     _sql_constraints = [
         ('user_unique', 'UNIQUE("user")', 'This user is already used for another server!'),
@@ -103,54 +183,35 @@ class Server(models.Model):
         return True
 
     @api.model
-    def _get_saltapi(self, force_login=False):
-        """Get Salt API pepper instance.
-        TODO: Cache auth in ORM cache not ir.config_parameter.
+    def _get_saltapi(self):
+        """Get Salt API session from the worker's pool.
+        Use as a context manager:
+
+        .. code:: python
+
+            with self._get_saltapi() as saltapi:
+                saltapi.local(tgt='asterisk', fun='test.ping')
+
         Returns:
             A connected pepper instance. See `libpepper.py <https://github.com/saltstack/pepper/blob/develop/pepper/libpepper.py>`__ for details.
         """
         get_param = self.env['asterisk_plus.settings'].sudo().get_param
-        saltapi = pepper.Pepper(get_param('saltapi_url'))
-        # Get saltapi auth params
-        auth = self.env[
-            'ir.config_parameter'].sudo().get_param('saltapi_auth')
-        # Check if we already logged in.
-        if not force_login and auth:
-            # Convert into dictionary.
-            try:
-                auth = json.loads(auth)
-            except json.decoder.JSONDecodeError as e:
-                logger.error('Auth token error: %s: %s', auth, e)
-                auth = {'expire': 0}
-            if auth['expire'] - time.time() < 0:
-                # Token is no longer valid so need to login.
-                logger.info('SALT API LOGIN AS TOKEN IS EXPIRED.')
-                saltapi.login(
-                    get_param('saltapi_user'),
-                    get_param('saltapi_passwd'),
-                    'file',
-                )
-                # Update auth data.
-                self.env['ir.config_parameter'].sudo().set_param(
-                    'saltapi_auth', json.dumps(saltapi.auth))
-            else:
-                # Token not expired, take it.
-                saltapi.auth = auth
-        else:
-            # Token is no longer valid so need to login.
-            logger.info('SALT API LOGIN.')
-            saltapi.login(
-                get_param('saltapi_user'),
-                get_param('saltapi_passwd'),
-                'file',
-            )
-            self.env['ir.config_parameter'].set_param(
-                'saltapi_auth', json.dumps(saltapi.auth))
-        return saltapi
+        return saltapi_pool.session(get_param('saltapi_url'),
+                                    get_param('saltapi_user'),
+                                    get_param('saltapi_passwd'))
+
+    @api.model
+    def _saltapi_relogin(self, saltapi):
+        """Login again when Salt API has denied the session's token."""
+        get_param = self.env['asterisk_plus.settings'].sudo().get_param
+        saltapi_pool.relogin(saltapi, get_param('saltapi_url'),
+                             get_param('saltapi_user'),
+                             get_param('saltapi_passwd'))
 
     def local_job(self, fun, arg=None, kwarg=None, timeout=None,
                   res_model=None, res_method=None, res_notify_uid=None,
-                  pass_back=None, sync=False):
+                  pass_back=None, sync=False, res_push_uid=None,
+                  res_on_timeout=False):
         """Execute a function on Salt minion.
 
         Args:
@@ -162,56 +223,158 @@ class Server(models.Model):
             res_method (str): name of the method to receive function result. Function result is passed as the 1-st paramater.
             res_notify_uid (int): User ID that will receive function result in notification message.
             pass_back (dict): json serializable dictionary that is passed to res_method as the 2-nd paramater.
+            sync (bool): wait for the function result. Blocks the worker for the Salt round trip, see submit_job.
+            res_push_uid (int): User ID that will receive function result over the bus.
+            res_on_timeout (bool): pass salt_job.TIMEOUT_RESULT to res_method when the job times out.
+
+        Returns:
+            Function result for sync calls or the queued asterisk_plus.salt_job,
+            empty in salt_batch().
+        """
+        if self.env.context.get('mock_agent') or self.env[
+                'asterisk_plus.settings'].sudo().get_param('mock_agent'):
+            return self.env['asterisk_plus.mock_agent'].local_job(
+                self, fun, arg=arg, kwarg=kwarg, timeout=timeout,
+                res_model=res_model, res_method=res_method,
+                res_notify_uid=res_notify_uid, pass_back=pass_back, sync=sync,
+                res_push_uid=res_push_uid, res_on_timeout=res_on_timeout)
+        if sync and self.sudo().health == 'down':
+            # Do not wait for the timeout of a minion known to be down.
+            raise ValidationError(_('Server {} is down: {}').format(
+                self.name, self.sudo().health_error or ''))
+        if not sync:
+            # Queue the job in the current transaction. It is sent to Salt API
+            # after the commit so that the returner always finds it.
+            vals = {
+                'server': self.id,
+                'fun': fun,
+                'arg': json.dumps(arg) if arg is not None else False,
+                'kwarg': json.dumps(kwarg) if kwarg else False,
+                'timeout': timeout or 0,
+                'state': 'queued',
+                'res_model': res_model,
+                'res_method': res_method,
+                'res_notify_uid': res_notify_uid,
+                'res_push_uid': res_push_uid,
+                'res_on_timeout': res_on_timeout,
+                'pass_back': json.dumps(pass_back) if pass_back else False,
+            }
+            return self._queue_salt_job(vals)
+        ret = self._call_saltapi('local', tgt=self.server_id, fun=fun, arg=arg,
+                                 kwarg=kwarg, timeout=timeout)
+        # TODO: When minion is not accepted it raises error.
+        trace(self, 'salt', lambda: json.dumps(ret, indent=2))
+        return ret
+
+    def submit_job(self, fun, arg=None, kwarg=None, timeout=None, **kwargs):
+        """Non-blocking replacement of local_job(sync=True). The result is
+        pushed to the calling user over the bus as a 'salt_result' action when
+        the minion returns. Scripts can poll asterisk_plus.salt_job.get_result.
+
+        Returns:
+            Job handle: {'job': job ID, 'fun': fun}.
+        """
+        self.ensure_one()
+        job = self.local_job(fun, arg=arg, kwarg=kwarg, timeout=timeout,
+                             res_push_uid=self.env.uid, **kwargs)
+        return {'job': job.id, 'fun': fun}
+
+    def fan_out(self, fun, arg=None, kwarg=None, timeout=None,
+                res_model=None, res_method=None, res_notify_uid=None,
+                pass_back=None, res_on_timeout=False):
+        """Execute a function on all the servers with one Salt job targeting
+        the list of their minion IDs. Arguments are the same as of local_job,
+        every server's return is passed to res_method separately.
+
+        Returns:
+            The queued asterisk_plus.salt_job with a child job per server.
+        """
+        if len(self) <= 1 or self.env.context.get('mock_agent') or self.env[
+                'asterisk_plus.settings'].sudo().get_param('mock_agent'):
+            for server in self:
+                server.local_job(
+                    fun, arg=arg, kwarg=kwarg, timeout=timeout,
+                    res_model=res_model, res_method=res_method,
+                    res_notify_uid=res_notify_uid, pass_back=pass_back,
+                    res_on_timeout=res_on_timeout)
+            return self.env['asterisk_plus.salt_job']
+        return self._queue_salt_job({
+            'fun': fun,
+            'arg': json.dumps(arg) if arg is not None else False,
+            'kwarg': json.dumps(kwarg) if kwarg else False,
+            'timeout': timeout or 0,
+            'state': 'queued',
+            'res_model': res_model,
+            'res_method': res_method,
+            'res_notify_uid': res_notify_uid,
+            'res_on_timeout': res_on_timeout,
+            'pass_back': json.dumps(pass_back) if pass_back else False,
+            'children': [(0, 0, {'server': server.id, 'fun': fun,
+                                 'state': 'queued'}) for server in self],
+        })
+
+    def _queue_salt_job(self, vals):
+        batch = self.env.cr.postcommit.data.get(SALT_BATCH_KEY)
+        if batch is not None:
+            batch.append(vals)
+            return self.env['asterisk_plus.salt_job']
+        job = self.env['asterisk_plus.salt_job'].sudo().create(vals)
+        job._dispatch_after_commit()
+        return job
+
+    @contextmanager
+    def salt_batch(self):
+        """Collect async local_job calls of the block and queue them with
+        one insert. The jobs are sent in one Salt API request after the
+        commit, every job keeps its callback.
+
+        .. code:: python
+
+            with self.env['asterisk_plus.server'].salt_batch():
+                for conf in confs:
+                    conf.upload_conf()
         """
+        data = self.env.cr.postcommit.data
+        if SALT_BATCH_KEY in data:
+            # Nested batch, the outer one queues the jobs.
+            yield
+            return
+        batch = data[SALT_BATCH_KEY] = []
         try:
-            saltapi = self.sudo()._get_saltapi()
-        except urllib.error.URLError:
-            raise ValidationError('Cannot connect to Salt API process.')
-        # Wrap calling function to be able to re-login on session expiration.
-
-        def call_fun():
-            if not sync:
-                ret = saltapi.local_async(tgt=self.server_id, fun=fun, arg=arg,
-                                          kwarg=kwarg, timeout=timeout, ret='odoo')
-                self.env['asterisk_plus.salt_job'].sudo().create({
-                    'jid': ret['return'][0]['jid'],
-                    'res_model': res_model,
-                    'res_method': res_method,
-                    'res_notify_uid': res_notify_uid,
-                    'pass_back': json.dumps(pass_back) if pass_back else False,
-                })
-            else:
-                ret = saltapi.local(tgt=self.server_id, fun=fun, arg=arg,
-                                    kwarg=kwarg, timeout=timeout)
-            # TODO: Add server:
-            # {'return': [{'jid': '20210928122846179815', 'minions': ['asterisk']}]}
-            # TODO: When minion is not accepted it raises error.
-            debug(self, json.dumps(ret, indent=2))
-            if not self.env.context.get('no_commit'):
-                # Commit ASAP so that returner can find the job.
-                # TODO: Move the above to separate transation not to commit the current one.
-                self.env.cr.commit()
-            return ret
+            yield
+        finally:
+            data.pop(SALT_BATCH_KEY, None)
+        if batch:
+            self.env['asterisk_plus.salt_job'].sudo().create(
+                batch)._dispatch_after_commit()
+
+    def _call_saltapi(self, method, **kwargs):
+        """Call Salt API client method re-login on session expiration.
+        Fails fast with SaltApiUnavailable while the Salt API circuit is open.
+        """
+        url = self.env['asterisk_plus.settings'].sudo().get_param('saltapi_url')
+        if not saltapi_breaker.allow(url):
+            raise SaltApiUnavailable('Salt API is not available, retry later.')
         try:
-            return call_fun()
+            with self.sudo()._get_saltapi() as saltapi:
+                try:
+                    res = getattr(saltapi, method)(**kwargs)
+                except pepper.exceptions.PepperException as e:
+                    if 'Authentication denied' not in str(e):
+                        raise
+                    logger.warning('Salt Authentication denied.')
+                    self.sudo()._saltapi_relogin(saltapi)
+                    res = getattr(saltapi, method)(**kwargs)
         except ConnectionResetError:
-            raise ValidationError('Salt API connection reset! Check HTTP/HTTPS settings.')
+            saltapi_breaker.failure(url)
+            raise SaltApiUnavailable('Salt API connection reset! Check HTTP/HTTPS settings.')
         except urllib.error.URLError:
-            raise ValidationError('Salt API connection error!')
+            saltapi_breaker.failure(url)
+            raise SaltApiUnavailable('Salt API connection error!')
         #except pepper.ServerError ?? TODO: catch when master is done.
         #    raise ValidationError('Salt Master connection error!')
-        except KeyError as e:
-            if 'jid' in str(e):
-                raise ValidationError('No job ID was returned. Check Minion ID!')
-            else:
-                logger.exception('Key Error:')
-        except pepper.exceptions.PepperException as e:
-            if 'Authentication denied' in str(e):
-                logger.warning('Salt Authentication denied.')
-                saltapi = self.sudo()._get_saltapi(force_login=True)
-                return call_fun()
-            else:
-                raise
+        saltapi_breaker.success(url)
+        return res
 
     def ami_action(self, action, timeout=5, no_wait=False, as_list=None, **kwargs):
         """Send AMI action to the server.
@@ -219,6 +382,9 @@ class Server(models.Model):
         Args:
             action (dict): A dictionary with action.
 
+        Called on several servers sends the action to all of them with
+        one Salt job, see fan_out.
+
         Returns:
             A list of results as received from Asterisk.
 
@@ -235,7 +401,12 @@ class Server(models.Model):
             [{'Response': 'Success', 'ActionID': 'action/67cfd99b-8138-4cb5-9473-4e8be6d1cbe9/1/5026', 'Ping': 'Pong', 'Timestamp': '1631707333.341870', 'content': ''}]        
 
         """
-        return self.local_job(
+        if len(self) == 1 and self.sudo().ami_transport == 'direct' and \
+                not kwargs.get('res_push_uid'):
+            # Results pushed over the bus are polled from Salt jobs.
+            return self._ami_direct_action(action, timeout=timeout, **kwargs)
+        send = self.fan_out if len(self) > 1 else self.local_job
+        return send(
             fun='asterisk.manager_action',
             arg=action,
             kwarg={
@@ -244,8 +415,81 @@ class Server(models.Model):
                 'as_list': as_list
             }, **kwargs)
 
+    def _ami_direct_action(self, action, timeout=AMI_DIRECT_TIMEOUT,
+                           res_model=None, res_method=None,
+                           res_notify_uid=None, pass_back=None, sync=False):
+        """Send AMI action over the direct AMI gateway connection.
+
+        Sync calls return the result like local_job. Other calls send the
+        action after the commit and pass the result to res_model / res_method
+        in a new transaction.
+
+        The Salt `timeout` is also the delay of reload and restart actions,
+        so an empty one means AMI_DIRECT_TIMEOUT here.
+        """
+        timeout = timeout or AMI_DIRECT_TIMEOUT
+        if isinstance(action, (list, tuple)):
+            # Salt positional arguments.
+            action = action[0]
+        server = self.sudo()
+        key = (self.env.cr.dbname, self.id)
+        config = (server.ami_host or 'localhost', server.ami_port,
+                  server.ami_username, server.ami_secret)
+        if sync:
+            try:
+                res = ami_gateway.action(key, config, action, timeout=timeout)
+            except Exception as e:
+                raise ValidationError(_('AMI action error: {}').format(e))
+            trace(self, 'ami', lambda: json.dumps(res, indent=2))
+            return {'return': [{self.server_id: res}]}
+        callback = {
+            'dbname': self.env.cr.dbname,
+            'uid': server.user.id,
+            'res_model': res_model,
+            'res_method': res_method,
+            'res_notify_uid': res_notify_uid,
+            'pass_back': pass_back,
+        }
+
+        def send():
+            ami_gateway.submit(key, config, action, timeout).add_done_callback(
+                lambda future: ami_gateway.executor.submit(
+                    ami_action_done, future, **callback))
+
+        self.env.cr.postcommit.add(send)
+        return True
+
+    def ingest(self, frame):
+        """Pass a decoded binary frame of the Agent to the JSON-RPC handlers.
+        Called as the server user.
+
+        Args:
+            frame (dict): {'events': [AMI event], 'returns': [Salt return]}.
+
+        Returns:
+            {'events': events queued or on_ami_events results when Queue AMI
+            Events is not set, 'returns': returner_bulk results}.
+        """
+        res = {}
+        if frame.get('events'):
+            if self.env['asterisk_plus.settings'].sudo().get_param(
+                    'queue_ami_events'):
+                res['events'] = self.env['asterisk_plus.event_queue'].enqueue(
+                    frame['events'])
+            else:
+                res['events'] = self.env['asterisk_plus.channel'].on_ami_events(
+                    frame['events'])
+        if frame.get('returns'):
+            res['returns'] = self.env['asterisk_plus.salt_job'].returner_bulk(
+                frame['returns'])
+        return res
+
     ##################### UI BUTTONS ==========================================
 
+    def generate_ingest_token(self):
+        for rec in self:
+            rec.ingest_token = uuid.uuid4().hex
+
     def ping(self):
         """Called from server form to test the connectivity.
 
@@ -301,11 +545,11 @@ class Server(models.Model):
 
     def format_number(self, number, model=None, res_id=None):
         if model and res_id:
-            debug(self, 'FORMAT NUMBER FOR MODEL {}'.format(model))
+            trace(self, 'partner', 'FORMAT NUMBER FOR MODEL %s', model)
             obj = self.env[model].browse(res_id)
             if getattr(obj, '_format_number', False):
                 number = obj._format_number(number, format_type=FORMAT_TYPE)
-                debug(self, 'MODEL FORMATTED NUMBER: {}'.format(number))
+                trace(self, 'partner', 'MODEL FORMATTED NUMBER: %s', number)
                 return number
         return strip_number(number)
 
@@ -338,87 +582,91 @@ class Server(models.Model):
             # Save original callerid
             variables.append('OUTBOUND_CALLERID="{}" <{}>'.format(
                 self.env.user.name, self.env.user.asterisk_users.exten))
-            for ch in originate_channels:
-                channel_vars = variables.copy()
-                if ch.auto_answer_header:
-                    header = ch.auto_answer_header
-                    try:
-                        pos = header.find(':')
-                        param = header[:pos]
-                        val = header[pos+1:]
-                        if 'PJSIP' in ch.name.upper():
-                            channel_vars.append(
-                                'PJSIP_HEADER(add,{})={}'.format(
-                                    param.lstrip(), val.lstrip()))
-                        else:
-                            channel_vars.append(
-                                'SIPADDHEADER={}: {}'.format(
-                                    param.lstrip(), val.lstrip()))
-                    except Exception:
-                        logger.warning(
-                            'Cannot parse auto answer header: %s', header)
-
-                if dtmf_variables:
-                    channel_vars.extend(dtmf_variables)
-
-                channel_id = uuid.uuid4().hex
-                other_channel_id = uuid.uuid4().hex
-                # Create a call.
-                call_data = {
-                    'server': asterisk_user.server.id,
-                    'uniqueid': channel_id,
-                    'calling_user': self.env.user.id,
-                    'calling_number': asterisk_user.exten,
-                    'called_number': number,
-                    'started': datetime.now(),
-                    'direction': 'out',
-                    'is_active': True,
-                    'status': 'progress',
-                    'model': model,
-                    'res_id': res_id,
-                }
-                if model == 'res.partner':
-                    # Set call partner
-                    call_data['partner'] = res_id
-                call = self.env['asterisk_plus.call'].create(call_data)
-                self.env['asterisk_plus.channel'].create({
+            # Originate on all channels in one Salt API request.
+            with self.salt_batch():
+                for ch in originate_channels:
+                    channel_vars = variables.copy()
+                    if ch.auto_answer_header:
+                        header = ch.auto_answer_header
+                        try:
+                            pos = header.find(':')
+                            param = header[:pos]
+                            val = header[pos+1:]
+                            if 'PJSIP' in ch.name.upper():
+                                channel_vars.append(
+                                    'PJSIP_HEADER(add,{})={}'.format(
+                                        param.lstrip(), val.lstrip()))
+                            else:
+                                channel_vars.append(
+                                    'SIPADDHEADER={}: {}'.format(
+                                        param.lstrip(), val.lstrip()))
+                        except Exception:
+                            logger.warning(
+                                'Cannot parse auto answer header: %s', header)
+
+                    if dtmf_variables:
+                        channel_vars.extend(dtmf_variables)
+
+                    channel_id = uuid.uuid4().hex
+                    other_channel_id = uuid.uuid4().hex
+                    # Create a call.
+                    call_data = {
                         'server': asterisk_user.server.id,
-                        'user': self.env.user.id,
-                        'call': call.id,
-                        'channel': ch.name,
                         'uniqueid': channel_id,
-                        'linkedid': other_channel_id,
-                })
-                if not self.env.context.get('no_commit'):
-                    self.env.cr.commit()
-                action = {
-                    'Action': 'Originate',
-                    'Context': ch.originate_context,
-                    'Priority': '1',
-                    'Timeout': 1000 * originate_timeout,
-                    'Channel': ch.name,
-                    'Exten': number,
-                    'Async': 'true',
-                    'EarlyMedia': 'true',
-                    'CallerID': callerid,
-                    'ChannelId': channel_id,
-                    'OtherChannelId': other_channel_id,
-                    'Variable': channel_vars,
-                },
-
-                ch.server.ami_action(action, res_model='asterisk_plus.server',
-                                     res_method='originate_call_response',
-                                     pass_back={'uid': self.env.user.id})
+                        'calling_user': self.env.user.id,
+                        'calling_number': asterisk_user.exten,
+                        'called_number': number,
+                        'started': datetime.now(),
+                        'direction': 'out',
+                        'is_active': True,
+                        'status': 'progress',
+                        'model': model,
+                        'res_id': res_id,
+                    }
+                    if model == 'res.partner':
+                        # Set call partner
+                        call_data['partner'] = res_id
+                    call = self.env['asterisk_plus.call'].create(call_data)
+                    self.env['asterisk_plus.channel'].create({
+                            'server': asterisk_user.server.id,
+                            'user': self.env.user.id,
+                            'call': call.id,
+                            'channel': ch.name,
+                            'uniqueid': channel_id,
+                            'linkedid': other_channel_id,
+                    })
+                    action = {
+                        'Action': 'Originate',
+                        'Context': ch.originate_context,
+                        'Priority': '1',
+                        'Timeout': 1000 * originate_timeout,
+                        'Channel': ch.name,
+                        'Exten': number,
+                        'Async': 'true',
+                        'EarlyMedia': 'true',
+                        'CallerID': callerid,
+                        'ChannelId': channel_id,
+                        'OtherChannelId': other_channel_id,
+                        'Variable': channel_vars,
+                    },
+
+                    ch.server.ami_action(action, res_model='asterisk_plus.server',
+                                         res_method='originate_call_response',
+                                         pass_back={'uid': self.env.user.id})
 
     @api.model
     def originate_call_response(self, data, pass_back):
-        debug(self, json.dumps(data, indent=2))
+        trace(self, 'salt', lambda: json.dumps(data, indent=2))
         if data[0]['Response'] == 'Error':
             self.env.user.asterisk_plus_notify(
                 data[0]['Message'], uid=pass_back['uid'], warning=True)
 
     @api.onchange('custom_command')
     def send_custom_command(self):
+        if not self.custom_command:
+            return
+        if not self._origin:
+            raise ValidationError(_('Save the server first!'))
         try:
             cmd_line = self.custom_command.split(' ')
             cmd, params_list = cmd_line[0], cmd_line[1:]
@@ -426,15 +674,27 @@ class Server(models.Model):
             for param_val in params_list:
                 param, val = param_val.split('=')
                 kwarg[param] = val
-            res = self.local_job(fun=cmd, kwarg=kwarg, sync=True)
-            ret = res['return'][0][self.server_id]
-            if isinstance(ret, str):
-                pass
-            else:
-                ret = yaml.dump(ret, default_flow_style=False)
-            self.custom_command_reply = ret
         except ValueError:
             raise ValidationError('Command not understood! Example: network.ping host=google.com')
+        # Do not wait for the reply, it is set by custom_command_response.
+        self._origin.submit_job(
+            cmd, kwarg=kwarg,
+            res_model='asterisk_plus.server',
+            res_method='custom_command_response',
+            pass_back={'server': self._origin.id})
+        self.custom_command_reply = _('Waiting for reply...')
+
+    @api.model
+    def custom_command_response(self, data, pass_back):
+        if isinstance(data, str):
+            ret = data
+        else:
+            ret = yaml.dump(data, default_flow_style=False)
+        server = self.browse(pass_back.get('server')).exists()
+        if server:
+            server.sudo().custom_command_reply = ret
+            server.reload_view(model='asterisk_plus.server')
+        return True
 
     ##################### Work with configs ==========================================
 
@@ -450,10 +710,12 @@ class Server(models.Model):
         changed_configs = self.env['asterisk_plus.conf'].search(
             [('server', '=', self.id), ('is_updated', '=', True)])
         try:
-            for conf in changed_configs:
-                conf.upload_conf()
             if changed_configs:
-                self.reload_action(delay=0.5)
+                with self.salt_batch():
+                    for conf in changed_configs:
+                        conf.upload_conf()
+                    self.reload_confs(changed_configs.mapped('name'),
+                                      delay=0.5)
                 return True
             else:
                 self.env['res.users'].asterisk_plus_notify(
@@ -467,8 +729,19 @@ class Server(models.Model):
 
     @api.model
     def apply_all_changes(self):
-        for server in self.search([]):
-            server.apply_changes()
+        changed_configs = self.env['asterisk_plus.conf'].search(
+            [('is_updated', '=', True)])
+        if not changed_configs:
+            self.env['res.users'].asterisk_plus_notify(
+                _('No changes detected.'))
+            return True
+        with self.salt_batch():
+            for conf in changed_configs:
+                conf.upload_conf()
+            # Reload jobs of all changed servers in one request.
+            for server in changed_configs.mapped('server'):
+                server.reload_confs(changed_configs.filtered(
+                    lambda r: r.server == server).mapped('name'), delay=0.5)
         return True
 
     def download_all_conf(self):
@@ -480,62 +753,144 @@ class Server(models.Model):
             if 'Expected singleton: asterisk_plus.server()' in str(e):
                 raise Exception(
                     'Odoo account %s is not set to Remote Agent.', self.env.uid)
+        # All files in one tar.gz archive.
         self.local_job(
-            fun='asterisk.get_all_configs',
+            fun='asterisk.get_configs_archive',
             res_model='asterisk_plus.server',
-            res_method='download_all_conf_response',
+            res_method='download_conf_archive_response',
             pass_back={
                 'notify_uid': self.env.user.id,
             })
 
+    @api.model
+    def download_conf_archive_response(self, response, pass_back):
+        server = self.env.user.asterisk_server
+        if not isinstance(response, dict) or 'file_data' not in response:
+            # Agent without asterisk.get_configs_archive.
+            logger.info('Config archive not received (%s), getting files.',
+                        response)
+            server.local_job(
+                fun='asterisk.get_all_configs',
+                res_model='asterisk_plus.server',
+                res_method='download_all_conf_response',
+                pass_back=pass_back)
+            return True
+        changed = self.env['asterisk_plus.conf'].apply_archive(
+            server, base64_to_archive(response.pop('file_data')))
+        return server._download_all_conf_done(changed, pass_back)
+
     @api.model
     def download_all_conf_response(self, response, pass_back):
         if not isinstance(response, dict):
             return False
-
         server = self.env.user.asterisk_server
-        for file, data in response.items():
-            conf = self.env[
-                'asterisk_plus.conf'].with_context(
-                conf_no_update=True).get_or_create(server.id, file)
-            conf.write({
-                'content': base64.b64decode(data['file_data'].encode()),
-                'sync_date': fields.Datetime.now(),
-                'sync_uid': self.env.uid,
-                'is_updated': False,
-            })
+        changed = self.env['asterisk_plus.conf'].apply_files(server, (
+            (name,) + decode_conf(data['file_data'])
+            for name, data in response.items()))
+        return server._download_all_conf_done(changed, pass_back)
+
+    def _download_all_conf_done(self, changed, pass_back):
         # Update last sync
-        server.write({'sync_date': fields.Datetime.now(),
-                      'init_conf_sync': True,
-                      'sync_uid': self.env.uid})
+        self.write({'sync_date': fields.Datetime.now(),
+                    'init_conf_sync': True,
+                    'sync_uid': self.env.uid})
         uid = pass_back.get('notify_uid')
         if uid:
             self.env['res.users'].asterisk_plus_notify(
-                _('Config files download complete.'), uid=uid)
+                _('Config files download complete: {} changed.').format(
+                    len(changed)), uid=uid)
         return True
 
-    def upload_all_conf(self, auto_reload=False):
+    def export_conf_archive(self):
+        """Download all config files as a tar.gz archive."""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/asterisk_plus/conf_archive/{}'.format(self.id),
+            'target': 'self',
+        }
+
+    def import_conf_archive(self):
+        """Create or update config files from a tar.gz archive."""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'asterisk_plus.conf_import_wizard',
+            'name': _('Import Conf Files'),
+            'view_mode': 'form',
+            'target': 'new',
+            'context': {'default_server': self.id},
+        }
+
+    def upload_all_conf(self, auto_reload=False, confs=None, archive=True):
         """Upload all config files on server.
+
+        Args:
+            confs (asterisk_plus.conf): Upload only these files.
+            archive (bool): Send one tar.gz archive, False for old Agents.
         """
         self.ensure_one()
-        data = {}
-        for rec in [k for k in self.conf_files if k.content]:
-            data[rec.name] = base64.b64encode(rec.content.encode()).decode()
+        domain = [('server', '=', self.id), ('content', '!=', False)]
+        if confs is not None:
+            domain.append(('id', 'in', confs.ids))
+        # Only the names, contents are read in batches by write_archive.
+        rows = self.env['asterisk_plus.conf'].search_read(domain, ['name'])
+        confs = self.env['asterisk_plus.conf'].browse([k['id'] for k in rows])
+        names = sorted(k['name'] for k in rows)
+        if archive:
+            fun = 'asterisk.put_configs_archive'
+            # The job keeps the attachment ID, the archive is read on dispatch.
+            arg = [{ATTACHMENT_ARG: self._conf_archive_attachment(
+                confs.write_archive(update_hashes=True)).id}]
+        else:
+            fun = 'asterisk.put_all_configs'
+            arg = [{}]
+            for rec in confs:
+                data = rec.content.encode()
+                arg[0][rec.name] = base64.b64encode(data).decode()
+                rec._update_file_hash(rec.content_hash, data)
         self.local_job(
-            fun='asterisk.put_all_configs',
-            arg=[data],
+            fun=fun,
+            arg=arg,
             res_model='asterisk_plus.server',
             res_method='upload_all_conf_response',
             pass_back={
                 'notify_uid': self.env.user.id,
-                'auto_reload': True
+                'auto_reload': True,
+                'names': names,
+                'archive': archive,
             })
         self.conf_files.write({'is_updated': False})
         self.write({'sync_date': fields.Datetime.now(),
                     'sync_uid': self.env.uid})
 
+    def _conf_archive_attachment(self, fileobj):
+        """Store the archive in the attachment of the server reused by every
+        upload.
+        """
+        vals = {'datas': archive_to_base64(fileobj),
+                'mimetype': 'application/gzip'}
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name), ('res_id', '=', self.id),
+            ('name', '=', CONF_ARCHIVE_NAME)], limit=1)
+        if attachment:
+            attachment.write(vals)
+        else:
+            attachment = attachment.create(dict(
+                vals, name=CONF_ARCHIVE_NAME, res_model=self._name,
+                res_id=self.id))
+        return attachment
+
     @api.model
     def upload_all_conf_response(self, response, pass_back):
+        if pass_back.get('archive') and isinstance(response, str) and \
+                'is not available' in response:
+            # Agent without asterisk.put_configs_archive.
+            server = self.env.user.asterisk_server
+            server.upload_all_conf(confs=self.env['asterisk_plus.conf'].search(
+                [('server', '=', server.id),
+                 ('name', 'in', pass_back['names'])]), archive=False)
+            return True
         if not isinstance(response, bool):
             return False
         uid = pass_back.get('notify_uid')
@@ -543,7 +898,11 @@ class Server(models.Model):
             self.env['res.users'].asterisk_plus_notify(
                 _('Config files upload complete.'), uid=uid)
         if pass_back['auto_reload']:
-            self.env.user.asterisk_server.reload_action()
+            server = self.env.user.asterisk_server
+            if pass_back.get('names'):
+                server.reload_confs(pass_back['names'])
+            else:
+                server.reload_action()
         return True
 
     def sync_configs(self):
@@ -554,28 +913,78 @@ class Server(models.Model):
         if not server.conf_sync:
             logger.info('Not syncing Asterisk config files, not enabled.')
             return True
-        if server.conf_sync_direction == 'odoo_to_asterisk':
-            # Check if there was a first config upload
-            if not server.init_conf_sync:
-                logger.info('Getting all .conf files from %s for the 1-st time...',
-                            server.name)
-                server.download_all_conf()
-            else:
-                logger.info('Sending .conf files to Asterisk system %s...',
-                            server.name)
+        # Check if there was a first config upload
+        if server.conf_sync_direction == 'odoo_to_asterisk' and \
+                server.init_conf_sync:
+            direction = 'upload'
+        else:
+            direction = 'download'
+        logger.info('Comparing .conf files of Asterisk system %s to %s...',
+                    server.name, direction)
+        # Only files with different hashes are sent.
+        server.local_job(
+            fun='asterisk.get_config_hashes',
+            res_model='asterisk_plus.server',
+            res_method='sync_configs_response',
+            pass_back={
+                'direction': direction,
+                'notify_uid': self.env.user.id,
+            })
+        return True
+
+    @api.model
+    def sync_configs_response(self, response, pass_back):
+        """Send or get the files with different hashes.
+
+        Args:
+            response (dict): SHA-256 hex digest of every file by its name.
+        """
+        server = self.env.user.asterisk_server
+        if not isinstance(response, dict):
+            # Agent without asterisk.get_config_hashes.
+            logger.info('Config hashes not received (%s), syncing all files.',
+                        response)
+            if pass_back['direction'] == 'upload':
                 server.upload_all_conf()
-                server.reload_action(delay=3)
+            else:
+                server.download_all_conf()
+            return True
+        confs = server.conf_files
+        if pass_back['direction'] == 'upload':
+            changed = confs.filtered(
+                lambda r: r.content and r.content_hash != response.get(r.name))
+            if changed:
+                # Replies with a reload.
+                server.upload_all_conf(confs=changed)
+            (confs - changed).filtered('is_updated').write(
+                {'is_updated': False})
+            total = len(confs)
         else:
-            # Get configs from Asterisk
-            logger.info('Getting all .conf files from Asterisk system %s...',
-                        server.name)
-            server.download_all_conf()
+            hashes = {k.name: k.content_hash for k in confs}
+            changed = [name for name, digest in sorted(response.items())
+                       if hashes.get(name) != digest]
+            Conf = self.env['asterisk_plus.conf'].with_context(
+                conf_no_update=True)
+            with server.salt_batch():
+                for name in changed:
+                    Conf.get_or_create(server.id, name).download_conf(
+                        notify=False)
+            server.init_conf_sync = True
+            total = len(response)
+        server.write({'sync_date': fields.Datetime.now(),
+                      'sync_uid': self.env.uid})
+        logger.info('Config files %s: %s changed, %s unchanged.',
+                    pass_back['direction'], len(changed), total - len(changed))
+        uid = pass_back.get('notify_uid')
+        if uid:
+            self.env['res.users'].asterisk_plus_notify(
+                _('Config files sync: {} changed.').format(len(changed)),
+                uid=uid)
         return True
 
     def reload_action(self, module=None, notify_uid=None, delay=0):
         """Send 'Reload' action to Asterisk.
         """
-        self.ensure_one()
         action = {'Action': 'Reload'}
         if module:
             action['Module'] = module
@@ -584,6 +993,22 @@ class Server(models.Model):
             timeout=delay,
             res_notify_uid=notify_uid or self.env.uid)
 
+    def reload_confs(self, names, notify_uid=None, delay=0):
+        """Reload only the Asterisk modules of the changed conf files, see
+        Settings.get_reload_modules. Several modules are reloaded with one
+        AMI action.
+        """
+        modules = self.env['asterisk_plus.settings'].sudo().get_reload_modules(
+            names)
+        if not modules or len(modules) == 1:
+            return self.reload_action(module=modules[0] if modules else None,
+                                      notify_uid=notify_uid, delay=delay)
+        self.ami_action(
+            {'Action': 'Command',
+             'Command': 'module reload {}'.format(' '.join(modules))},
+            timeout=delay,
+            res_notify_uid=notify_uid or self.env.uid)
+
     def restart_action(self, notify_uid=None, delay=0):
         """Send 'core restart now' command to Asterisk.
         """
@@ -597,6 +1022,146 @@ class Server(models.Model):
             timeout=delay,
             res_notify_uid=notify_uid or self.env.uid)
 
+    ##################### Health ===========================================
+
+    @api.model
+    def check_health(self):
+        """Cron job to ping all minions with one Salt call.
+        """
+        servers = self.sudo().search([])
+        if not servers:
+            return True
+        started = time.time()
+        error = _('No reply to test.ping.')
+        try:
+            ret = self._call_saltapi('low', lowstate=[{
+                'client': 'local',
+                'tgt': servers.mapped('server_id'),
+                'tgt_type': 'list',
+                'fun': 'test.ping',
+                'timeout': HEALTH_PING_TIMEOUT}])
+            replies = ret['return'][0] if ret.get('return') else {}
+        except SaltApiUnavailable as e:
+            replies, error = {}, str(e)
+        latency = time.time() - started
+        servers.filtered(lambda r: replies.get(r.server_id) is True)._set_health(
+            'ok', latency=latency)
+        servers.filtered(lambda r: replies.get(r.server_id) is not True)._set_health(
+            'down', error=error)
+        return True
+
+    def _set_health(self, health, error=False, latency=None):
+        """Set health observed by pings, job dispatch and returns. Jobs held
+        for recovered servers are sent.
+        """
+        recovered = self.filtered(lambda r: r.health == 'down' and health == 'ok')
+        for rec in self.filtered(lambda r: r.health != health):
+            log = logger.warning if health == 'down' else logger.info
+            log('Server %s health: %s %s', rec.name, health, error or '')
+        vals = {'health': health, 'health_error': error,
+                'health_checked': fields.Datetime.now()}
+        if latency is not None:
+            vals['health_latency'] = latency
+        self.sudo().write(vals)
+        if recovered:
+            self.env['asterisk_plus.salt_job'].sudo().search([
+                ('server', 'in', recovered.ids),
+                ('state', '=', 'queued')])._dispatch_after_commit()
+
+    ##################### Statistics =======================================
+
+    def _get_identity_map_stats(self):
+        stats = yaml.dump(
+            self.env['asterisk_plus.channel'].get_identity_map_stats(),
+            default_flow_style=False)
+        for rec in self:
+            rec.identity_map_stats = stats
+
+    def _get_event_queue_stats(self):
+        stats = self.env['asterisk_plus.event_queue'].sudo().get_queue_stats()
+        for rec in self:
+            rec.event_queue_depth = stats['depth']
+            rec.event_queue_lag = stats['lag']
+            rec.event_queue_failed = stats['failed']
+
+    @api.model
+    def get_handler_stats(self):
+        """Latency, SQL queries and rows written by AMI handlers and Salt
+        callbacks of this worker: for the last minutes and since start.
+        """
+        db = self.env.cr.dbname
+        return {
+            'rolling_minutes': ROLLING_MINUTES,
+            'rolling': {name: hist.to_dict() for name, hist in
+                        handler_stats.get_rolling(db).items()},
+            'totals': {name: hist.to_dict() for name, hist in
+                       handler_stats.get_totals(db).items()},
+        }
+
+    @api.model
+    def get_metrics(self):
+        """Prometheus text exposition of this worker's metrics. Gauges
+        taken from the database are cached for a few seconds.
+        """
+        db = self.env.cr.dbname
+        env = self.sudo().env
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+        day_ago = datetime.utcnow() - timedelta(days=1)
+        lookups = metrics.get(db, 'asterisk_plus_caller_lookups_total')
+        misses = metrics.get(db, 'asterisk_plus_caller_lookup_misses_total')
+        gauges = {
+            'asterisk_plus_active_calls': metrics.cached(
+                db, 'active_calls', lambda: env['asterisk_plus.call'].search_count(
+                    [('is_active', '=', True)])),
+            'asterisk_plus_active_channels': metrics.cached(
+                db, 'active_channels', lambda: env['asterisk_plus.channel'].search_count(
+                    [('hangup_date', '=', False), ('create_date', '>', day_ago)])),
+            'asterisk_plus_salt_jobs_pending': metrics.cached(
+                db, 'salt_jobs_pending', lambda: env['asterisk_plus.salt_job'].search_count(
+                    [('state', 'in', ['queued', 'sent']), ('success', '=', False),
+                     ('create_date', '>', hour_ago)])),
+            'asterisk_plus_event_queue_depth': metrics.cached(
+                db, 'event_queue_depth', lambda: env[
+                    'asterisk_plus.event_queue'].get_queue_stats()['depth']),
+            'asterisk_plus_caller_lookup_hit_rate': round(
+                max(0, lookups - misses) / lookups, 3) if lookups else 0,
+            'asterisk_plus_server_up': metrics.cached(
+                db, 'server_up', lambda: [
+                    ((('server', k.name),), int(k.health == 'ok'))
+                    for k in env['asterisk_plus.server'].search([])]),
+            'asterisk_plus_saltapi_circuit_open': int(saltapi_breaker.is_open(
+                env['asterisk_plus.settings'].get_param('saltapi_url'))),
+        }
+        histograms = {'asterisk_plus_handler_seconds': [
+            ((('handler', name),), hist) for name, hist in
+            handler_stats.get_totals(db).items()]}
+        return metrics.render(db, gauges, histograms)
+
+    def _get_handler_stats(self):
+        stats = yaml.dump(self.get_handler_stats()['rolling'],
+                          default_flow_style=False)
+        profiles = '\n'.join('{}\n{}'.format(name, profile) for name, profile in
+                             handler_stats.get_profiles(self.env.cr.dbname).items())
+        for rec in self:
+            rec.handler_stats = stats
+            rec.handler_profiles = profiles
+
+    def _get_salt_job_stats(self):
+        stats = yaml.dump(self.env['asterisk_plus.salt_job'].sudo().get_latency_stats(),
+                          default_flow_style=False)
+        for rec in self:
+            rec.salt_job_stats = stats
+
+    def _get_recent_traces(self):
+        lines = []
+        for created, _db, subsystem, caller, message in get_recent_traces(
+                self.env.cr.dbname):
+            lines.append('{} [{}] {}: {}'.format(
+                datetime.utcfromtimestamp(created).strftime('%H:%M:%S.%f')[:-3],
+                subsystem, caller, message))
+        for rec in self:
+            rec.recent_traces = '\n'.join(lines)
+
     ##################### Console ==========================================
 
     def _get_cli_area(self):
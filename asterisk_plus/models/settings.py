@@ -1,19 +1,42 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
-import inspect
+from fnmatch import fnmatch
 import logging
 from odoo import fields, models, api, release, _
 from odoo.exceptions import ValidationError
 from odoo.tools import ormcache
+from .tracing import trace, TRACE_LEVELS, TRACE_SUBSYSTEMS, LEVEL_VALUES
+from .saltapi import saltapi_pool
 
 logger = logging.getLogger(__name__)
 
 FORMAT_TYPE = 'e164'
 
+#: Asterisk modules reloaded when conf files matching the patterns change.
+RELOAD_MODULES = """pjsip*.conf: res_pjsip.so
+extensions*.conf: pbx_config
+sip*.conf: chan_sip.so
+iax*.conf: chan_iax2.so
+queues*.conf: app_queue.so
+voicemail*.conf: app_voicemail.so
+confbridge*.conf: app_confbridge.so
+musiconhold*.conf: res_musiconhold.so
+rtp*.conf: res_rtp_asterisk.so
+features*.conf: features
+manager*.conf: manager
+http*.conf: http
+cdr*.conf: cdr
+cel*.conf: cel
+logger*.conf: logger
+acl*.conf: acl
+indications*.conf: indications
+"""
 
-def debug(rec, message):
-    caller_module = inspect.stack()[1][3]
-    if rec.env['asterisk_plus.settings'].sudo().get_param('debug_mode'):
-        print('++++++ {}: {}'.format(caller_module, message))
+
+def debug(rec, message, *args):
+    """Trace a message of the general subsystem enabled by Debug mode.
+    Kept for modules using it, see trace() for subsystems.
+    """
+    trace(rec, 'general', message, *args, depth=2)
 
 
 class Settings(models.Model):
@@ -35,10 +58,45 @@ class Settings(models.Model):
     saltapi_passwd = fields.Char(required=True, string='Salt API Password',
                                  default='odoo')
     #: Debug mode
-    debug_mode = fields.Boolean()
+    debug_mode = fields.Boolean(help='Trace general debug messages.')
+    #: Per subsystem trace levels.
+    trace_level_ami = fields.Selection(TRACE_LEVELS, default='off',
+                                       string='AMI Events Tracing')
+    trace_level_salt = fields.Selection(TRACE_LEVELS, default='off',
+                                        string='Salt Jobs Tracing')
+    trace_level_recording = fields.Selection(TRACE_LEVELS, default='off',
+                                             string='Recording Tracing')
+    trace_level_partner = fields.Selection(TRACE_LEVELS, default='off',
+                                           string='Partner Lookup Tracing')
+    trace_sample_rate = fields.Float(
+        default=1.0, string='Trace Sample Rate',
+        help='Share of traces to keep from 0 to 1. E.g. 0.1 keeps every 10th trace.')
+    #: Handler statistics.
+    handler_stats = fields.Boolean(
+        default=True, string='Handler Statistics',
+        help='Record time and SQL queries of AMI handlers and Salt callbacks.')
+    handler_stats_rows = fields.Boolean(
+        string='Count Rows Written',
+        help='Also count rows written by handlers. Costs 2 queries a handler.')
+    profile_handlers = fields.Char(
+        help='Comma separated handlers to profile, e.g. on_ami_hangup.')
+    profile_sample_rate = fields.Float(
+        default=0.01, help='Share of handler calls to profile from 0 to 1.')
     #: Save all AMI messages on channels
     trace_ami = fields.Boolean(string='Trace AMI',
         help='Save all AMI messages on channels')
+    trace_ami_storage = fields.Selection(
+        [('partitions', 'Daily Partitions'), ('messages', 'Channel Messages')],
+        default='partitions', required=True, string='AMI Trace Storage',
+        help='Daily Partitions append events to a table dropped day by day. '
+             'Channel Messages create a record for every event.')
+    queue_ami_events = fields.Boolean(
+        string='Queue AMI Events',
+        help='The Agent only appends AMI events to the event queue and the '
+             'queue consumers run the handlers. Restart the Agent to apply.')
+    mock_agent = fields.Boolean(
+        help='Answer Salt jobs and play originated calls locally without '
+             'Salt and Asterisk. Use only for load testing!')
     permit_ip_addresses = fields.Char(
         string=_('Permit IP address(es)'),
         help=_('Comma separated list of IP addresses permitted to query caller'
@@ -107,6 +165,15 @@ class Settings(models.Model):
     auto_reload_channels = fields.Boolean(
         default=True,
         help=_('Automatically refresh active channels view'))
+    conf_revisions_keep = fields.Integer(
+        default=50, string='Conf Revisions to Keep',
+        help='Revisions of every conf file kept for diff and rollback. '
+             'Older ones are deleted, 0 keeps all.')
+    reload_modules = fields.Text(
+        default=RELOAD_MODULES, string='Reload Modules',
+        help='Asterisk modules to reload when conf files change, one '
+             '"pattern: module" a line. Files not matching any pattern '
+             'reload all modules.')
 
     @api.model
     def _get_name(self):
@@ -141,6 +208,75 @@ class Settings(models.Model):
             data = data[0]
         return getattr(data, param, default)
 
+    @api.model
+    @ormcache()
+    def _get_trace_config(self):
+        """Returns trace levels by subsystem and the sample rate.
+        Cached until settings are changed.
+        """
+        settings = self.sudo()
+        levels = {'general': LEVEL_VALUES[
+            'debug' if settings.get_param('debug_mode') else 'off']}
+        for subsystem in TRACE_SUBSYSTEMS[1:]:
+            levels[subsystem] = LEVEL_VALUES[settings.get_param(
+                'trace_level_{}'.format(subsystem)) or 'off']
+        sample_rate = settings.get_param('trace_sample_rate')
+        return levels, sample_rate if sample_rate is not False else 1.0
+
+    @api.model
+    @ormcache()
+    def _get_stats_config(self):
+        """Returns handler statistics switches, profiled handlers and
+        the profile sample rate. Cached until settings are changed.
+        """
+        settings = self.sudo()
+        profiled = tuple(k.strip() for k in (
+            settings.get_param('profile_handlers') or '').split(',') if k.strip())
+        return (settings.get_param('handler_stats'),
+                settings.get_param('handler_stats_rows'),
+                profiled, settings.get_param('profile_sample_rate') or 0.0)
+
+    @api.model
+    @ormcache()
+    def _get_reload_modules(self):
+        """Returns (pattern, module) tuples. Cached until settings are changed.
+        """
+        res = []
+        for line in (self.sudo().get_param('reload_modules') or '').splitlines():
+            pattern, _sep, module = line.partition(':')
+            if pattern.strip() and not pattern.startswith('#'):
+                res.append((pattern.strip(), module.strip()))
+        return tuple(res)
+
+    @api.model
+    def get_reload_modules(self, names):
+        """Asterisk modules to reload after conf files are changed.
+
+        Args:
+            names (list): Changed conf file names.
+
+        Returns:
+            Sorted list of modules or None to reload all modules.
+        """
+        modules = set()
+        mapping = self._get_reload_modules()
+        for name in names:
+            module = next((k[1] for k in mapping if fnmatch(name, k[0])), None)
+            if not module:
+                return None
+            modules.add(module)
+        return sorted(modules)
+
+    @api.constrains('reload_modules')
+    def _check_reload_modules(self):
+        for rec in self:
+            for line in (rec.reload_modules or '').splitlines():
+                if line.strip() and not line.startswith('#') and \
+                        not line.partition(':')[2].strip():
+                    raise ValidationError(
+                        _('Reload modules line "{}" must be "pattern: '
+                          'module".').format(line))
+
     @api.model
     def set_param(self, param, value, keep_existing=False):
         """
@@ -155,7 +291,7 @@ class Settings(models.Model):
             # TODO: How to handle Boolean fields!?
             setattr(data, param, value)
         else:
-            debug(self, "Keeping existing value for param: {}".format(param))
+            debug(self, 'Keeping existing value for param: %s', param)
         return True
 
     @api.model
@@ -165,6 +301,9 @@ class Settings(models.Model):
 
     def write(self, vals):
         self.clear_caches()
+        if any(k.startswith('saltapi_') for k in vals):
+            # Drop sessions logged in with the old Salt API settings.
+            saltapi_pool.clear()
         return super(Settings, self).write(vals)
 
     @api.constrains('record_calls')
@@ -180,10 +319,7 @@ class Settings(models.Model):
         recording_event.is_enabled = True if self.record_calls is True else False
         # Reload events map
         servers = self.env['asterisk_plus.server'].search([])
-        for s in servers:
-            s.ami_action(
-                {'Action': 'ReloadEvents'},
-            )
+        servers.ami_action({'Action': 'ReloadEvents'})
 
     @api.constrains('use_mp3_encoder')
     def _check_lameenc(self):
@@ -0,0 +1,63 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import deque
+import logging
+import random
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Traced subsystems. Every subsystem has its own level in settings.
+TRACE_SUBSYSTEMS = ['general', 'ami', 'salt', 'recording', 'partner']
+#: Trace levels selection.
+TRACE_LEVELS = [('off', 'Off'), ('info', 'Info'), ('debug', 'Debug')]
+LEVEL_VALUES = {'off': 0, 'info': 1, 'debug': 2}
+#: Number of recent traces kept in memory by every worker.
+TRACE_BUFFER_SIZE = 1000
+
+#: Ring buffer of recent traces: (time, db, subsystem, caller, message).
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+def trace(rec, subsystem, message, *args, level='debug', depth=1):
+    """Trace a message of a subsystem.
+
+    The message is built only when the subsystem level is enabled, so pass
+    arguments instead of formatting them in advance:
+
+    .. code:: python
+
+        trace(self, 'ami', 'Channel %s not found.', event['Channel'])
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
+
+    Args:
+        rec: Any object with env (record, request).
+        subsystem (str): One of TRACE_SUBSYSTEMS.
+        message (str or callable): Message, %-format string or a function
+            returning the message.
+        level (str): info or debug.
+    """
+    levels, sample_rate = rec.env['asterisk_plus.settings']._get_trace_config()
+    if levels.get(subsystem, 0) < LEVEL_VALUES[level]:
+        return
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+    if callable(message):
+        message = message()
+    elif args:
+        message = message % args
+    caller = sys._getframe(depth).f_code.co_name
+    recent_traces.append(
+        (time.time(), rec.env.cr.dbname, subsystem, caller, message))
+    logger.info('[%s] %s: %s', subsystem, caller, message)
+
+
+def get_recent_traces(db, subsystem=None, limit=100):
+    """Recent traces of the database, newest first."""
+    res = []
+    for entry in reversed(recent_traces):
+        if entry[1] == db and (not subsystem or entry[2] == subsystem):
+            res.append(entry)
+            if len(res) >= limit:
+                break
+    return res
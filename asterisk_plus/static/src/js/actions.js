@@ -3,11 +3,14 @@ odoo.define("asterisk_plus.actions", function (require) {
   
     var WebClient = require('web.WebClient');
     var ajax = require('web.ajax');
+    var core = require('web.core');
     var utils = require('mail.utils');
     var session = require('web.session');
     var personal_channel = 'asterisk_plus_actions_' + session.uid;
     var common_channel = 'asterisk_plus_actions';
-
+    // Lists updated with row changes, see list_updates.py.
+    var list_models = ['asterisk_plus.call', 'asterisk_plus.channel'];
+    var list_channel_prefix = 'asterisk_plus_list_';
     WebClient.include({
         start: function() {
             this._super()
@@ -28,6 +31,7 @@ odoo.define("asterisk_plus.actions", function (require) {
                   console.log(settings)
                 })
                 // Start polling
+                self.asterisk_plus_enabled = true
                 self.call('bus_service', 'addChannel', personal_channel);
                 self.call('bus_service', 'addChannel', common_channel);
                 self.call('bus_service', 'onNotification', self,
@@ -41,7 +45,8 @@ odoo.define("asterisk_plus.actions", function (require) {
           for (var i = 0; i < action.length; i++) {
              var ch = action[i][0]
              var msg = action[i][1]
-             if (ch == personal_channel || ch == common_channel) {
+             if (ch == personal_channel || ch == common_channel ||
+                 (typeof ch == 'string' && ch.startsWith(list_channel_prefix))) {
                  try {
                   this.asterisk_plus_handle_action(msg)
                 }
@@ -60,6 +65,10 @@ odoo.define("asterisk_plus.actions", function (require) {
           if (message.action == 'reload_view') {
             return this.asterisk_plus_handle_reload_view(message)
           }
+          // Check if this is a list rows update.
+          else if (message.action == 'update_list') {
+            return this.asterisk_plus_handle_update_list(message)
+          }
           // Check if this is a notification action
           else if (message.action == 'notify') {
             return this.asterisk_plus_handle_notify(message)
@@ -68,6 +77,10 @@ odoo.define("asterisk_plus.actions", function (require) {
           else if (message.action == 'open_record') {
             return this.asterisk_plus_handle_open_record(message) 
           }
+          // Salt job result requested with Server.submit_job.
+          else if (message.action == 'salt_result') {
+            return core.bus.trigger('asterisk_plus_salt_result', message)
+          }
         },
 
         asterisk_plus_handle_open_record: function(message) {
@@ -101,6 +114,61 @@ odoo.define("asterisk_plus.actions", function (require) {
           controller.widget.reload()
         },
 
+        current_action_updated: function (action, controller) {
+          this._super.apply(this, arguments)
+          this.asterisk_plus_update_list_channels(controller)
+        },
+
+        asterisk_plus_update_list_channels: function (controller) {
+          // Listen to list updates only while the list is open.
+          if (!this.asterisk_plus_enabled)
+            return
+          var model = controller && controller.widget && controller.widget.modelName
+          var self = this
+          _.each(list_models, function (list_model) {
+            var channel = list_channel_prefix + list_model
+            if (list_model == model)
+              self.call('bus_service', 'addChannel', channel)
+            else
+              self.call('bus_service', 'deleteChannel', channel)
+          })
+        },
+
+        asterisk_plus_handle_update_list: function(message) {
+          var controller = this.action_manager && this.action_manager.getCurrentController()
+          if (!controller || controller.widget.modelName != message.model) {
+              return
+          }
+          var widget = controller.widget
+          if (widget.viewType != 'list') {
+            return
+          }
+          var state = widget.model.get(widget.handle)
+          var updated = message.updated || {}
+          var domain_fields = _.filter(_.flatten(state.domain), function (k) {
+            return typeof k == 'string'
+          })
+          // New or removed rows or rows leaving the domain require a reload.
+          if (message.created.length || message.removed.length ||
+              state.groupedBy.length || _.some(updated, function (field_names) {
+                return _.intersection(field_names, domain_fields).length
+              })) {
+            return widget.reload()
+          }
+          // Patch shown rows in place.
+          var records = _.filter(state.data, function (record) {
+            return updated[record.res_id]
+          })
+          if (!records.length) {
+            return
+          }
+          return Promise.all(_.map(records, function (record) {
+            return widget.model.reload(record.id)
+          })).then(function () {
+            return widget.update({}, {reload: false})
+          })
+        },
+
         asterisk_plus_handle_notify: function(message) {
           console.log(message)
           if (message.warning == true)
@@ -4,4 +4,16 @@ from . import test_event
 from . import test_user_channel
 from . import test_user
 from . import test_controllers
-from . import test_res_partner
\ No newline at end of file
+from . import test_res_partner
+from . import test_channel
+from . import test_event_queue
+from . import test_tracing
+from . import test_ami_replay
+from . import test_mock_agent
+from . import test_handler_stats
+from . import test_saltapi
+from . import test_ami_gateway
+from . import test_ingest
+from . import test_conf_sync
+from . import test_conf_revision
+from . import test_conf
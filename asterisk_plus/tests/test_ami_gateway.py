@@ -0,0 +1,106 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from concurrent.futures import Future
+import time
+from unittest.mock import patch
+from odoo.exceptions import ValidationError
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.ami_gateway import (
+    AmiGateway, format_message, parse_message)
+from odoo.addons.asterisk_plus.models.mock_ami import MockAmiServer
+from odoo.addons.asterisk_plus.models import server as server_module
+
+
+class TestAmiGateway(TransactionCase):
+
+    def setUp(self):
+        super(TestAmiGateway, self).setUp()
+        self.ami = MockAmiServer('odoo', 'secret', channels=[
+            {'Channel': 'PJSIP/1001-00000001'}])
+        self.port = self.ami.run_in_thread()
+        self.addCleanup(self.ami.stop)
+        self.gateway = AmiGateway()
+        self.config = ('127.0.0.1', self.port, 'odoo', 'secret')
+
+    def test_message(self):
+        data = format_message({'Action': 'Originate',
+                               'Variable': ['A=1', 'B=2']})
+        self.assertEqual(data, b'Action: Originate\r\nVariable: A=1\r\n'
+                               b'Variable: B=2\r\n\r\n')
+        self.assertEqual(parse_message(data),
+                         {'Action': 'Originate', 'Variable': ['A=1', 'B=2']})
+
+    def test_pipelining(self):
+        # Originate is answered last but does not hold the pings.
+        futures = [self.gateway.submit('test', self.config,
+                                       {'Action': 'Originate'})]
+        futures += [self.gateway.submit('test', self.config,
+                                        {'Action': 'Ping'})
+                    for _ in range(20)]
+        results = [k.result(5) for k in futures]
+        self.assertEqual(results[0][0]['Message'],
+                         'Originate successfully queued')
+        self.assertTrue(all(k[0]['Ping'] == 'Pong' for k in results[1:]))
+        # One connection and login for all actions.
+        self.assertEqual(len([k for k in self.ami.actions
+                              if k['Action'] == 'Login']), 1)
+
+    def test_event_list(self):
+        res = self.gateway.action('test', self.config,
+                                  {'Action': 'CoreShowChannels'})
+        self.assertEqual([k.get('Event') for k in res], [
+            None, 'CoreShowChannel', 'CoreShowChannelsComplete'])
+
+    def test_login_failed(self):
+        with self.assertRaises(Exception):
+            self.gateway.action('test', self.config[:3] + ('bad',),
+                                {'Action': 'Ping'}, timeout=1)
+
+    def test_reconnect(self):
+        self.gateway.action('test', self.config, {'Action': 'Ping'})
+        self.ami.drop_connections()
+        time.sleep(0.1)
+        res = self.gateway.action('test', self.config, {'Action': 'Ping'},
+                                  timeout=5)
+        self.assertEqual(res[0]['Response'], 'Success')
+
+    def _direct_server(self):
+        server = self.env.ref('asterisk_plus.default_server')
+        server.write({
+            'ami_transport': 'direct',
+            'ami_host': '127.0.0.1',
+            'ami_port': self.port,
+            'ami_username': 'odoo',
+            'ami_secret': 'secret',
+        })
+        return server
+
+    def test_server_direct(self):
+        server = self._direct_server()
+        with patch.object(server_module, 'ami_gateway', self.gateway):
+            res = server.ami_action({'Action': 'Ping'}, sync=True)
+            self.assertEqual(
+                res['return'][0][server.server_id][0]['Ping'], 'Pong')
+            # Not sent before the commit, no Salt job.
+            jobs = self.env['asterisk_plus.salt_job'].search_count([])
+            self.assertTrue(server.ami_action({'Action': 'Ping'}))
+            self.assertEqual(
+                self.env['asterisk_plus.salt_job'].search_count([]), jobs)
+            server.ami_secret = 'bad'
+            with self.assertRaises(ValidationError):
+                server.ami_action({'Action': 'Ping'}, sync=True, timeout=1)
+
+    def test_server_direct_reload(self):
+        # Reload is sent with delay=0 which is no AMI timeout.
+        server = self._direct_server()
+        sent, done = [], Future()
+        with patch.object(server_module, 'ami_gateway', self.gateway), \
+                patch.object(server_module, 'ami_action_done',
+                             lambda future, **kw: done.set_result(future)), \
+                patch.object(self.env.cr.postcommit, 'add', sent.append):
+            server.reload_action(module='res_pjsip.so')
+            sent.pop()()
+            res = done.result(5).result()
+        self.assertEqual(res[0]['Message'], 'Module Reloaded')
+        self.assertIn({'Action': 'Reload', 'Module': 'res_pjsip.so'}, [
+            {k: v for k, v in action.items() if k != 'ActionID'}
+            for action in self.ami.actions])
@@ -0,0 +1,52 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+from odoo.exceptions import ValidationError
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.wizard.ami_replay import (
+    dump_recording, load_recording, percentile)
+from .test_channel import ami_event
+
+
+class TestAmiReplay(TransactionCase):
+
+    def setUp(self):
+        super(TestAmiReplay, self).setUp()
+        self.records = [
+            (100.0, ami_event('Newchannel', 'replay-1.1', 'replay-1.1')),
+            (100.5, ami_event('Newchannel', 'replay-1.2', 'replay-1.1',
+                              Channel='SIP/1002-00000002')),
+            (105.0, ami_event('Hangup', 'replay-1.2', 'replay-1.1',
+                              Channel='SIP/1002-00000002', Cause='16',
+                              **{'Cause-txt': 'Normal Clearing'})),
+            (105.1, ami_event('Hangup', 'replay-1.1', 'replay-1.1',
+                              Cause='16', **{'Cause-txt': 'Normal Clearing'})),
+        ]
+
+    def test_recording(self):
+        self.assertEqual(load_recording(dump_recording(self.records)),
+                         self.records)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 99), 4)
+
+    def test_live_database(self):
+        wizard = self.env['asterisk_plus.ami_replay_wizard'].create({
+            'recording': base64.b64encode(dump_recording(self.records))})
+        self.assertFalse(wizard.database)
+        for database in [False, self.env.cr.dbname]:
+            wizard.database = database
+            with self.assertRaisesRegex(ValidationError, 'copy'):
+                wizard.replay()
+
+    def test_replay(self):
+        Wizard = self.env['asterisk_plus.ami_replay_wizard']
+        for batch_size, keys in [(1, {'Newchannel', 'Hangup'}), (2, {'Batch'})]:
+            stats = Wizard.with_context(no_commit=True)._replay(
+                self.records, batch_size=batch_size)
+            self.assertEqual(stats['events'], 4)
+            self.assertEqual(stats['errors'], 0)
+            self.assertEqual(set(stats['handlers']), keys)
+            self.assertGreater(stats['queries_per_event'], 0)
+            self.env['asterisk_plus.channel'].search(
+                [('uniqueid', 'like', 'replay-%')]).unlink()
+            self.env['asterisk_plus.call'].search(
+                [('uniqueid', 'like', 'replay-%')]).unlink()
@@ -0,0 +1,143 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
+from odoo.addons.asterisk_plus.models.cache import (
+    IdentityMap, call_map, channel_map)
+from odoo.addons.asterisk_plus.models.channel import (
+    LIVE_RECORDS_KEY, live_records_savepoint)
+
+
+def ami_event(name, uniqueid, linkedid, **kwargs):
+    event = {
+        'Event': name,
+        'Channel': 'SIP/1001-00000001',
+        'ChannelState': '4',
+        'ChannelStateDesc': 'Ring',
+        'CallerIDNum': '1001',
+        'CallerIDName': 'Test',
+        'ConnectedLineNum': '',
+        'ConnectedLineName': '',
+        'Language': 'en',
+        'AccountCode': '',
+        'Context': 'from-internal',
+        'Exten': '1002',
+        'Priority': '1',
+        'Uniqueid': uniqueid,
+        'Linkedid': linkedid,
+        'SystemName': 'asterisk',
+    }
+    event.update(kwargs)
+    return event
+
+
+class TestChannel(TransactionCase):
+
+    def test_on_ami_events(self):
+        events = [
+            ami_event('Newchannel', 'test-1.1', 'test-1.1'),
+            ami_event('Newchannel', 'test-2.1', 'test-2.1'),
+            ami_event('Newchannel', 'test-1.2', 'test-1.1',
+                      Channel='SIP/1002-00000002'),
+            ami_event('Hangup', 'test-1.2', 'test-1.1',
+                      Channel='SIP/1002-00000002', Cause='16',
+                      **{'Cause-txt': 'Normal Clearing'}),
+            ami_event('Hangup', 'test-1.1', 'test-1.1', Cause='17',
+                      **{'Cause-txt': 'User busy'}),
+            ami_event('UnknownEvent', 'test-1.1', 'test-1.1'),
+        ]
+        results = self.env['asterisk_plus.channel'].on_ami_events(events)
+        self.assertEqual(len(results), len(events))
+        self.assertFalse(results[-1])
+        channels = self.env['asterisk_plus.channel'].search(
+            [('uniqueid', 'like', 'test-%')])
+        self.assertEqual(len(channels), 3)
+        self.assertEqual(results[0], channels.filtered(
+            lambda r: r.uniqueid == 'test-1.1').id)
+        call = self.env['asterisk_plus.call'].search(
+            [('uniqueid', '=', 'test-1.1')])
+        self.assertEqual(len(call.channels), 2)
+        self.assertEqual(call.status, 'busy')
+        self.assertFalse(call.is_active)
+        self.assertTrue(self.env['asterisk_plus.call'].search(
+            [('uniqueid', '=', 'test-2.1'), ('is_active', '=', True)]))
+
+    def test_malformed_event(self):
+        self.env.ref('asterisk_plus.new_channel').condition = \
+            "event['Context'] != 'ignored'"
+        malformed = ami_event('Newchannel', 'bad-2.1', 'bad-2.1')
+        del malformed['CallerIDNum']
+        events = [
+            ami_event('Newchannel', 'bad-1.1', 'bad-1.1'),
+            malformed,
+            ami_event('Newchannel', 'bad-3.1', 'bad-3.1', Context='ignored'),
+            ami_event('Hangup', 'bad-1.1', 'bad-1.1', Cause='16',
+                      **{'Cause-txt': 'Normal Clearing'}),
+        ]
+        with mute_logger('odoo.addons.asterisk_plus.models.channel',
+                         'odoo.sql_db'):
+            results, errors = self.env[
+                'asterisk_plus.channel']._process_ami_events(events)
+        self.assertEqual(list(errors), ['bad-2.1'])
+        self.assertFalse(results[1])
+        channels = self.env['asterisk_plus.channel'].search(
+            [('uniqueid', 'like', 'bad-%')])
+        # The condition of the handler is checked.
+        self.assertEqual(channels.mapped('uniqueid'), ['bad-1.1'])
+        self.assertEqual(results[0], channels.id)
+        self.assertTrue(channels.hangup_date)
+
+    def test_live_records(self):
+        pending = lambda: self.env.cr.postcommit.data.get(LIVE_RECORDS_KEY, {})
+        # Rolled back records are not put to the maps on commit.
+        with self.assertRaises(ValueError), \
+                live_records_savepoint(self.env.cr):
+            self.env['asterisk_plus.channel'].create(
+                {'uniqueid': 'live-1.1', 'channel': 'SIP/1001-00000001'})
+            self.assertIn((channel_map, 'live-1.1'), pending())
+            raise ValueError()
+        self.assertNotIn((channel_map, 'live-1.1'), pending())
+        # Finished calls are not put back.
+        self.env['asterisk_plus.channel'].on_ami_events([
+            ami_event('Newchannel', 'live-2.1', 'live-2.1'),
+            ami_event('Hangup', 'live-2.1', 'live-2.1', Cause='16',
+                      **{'Cause-txt': 'Normal Clearing'}),
+        ])
+        self.assertNotIn((channel_map, 'live-2.1'), pending())
+        self.assertNotIn((call_map, 'live-2.1'), pending())
+
+    def test_identity_map(self):
+        identity_map = IdentityMap('test', size=2)
+        self.assertIsNone(identity_map.get('db', 'a'))
+        identity_map.set('db', 'a', 1)
+        identity_map.set('db', 'b', 2)
+        self.assertEqual(identity_map.get('db', 'a'), 1)
+        # 'b' is the least recently used entry.
+        identity_map.set('db', 'c', 3)
+        self.assertIsNone(identity_map.get('db', 'b'))
+        self.assertIsNone(identity_map.get('other_db', 'a'))
+        identity_map.pop('db', 'a')
+        self.assertIsNone(identity_map.get('db', 'a'))
+        identity_map.discard_ids('db', [3])
+        self.assertIsNone(identity_map.get('db', 'c'))
+        stats = identity_map.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 5))
+        expired = IdentityMap('expired', ttl=-1)
+        expired.set('db', 'a', 1)
+        self.assertIsNone(expired.get('db', 'a'))
+
+    def test_ami_trace(self):
+        self.env['asterisk_plus.settings'].set_param('trace_ami', True)
+        self.env['asterisk_plus.settings'].set_param(
+            'trace_ami_storage', 'partitions')
+        self.env['asterisk_plus.channel'].on_ami_events([
+            ami_event('Newchannel', 'trace-1.1', 'trace-1.1'),
+            ami_event('Newchannel', 'trace-1.2', 'trace-1.1',
+                      Channel='SIP/1002-00000002'),
+        ])
+        self.env['asterisk_plus.ami_trace'].flush()
+        timeline = self.env['asterisk_plus.ami_trace'].search(
+            self.env['asterisk_plus.ami_trace'].get_call_timeline(
+                'trace-1.1')['domain'])
+        self.assertEqual(timeline.mapped('uniqueid'), ['trace-1.1', 'trace-1.2'])
+        self.assertFalse(self.env['asterisk_plus.channel_message'].search(
+            [('uniqueid', 'like', 'trace-%')]))
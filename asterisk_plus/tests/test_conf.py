@@ -0,0 +1,53 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from odoo.exceptions import ValidationError
+from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
+
+
+class TestConf(TransactionCase):
+
+    def setUp(self):
+        super(TestConf, self).setUp()
+        self.server = self.env.ref('asterisk_plus.default_server')
+        self.Conf = self.env['asterisk_plus.conf'].with_context(
+            conf_no_update=True)
+
+    def test_unique_name(self):
+        conf = self.Conf.create({'server': self.server.id,
+                                 'name': 'unique_test.conf'})
+        with mute_logger('odoo.sql_db'), \
+                self.assertRaisesRegex(ValidationError, 'already used'):
+            self.Conf.create({'server': self.server.id,
+                              'name': 'unique_test.conf'})
+        # Archived files do not block the name.
+        conf.active = False
+        self.Conf.create({'server': self.server.id,
+                          'name': 'unique_test.conf'})
+        with mute_logger('odoo.sql_db'), \
+                self.assertRaisesRegex(ValidationError, 'already used'):
+            conf.active = True
+
+    def test_archive_duplicates(self):
+        self.env.cr.execute('DROP INDEX asterisk_plus_conf_server_name_uniq')
+        confs = self.Conf.create([{'server': self.server.id,
+                                   'name': 'duplicate_test.conf'}
+                                  for _ in range(2)])
+        with mute_logger('odoo.addons.asterisk_plus.models.conf'):
+            self.Conf.init()
+        confs.invalidate_cache()
+        self.assertEqual(confs.mapped('active'), [False, True])
+        with mute_logger('odoo.sql_db'), \
+                self.assertRaisesRegex(ValidationError, 'already used'):
+            self.Conf.create({'server': self.server.id,
+                              'name': 'duplicate_test.conf'})
+
+    def test_bulk_version(self):
+        confs = self.Conf.create([{
+            'server': self.server.id,
+            'name': 'bulk_test_{}.conf'.format(k),
+            'content': 'line {}\n'.format(k)} for k in range(5)])
+        confs[0].with_context(conf_no_update=False).content = 'changed\n'
+        confs.with_context(conf_no_update=False).write({'content': 'all\n'})
+        self.assertEqual(confs.mapped('version'), [3, 2, 2, 2, 2])
+        self.assertTrue(all(confs.mapped('is_updated')))
+        self.assertEqual(confs[0].revisions.sorted('id')[-1].version, 3)
@@ -0,0 +1,84 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from unittest.mock import patch
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.conf_revision import (
+    SNAPSHOT_INTERVAL, apply_delta, make_delta)
+from odoo.addons.asterisk_plus.models.mock_agent import MOCK_CONFIGS
+from odoo.addons.asterisk_plus.models.server import Server
+
+# Other tests replace Server.local_job with a mock.
+LOCAL_JOB = Server.local_job
+
+
+class TestConfRevision(TransactionCase):
+
+    def setUp(self):
+        super(TestConfRevision, self).setUp()
+        patcher = patch.object(Server, 'local_job', LOCAL_JOB)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.env.ref('asterisk_plus.default_server')
+        self.conf = self.env['asterisk_plus.conf'].with_context(
+            mock_agent=True, no_commit=True).create({
+                'server': self.server.id,
+                'name': 'extensions_revision_test.conf',
+                'content': ''.join('exten => {},1,Dial(PJSIP/{})\n'.format(
+                    k, k) for k in range(100, 200)),
+            })
+
+    def test_delta(self):
+        old = 'a\nb\nc\n'
+        new = 'a\nB\nc\nd'
+        self.assertEqual(apply_delta(old, make_delta(old, new)), new)
+        self.assertEqual(apply_delta(new, make_delta(new, '')), '')
+
+    def test_history(self):
+        contents = [self.conf.content]
+        for pos in range(SNAPSHOT_INTERVAL + 5):
+            self.conf.content = contents[-1].replace(
+                '{},'.format(100 + pos), '{}1,'.format(100 + pos))
+            contents.append(self.conf.content)
+        revisions = self.conf.revisions.sorted('id')
+        self.assertEqual(len(revisions), len(contents))
+        self.assertEqual(revisions.mapped('snapshot').count(True), 2)
+        # Deltas are small.
+        self.assertLess(revisions[1].size, revisions[0].size // 4)
+        for rev, content in zip(revisions, contents):
+            self.assertEqual(rev.content, content)
+        self.assertEqual(revisions[-1].version, self.conf.version)
+
+    def test_batch(self):
+        confs = self.conf | self.conf.copy({
+            'name': 'extensions_revision_copy.conf'})
+        confs.write({'content': 'exten => 100,1,Hangup()\n'})
+        for conf in confs:
+            revisions = conf.revisions.sorted('id')
+            self.assertEqual(len(revisions), 2)
+            self.assertEqual(revisions[-1].content, conf.content)
+            self.assertEqual(revisions[-1].version, conf.version)
+
+    def test_retention(self):
+        self.env['asterisk_plus.settings'].set_param('conf_revisions_keep', 3)
+        for pos in range(SNAPSHOT_INTERVAL + 5):
+            self.conf.content += 'exten => {},1,Hangup()\n'.format(pos)
+        revisions = self.conf.revisions.sorted('id')
+        # Kept from the snapshot the last 3 revisions are built from.
+        self.assertTrue(revisions[0].snapshot)
+        self.assertLessEqual(len(revisions), SNAPSHOT_INTERVAL + 1)
+        self.assertEqual(revisions[-1].content, self.conf.content)
+
+    def test_rollback(self):
+        first = self.conf.revisions
+        conf = self.conf.with_context(mock_agent=True, no_commit=True)
+        conf.content = 'exten => 100,1,Hangup()\n'
+        diff = self.env['asterisk_plus.conf_diff_wizard'].create({
+            'conf': conf.id, 'from_revision': first.id}).diff
+        self.assertIn('text-danger', diff)
+        first.with_context(mock_agent=True, no_commit=True).rollback()
+        self.assertEqual(conf.content, first.content)
+        self.assertEqual(conf.version, 3)
+        # Uploaded to Asterisk.
+        self.assertFalse(conf.is_updated)
+        self.assertEqual(MOCK_CONFIGS.pop(
+            (self.env.cr.dbname, self.server.id))[conf.name].decode(),
+            first.content)
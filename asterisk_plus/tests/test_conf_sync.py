@@ -0,0 +1,157 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import hashlib
+from unittest.mock import patch
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.mock_agent import MOCK_CONFIGS
+from odoo.addons.asterisk_plus.models.server import CONF_ARCHIVE_NAME, Server
+
+# Other tests replace Server.local_job with a mock.
+LOCAL_JOB = Server.local_job
+
+
+class TestConfSync(TransactionCase):
+
+    def setUp(self):
+        super(TestConfSync, self).setUp()
+        patcher = patch.object(Server, 'local_job', LOCAL_JOB)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.env.ref('asterisk_plus.default_server').with_context(
+            mock_agent=True, no_commit=True)
+        confs = self.env['asterisk_plus.conf'].with_context(
+            active_test=False).search([('server', '=', self.server.id)])
+        confs.write({'active': False})
+        confs.unlink()
+        self.files = MOCK_CONFIGS.setdefault(
+            (self.env.cr.dbname, self.server.id), {})
+        self.addCleanup(self.files.clear)
+        self.env['asterisk_plus.conf'].create([
+            {'server': self.server.id, 'name': 'a.conf', 'content': 'A'},
+            {'server': self.server.id, 'name': 'b.conf', 'content': 'B'},
+        ])
+
+    def count_jobs(self, fun):
+        return self.env['asterisk_plus.salt_job'].search_count(
+            [('fun', '=', fun)])
+
+    def test_upload(self):
+        self.files.update({'a.conf': b'A', 'b.conf': b'old'})
+        self.server.write({'conf_sync_direction': 'odoo_to_asterisk',
+                           'init_conf_sync': True})
+        self.server.sync_configs()
+        self.assertEqual(self.files['b.conf'], b'B')
+        self.assertEqual(self.count_jobs('asterisk.put_all_configs'), 1)
+        self.assertFalse(any(self.server.conf_files.mapped('is_updated')))
+        # Nothing to send, no reload.
+        reloads = self.count_jobs('asterisk.manager_action')
+        self.server.sync_configs()
+        self.assertEqual(self.count_jobs('asterisk.put_all_configs'), 1)
+        self.assertEqual(self.count_jobs('asterisk.manager_action'), reloads)
+
+    def test_download(self):
+        self.files.update({'a.conf': b'A', 'b.conf': b'B2',
+                           'c.conf': 'Café'.encode(),
+                           'd.conf': 'Café'.encode('latin-1')})
+        self.server.write({'conf_sync_direction': 'asterisk_to_odoo'})
+        self.server.sync_configs()
+        confs = {k.name: k for k in self.server.conf_files}
+        self.assertEqual(confs['b.conf'].content, 'B2')
+        self.assertEqual(confs['c.conf'].content, 'Café')
+        self.assertFalse(confs['c.conf'].is_updated)
+        # Not UTF-8 files keep the hash of the file on Asterisk.
+        self.assertEqual(confs['d.conf'].content, 'Café')
+        self.assertEqual(self.count_jobs('asterisk.get_config'), 3)
+        self.assertTrue(self.server.init_conf_sync)
+        self.server.sync_configs()
+        self.assertEqual(self.count_jobs('asterisk.get_config'), 3)
+
+    def test_old_agent(self):
+        # Agent without asterisk.get_config_hashes syncs all files.
+        self.server.write({'conf_sync_direction': 'odoo_to_asterisk',
+                           'init_conf_sync': True})
+        self.env['asterisk_plus.server'].with_user(
+            self.server.user).with_context(
+                mock_agent=True, no_commit=True).sync_configs_response(
+            "'asterisk.get_config_hashes' is not available.",
+            {'direction': 'upload'})
+        self.assertEqual(self.files, {'a.conf': b'A', 'b.conf': b'B'})
+
+    def test_reload_modules(self):
+        settings = self.env['asterisk_plus.settings']
+        self.assertEqual(settings.get_reload_modules(
+            ['pjsip_odoo_users.conf', 'extensions.conf', 'pjsip.conf']),
+            ['pbx_config', 'res_pjsip.so'])
+        # Unknown file reloads all modules.
+        self.assertIsNone(settings.get_reload_modules(['modules.conf']))
+        settings.set_param('reload_modules', 'modules.conf: res_odoo.so')
+        self.assertEqual(settings.get_reload_modules(['modules.conf']),
+                         ['res_odoo.so'])
+
+    def test_apply_changes(self):
+        self.env['asterisk_plus.conf'].create([
+            {'server': self.server.id, 'name': 'pjsip_odoo.conf',
+             'content': '[1001]'},
+            {'server': self.server.id, 'name': 'extensions_odoo.conf',
+             'content': '[users]'},
+        ])
+        actions = []
+        with patch.object(Server, 'ami_action',
+                          lambda self, action, **kw: actions.append(action)):
+            self.server.apply_changes()
+            self.server.reload_confs(['pjsip.conf'])
+            self.server.reload_confs(['pjsip.conf', 'modules.conf'])
+        # a.conf and b.conf are not mapped.
+        self.assertEqual(actions[0], {'Action': 'Reload'})
+        self.assertEqual(actions[1], {'Action': 'Reload',
+                                      'Module': 'res_pjsip.so'})
+        self.assertEqual(actions[2], {'Action': 'Reload'})
+        self.env['asterisk_plus.conf'].search(
+            [('name', 'in', ['a.conf', 'b.conf'])]).write(
+            {'is_updated': False})
+        actions.clear()
+        with patch.object(Server, 'ami_action',
+                          lambda self, action, **kw: actions.append(action)):
+            self.server.apply_changes()
+        self.assertEqual(actions, [{
+            'Action': 'Command',
+            'Command': 'module reload pbx_config res_pjsip.so'}])
+
+    def test_archive(self):
+        # Download: one archive, unchanged files are not written.
+        self.files.update({'a.conf': b'A', 'b.conf': b'B2',
+                           'c.conf': 'Café'.encode(),
+                           'd.conf': 'Café'.encode('latin-1')})
+        self.server.download_all_conf()
+        confs = {k.name: k for k in self.server.conf_files}
+        self.assertEqual(confs['b.conf'].content, 'B2')
+        self.assertEqual(confs['c.conf'].content, 'Café')
+        self.assertEqual(confs['a.conf'].version, 1)
+        # Not UTF-8 files keep the hash of the file on Asterisk.
+        self.assertEqual(confs['d.conf'].content, 'Café')
+        self.assertEqual(confs['d.conf'].content_hash, hashlib.sha256(
+            'Café'.encode('latin-1')).hexdigest())
+        self.assertEqual(self.count_jobs('asterisk.get_configs_archive'), 1)
+        self.assertEqual(self.count_jobs('asterisk.get_all_configs'), 0)
+        # Upload: one archive.
+        confs['a.conf'].content = 'A2'
+        self.files.clear()
+        self.server.upload_all_conf()
+        self.assertEqual(self.files, {'a.conf': b'A2', 'b.conf': b'B2',
+                                      'c.conf': 'Café'.encode(),
+                                      'd.conf': 'Café'.encode()})
+        # The job keeps a reference to the archive.
+        self.assertTrue(self.env['ir.attachment'].search([
+            ('res_model', '=', 'asterisk_plus.server'),
+            ('res_id', '=', self.server.id),
+            ('name', '=', CONF_ARCHIVE_NAME)]))
+        # Uploaded in UTF-8.
+        self.assertEqual(confs['d.conf'].content_hash, hashlib.sha256(
+            'Café'.encode()).hexdigest())
+        # Export and import back.
+        archive = self.server.conf_files.write_archive()
+        confs['a.conf'].content = 'A3'
+        changed = self.env['asterisk_plus.conf'].apply_archive(
+            self.server, archive, sync=False)
+        self.assertEqual(changed, ['a.conf'])
+        self.assertEqual(confs['a.conf'].content, 'A2')
+        self.assertTrue(confs['a.conf'].is_updated)
@@ -1,3 +1,4 @@
+import os
 from odoo.tests.common import HttpCase, new_test_user
 import urllib
 
@@ -30,6 +31,27 @@ class TestController(HttpCase):
             params=urllib.parse.urlencode(params)),
             timeout=2)
 
+    def test_job_result(self):
+        job = self.env['asterisk_plus.salt_job'].create({
+            'fun': 'asterisk.manager_action',
+            'state': 'returned',
+            'success': 'True',
+            'full_ret': '"Command output"',
+            'res_push_uid': self.user.id,
+        })
+        url = '/asterisk_plus/job/{}'.format(job.id)
+        with self.subTest(test_name='Anonymous'):
+            res = self.url_open(url, timeout=2)
+            self.assertIn('/web/login', res.url)
+        with self.subTest(test_name='Other user'):
+            new_test_user(self.env, login='other', groups='base.group_user')
+            self.authenticate('other', 'other')
+            self.assertEqual(self.url_open(url, timeout=2).status_code, 404)
+        with self.subTest(test_name='Job owner'):
+            self.authenticate('user', 'user')
+            res = self.url_open(url, timeout=2)
+            self.assertEqual(res.json()['result'], 'Command output')
+
     def test_forbidden_ip(self):
         with self.subTest(test_name='Forbidden IP'):
             self.env['asterisk_plus.settings'].set_param(
@@ -92,3 +114,15 @@ class TestController(HttpCase):
         with self.subTest(test_name='Tags not found'):
             res = self.send_request(self.partner_manager_url, {'number': '10101999'})
             self.assertEqual(res.text, '')
+
+    def test_metrics(self):
+        self.send_request(self.caller_name_url, {'number': '10101'})
+        res = self.send_request('/asterisk_plus/metrics?', {})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('asterisk_plus_caller_lookups_total', res.text)
+        self.assertIn('# TYPE asterisk_plus_active_calls gauge', res.text)
+        self.assertIn('worker="{}"'.format(os.getpid()), res.text)
+        self.env['asterisk_plus.settings'].set_param(
+            'permit_ip_addresses', '45.46.47.01')
+        res = self.send_request('/asterisk_plus/metrics?', {})
+        self.assertEqual(res.status_code, 400)
@@ -0,0 +1,83 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from unittest.mock import patch
+from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
+from odoo.addons.asterisk_plus.models.channel import Channel
+from .test_channel import ami_event
+
+PROCESS_AMI_EVENTS = Channel._process_ami_events
+
+
+class TestEventQueue(TransactionCase):
+
+    def test_process_queue(self):
+        queue = self.env['asterisk_plus.event_queue'].with_context(
+            no_commit=True)
+        self.assertEqual(queue.enqueue([
+            ami_event('Newchannel', 'queue-1.1', 'queue-1.1'),
+            ami_event('Hangup', 'queue-1.1', 'queue-1.1', Cause='16',
+                      **{'Cause-txt': 'Normal Clearing'}),
+        ]), 2)
+        self.assertEqual(queue.get_queue_stats()['depth'], 2)
+        self.assertEqual(queue.process_queue(), 2)
+        self.assertEqual(queue.get_queue_stats()['depth'], 0)
+        call = self.env['asterisk_plus.call'].search(
+            [('uniqueid', '=', 'queue-1.1')])
+        self.assertEqual(call.status, 'answered')
+        self.assertFalse(call.is_active)
+
+    def test_failed_event(self):
+        queue = self.env['asterisk_plus.event_queue'].with_context(
+            no_commit=True)
+        # Newstate of an unknown call fails as the call event has no call.
+        queue.enqueue({'Event': 'Newstate', 'Uniqueid': 'queue-2.1',
+                       'Linkedid': 'queue-2.1', 'ChannelStateDesc': 'Up',
+                       'Channel': 'SIP/1001-00000001'})
+        with mute_logger('odoo.addons.asterisk_plus.models.channel',
+                         'odoo.sql_db'):
+            queue.process_queue()
+        failed = queue.search([('linkedid', '=', 'queue-2.1')])
+        self.assertEqual(failed.state, 'failed')
+        self.assertTrue(failed.error)
+
+    def test_dead_letter(self):
+        queue = self.env['asterisk_plus.event_queue'].with_context(
+            no_commit=True)
+        queue.enqueue([
+            ami_event('Newchannel', 'queue-3.1', 'queue-3.1'),
+            ami_event('Newchannel', 'queue-4.1', 'queue-4.1'),
+        ])
+
+        def process(self, events):
+            if any(k['Linkedid'] == 'queue-3.1' for k in events):
+                raise ValueError('Broken call')
+            return PROCESS_AMI_EVENTS(self, events)
+
+        with patch.object(Channel, '_process_ami_events', process), \
+                mute_logger('odoo.addons.asterisk_plus.models.event_queue'):
+            self.assertEqual(queue.process_queue(), 2)
+        # The broken call does not hold the other one.
+        failed = queue.search([])
+        self.assertEqual(failed.mapped('linkedid'), ['queue-3.1'])
+        self.assertEqual(failed.state, 'failed')
+        self.assertTrue(self.env['asterisk_plus.call'].search(
+            [('uniqueid', '=', 'queue-4.1')]))
+        self.assertEqual(queue.get_queue_stats()['depth'], 0)
+
+    def test_agent_handlers(self):
+        server_user = self.env.ref('asterisk_plus.default_server').user
+        self.env['asterisk_plus.event'].create({
+            'source': 'AMI', 'name': 'Hangup',
+            'model': 'asterisk_plus.channel', 'method': 'on_test_hangup'})
+        events = self.env['asterisk_plus.event'].with_user(server_user)
+        domain = [('source', '=', 'AMI'), ('name', '=', 'Hangup')]
+        fields = ['model', 'method', 'condition']
+        self.assertNotIn('asterisk_plus.event_queue', [
+            k['model'] for k in events.search_read(domain, fields)])
+        self.env['asterisk_plus.settings'].set_param('queue_ami_events', True)
+        handlers = events.search_read(domain, fields)
+        self.assertEqual({(k['model'], k['method']) for k in handlers},
+                         {('asterisk_plus.event_queue', 'enqueue')})
+        # Every event is queued once.
+        self.assertEqual(
+            [k['condition'] for k in handlers].count(False), 1)
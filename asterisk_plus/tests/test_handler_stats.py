@@ -0,0 +1,58 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import os
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.handler_stats import (
+    Histogram, HandlerStats)
+from odoo.addons.asterisk_plus.models.metrics import Metrics
+from .test_channel import ami_event
+
+
+class TestHandlerStats(TransactionCase):
+
+    def test_histogram(self):
+        stats = HandlerStats()
+        for ms in [1, 1, 3, 40, 900]:
+            stats.record('db', 'test', ms / 1000.0, 2, rows=1)
+        hist = stats.get_rolling('db')['test']
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.percentile(50), 0.005)
+        self.assertEqual(hist.percentile(99), 0.9)
+        self.assertEqual(hist.to_dict()['queries_per_call'], 2)
+        self.assertFalse(stats.get_rolling('other_db'))
+        self.assertEqual(Histogram().to_dict()['count'], 0)
+
+    def test_handlers_measured(self):
+        settings = self.env['asterisk_plus.settings']
+        settings.set_param('handler_stats', True)
+        settings.set_param('handler_stats_rows', True)
+        settings.set_param('profile_handlers', 'on_ami_new_channel')
+        settings.set_param('profile_sample_rate', 1.0)
+        self.env['asterisk_plus.channel'].on_ami_events([
+            ami_event('Newchannel', 'stats-1.1', 'stats-1.1')])
+        stats = self.env['asterisk_plus.server'].get_handler_stats()
+        new_channel = stats['totals']['ami:on_ami_new_channel']
+        self.assertGreaterEqual(new_channel['count'], 1)
+        self.assertGreater(new_channel['queries_per_call'], 0)
+        self.assertGreater(new_channel['rows_per_call'], 0)
+        self.assertIn('update_call_data', stats['rolling'])
+        server = self.env.ref('asterisk_plus.default_server')
+        self.assertIn('ami:on_ami_new_channel', server.handler_profiles)
+
+    def test_metrics_render(self):
+        metrics = Metrics()
+        metrics.inc('db', 'asterisk_plus_ami_events_total', event='Hangup')
+        metrics.inc('db', 'asterisk_plus_ami_events_total', event='Hangup')
+        metrics.observe('db', 'asterisk_plus_salt_job_roundtrip_seconds',
+                        0.3, fun='test.ping')
+        text = metrics.render('db', gauges={'asterisk_plus_active_calls': 2})
+        worker = os.getpid()
+        self.assertIn('asterisk_plus_ami_events_total{{event="Hangup",'
+                      'worker="{}"}} 2'.format(worker), text)
+        self.assertIn('asterisk_plus_active_calls{{worker="{}"}} 2'.format(
+            worker), text)
+        self.assertIn('asterisk_plus_salt_job_roundtrip_seconds_bucket'
+                      '{{fun="test.ping",le="0.5",worker="{}"}} 1'.format(
+                          worker), text)
+        self.assertIn('asterisk_plus_salt_job_roundtrip_seconds_count'
+                      '{{fun="test.ping",worker="{}"}} 1'.format(worker), text)
+        self.assertEqual(metrics.render('other_db'), '\n')
@@ -0,0 +1,67 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+import unittest
+from odoo.tests.common import HttpCase
+from odoo.addons.asterisk_plus.models.ingest import (
+    MSGPACK, HEADER_IDS, binary_to_base64, decode_frame, encode_frame,
+    loads, pack_keys, unpack_keys)
+
+
+class TestIngest(HttpCase):
+
+    def setUp(self):
+        super(TestIngest, self).setUp()
+        self.server = self.env.ref('asterisk_plus.default_server')
+        self.server.generate_ingest_token()
+        self.event = {'Event': 'FullyBooted', 'Privilege': 'system,all',
+                      'Uptime': '10', 'Status': 'Fully Booted'}
+
+    def test_keys(self):
+        packed = pack_keys(self.event)
+        self.assertEqual(packed[HEADER_IDS['Event']], 'FullyBooted')
+        # Unknown headers are sent as is.
+        self.assertEqual(packed['Uptime'], '10')
+        self.assertEqual(unpack_keys(packed), self.event)
+        with self.assertRaises(ValueError):
+            unpack_keys({10000: 'x'})
+        self.assertEqual(binary_to_base64({'return': {'file_data': b'\x00'}}),
+                         {'return': {'file_data': base64.b64encode(
+                             b'\x00').decode()}})
+
+    def post(self, data, token):
+        return self.url_open('/asterisk_plus/ingest', data=data, headers={
+            'Content-Type': 'application/msgpack',
+            'Authorization': 'Bearer {}'.format(token)})
+
+    @unittest.skipIf(not MSGPACK, 'msgpack is not installed')
+    def test_ingest(self):
+        ret = {'jid': '20210916150939079024', 'id': 'asterisk',
+               'fun': 'asterisk.get_file', 'fun_args': [], 'retcode': 0,
+               'success': True, 'return': {'file_data': b'RIFF\x00\x01'}}
+        data = encode_frame([self.event], [ret])
+        self.assertEqual(decode_frame(data, 'msgpack')['returns'][0][
+            'return']['file_data'], base64.b64encode(b'RIFF\x00\x01').decode())
+        res = self.post(data, 'bad')
+        self.assertEqual(res.status_code, 401)
+        self.env['asterisk_plus.settings'].set_param('queue_ami_events', True)
+        res = self.post(data, self.server.sudo().ingest_token)
+        self.assertEqual(res.status_code, 200)
+        res = loads(res.content, 'msgpack')
+        self.assertEqual(res['events'], 1)
+        self.assertEqual(res['returns'][0]['jid'], ret['jid'])
+        queued = self.env['asterisk_plus.event_queue'].search(
+            [('event', '=', 'FullyBooted')])
+        self.assertEqual(queued.user, self.server.user)
+        # Not a frame.
+        self.assertEqual(self.post(b'\xc1', self.server.sudo().ingest_token
+                                   ).status_code, 400)
+
+    @unittest.skipIf(not MSGPACK, 'msgpack is not installed')
+    def test_ingest_events(self):
+        # Events are handled at once when Queue AMI Events is not set.
+        self.env['asterisk_plus.settings'].set_param('queue_ami_events', False)
+        res = self.post(encode_frame([{'Event': 'TestIngestEvent'}], []),
+                        self.server.sudo().ingest_token)
+        self.assertEqual(loads(res.content, 'msgpack')['events'], [False])
+        self.assertFalse(self.env['asterisk_plus.event_queue'].search(
+            [('event', '=', 'TestIngestEvent')]))
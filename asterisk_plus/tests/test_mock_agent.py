@@ -0,0 +1,64 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from unittest.mock import patch
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.mock_agent import (
+    MockAgent, generate_call_events)
+from odoo.addons.asterisk_plus.models.server import Server
+
+# Other tests replace Server.local_job with a mock.
+LOCAL_JOB = Server.local_job
+
+
+class TestMockAgent(TransactionCase):
+
+    def setUp(self):
+        super(TestMockAgent, self).setUp()
+        patcher = patch.object(Server, 'local_job', LOCAL_JOB)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.env.ref('asterisk_plus.default_server').with_context(
+            mock_agent=True, no_commit=True)
+
+    def test_local_job(self):
+        self.assertEqual(self.server.local_job('test.ping', sync=True),
+                         {'return': [{'asterisk': True}]})
+        res = self.server.ami_action({'Action': 'Ping'}, sync=True)
+        self.assertEqual(res['return'][0]['asterisk'][0]['Ping'], 'Pong')
+
+    def test_call(self):
+        events = generate_call_events(
+            'mock-1.1', 'mock-1.2', 'SIP/trunk-00000001', 'SIP/1001-00000002',
+            '+15551234567', '1001', cause=('16', 'Normal Clearing'),
+            recording_path='/var/spool/asterisk/monitor/mock-1.1.wav')
+        self.assertEqual([k[1]['Event'] for k in events], [
+            'Newchannel', 'Newchannel', 'Newstate', 'Newstate', 'VarSet',
+            'Hangup', 'Hangup'])
+        self.env['asterisk_plus.mock_agent'].with_user(
+            self.server.user).with_context(
+                mock_agent=True, no_commit=True)._play_events(events)
+        call = self.env['asterisk_plus.call'].search(
+            [('uniqueid', '=', 'mock-1.1')])
+        self.assertEqual(call.status, 'answered')
+        self.assertFalse(call.is_active)
+        self.assertEqual(len(call.channels), 2)
+        self.assertTrue(self.env['asterisk_plus.recording'].search(
+            [('call', '=', call.id)]))
+
+    def test_play_call(self):
+        # Events are played as the agent does in their own transactions.
+        self.registry.enter_test_mode(self.env.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        events = generate_call_events(
+            'mock-2.1', 'mock-2.2', 'SIP/trunk-00000001', 'SIP/1001-00000002',
+            '+15551234567', '1001', cause=('16', 'Normal Clearing'),
+            talk_time=0,
+            recording_path='/var/spool/asterisk/monitor/mock-2.1.wav')
+        with patch.object(MockAgent, 'local_job', autospec=True,
+                          side_effect=MockAgent.local_job) as local_job:
+            timings = self.env['asterisk_plus.mock_agent']._play_call(
+                self.env.cr.dbname, self.server.user.id, events)
+        self.assertNotIn('error', timings)
+        self.assertEqual(timings['cause'], '16')
+        # The recording is requested from the mock agent, not from Salt.
+        self.assertIn('asterisk.get_file', [
+            k.kwargs.get('fun') for k in local_job.call_args_list])
@@ -0,0 +1,327 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from datetime import datetime, timedelta
+import json
+import time
+from unittest.mock import patch
+from odoo import api, SUPERUSER_ID
+from odoo.exceptions import ValidationError
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.saltapi import (
+    CircuitBreaker, SaltApiPool, SaltApiSession)
+from odoo.addons.asterisk_plus.models.salt_job import TIMEOUT_RESULT
+from odoo.addons.asterisk_plus.models.server import Server
+
+# Other tests replace Server.local_job with a mock.
+LOCAL_JOB = Server.local_job
+
+
+class FakeSaltApi(SaltApiSession):
+    logins = 0
+
+    def login(self, username, password, eauth):
+        FakeSaltApi.logins += 1
+        self.auth = {'token': str(FakeSaltApi.logins),
+                     'expire': time.time() + 3600}
+
+
+class TestSaltApiPool(TransactionCase):
+
+    def setUp(self):
+        super(TestSaltApiPool, self).setUp()
+        FakeSaltApi.logins = 0
+        self.pool = SaltApiPool(size=1)
+        self.key = ('https://agent:48008', 'odoo')
+
+    def test_token_reused(self):
+        saltapi = FakeSaltApi(self.key[0])
+        auth = self.pool.get_auth(saltapi, self.key, 'secret', 'file')
+        self.assertEqual(auth['token'], '1')
+        other = FakeSaltApi(self.key[0])
+        self.assertIs(self.pool.get_auth(other, self.key, 'secret', 'file'), auth)
+        self.assertEqual(FakeSaltApi.logins, 1)
+
+    def test_relogin_once(self):
+        first, second = FakeSaltApi(self.key[0]), FakeSaltApi(self.key[0])
+        first.auth = second.auth = self.pool.get_auth(
+            first, self.key, 'secret', 'file')
+        # Both sessions get denied, only the first one logs in again.
+        self.pool.relogin(first, *self.key, 'secret')
+        self.pool.relogin(second, *self.key, 'secret')
+        self.assertEqual(FakeSaltApi.logins, 2)
+        self.assertEqual(second.auth['token'], '2')
+
+    def test_expiring_token_refreshed(self):
+        saltapi = FakeSaltApi(self.key[0])
+        self.pool.get_auth(saltapi, self.key, 'secret', 'file')
+        self.pool._auth[self.key]['expire'] = time.time() + 10
+        auth = self.pool.get_auth(saltapi, self.key, 'secret', 'file')
+        self.assertEqual(auth['token'], '2')
+
+
+class TestSaltJobOutbox(TransactionCase):
+
+    def setUp(self):
+        super(TestSaltJobOutbox, self).setUp()
+        patcher = patch.object(Server, 'local_job', LOCAL_JOB)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.env.ref('asterisk_plus.default_server')
+        self.salt_job = self.env['asterisk_plus.salt_job'].with_context(
+            no_commit=True)
+
+    def test_job_queued(self):
+        with patch.object(Server, '_call_saltapi') as call_saltapi:
+            job = self.server.local_job('test.ping', arg=['x'],
+                                        res_model='asterisk_plus.server',
+                                        res_method='ping_reply')
+            call_saltapi.assert_not_called()
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(job.arg, '["x"]')
+
+    def test_parked_return(self):
+        job = self.server.local_job('test.ping')
+        ret = {'jid': '20210916150939079024', 'return': True, 'fun': 'test.ping',
+               'id': 'asterisk', 'success': True}
+        # The return comes before the dispatcher has written the job ID.
+        self.salt_job.returner(ret)
+        parked = self.salt_job.search([('jid', '=', ret['jid'])])
+        self.assertEqual(parked.state, 'parked')
+        with patch.object(Server, '_call_saltapi', return_value={
+                'return': [{'jid': ret['jid'], 'minions': ['asterisk']}]}):
+            self.salt_job.dispatch_outbox(job.ids)
+        self.assertEqual(job.state, 'returned')
+        self.assertEqual(job.success, 'True')
+        self.assertFalse(parked.exists())
+
+    def test_sweep_parked_return(self):
+        job = self.salt_job.create({'server': self.server.id, 'fun': 'test.ping',
+                                    'jid': '10', 'state': 'sent',
+                                    'sent_date': datetime.utcnow()})
+        self.salt_job.create({'jid': '10', 'state': 'parked', 'full_ret': json.dumps(
+            {'jid': '10', 'id': 'asterisk', 'return': True, 'fun': 'test.ping',
+             'success': True})})
+        self.salt_job.sweep_outbox()
+        self.assertEqual(job.state, 'returned')
+        self.assertEqual(self.salt_job.search([('jid', '=', '10')]), job)
+
+    def test_parked_return_concurrent(self):
+        # Dispatcher and returner in their own transactions as in production.
+        jid = '20210916150939079025'
+        ret = {'jid': jid, 'return': True, 'fun': 'test.ping',
+               'id': 'asterisk', 'success': True}
+        with self.registry.cursor() as cr:
+            job_id = api.Environment(cr, SUPERUSER_ID, {})[
+                'asterisk_plus.salt_job'].create({
+                    'server': self.server.id, 'fun': 'test.ping',
+                    'state': 'queued'}).id
+
+        def cleanup():
+            with self.registry.cursor() as cr:
+                cr.execute('DELETE FROM asterisk_plus_salt_job '
+                           'WHERE id = %s OR jid = %s', (job_id, jid))
+
+        self.addCleanup(cleanup)
+        returner_cr = self.registry.cursor()
+        self.addCleanup(returner_cr.close)
+
+        def call_saltapi(*args, **kwargs):
+            # The return comes while the Salt API call is in flight.
+            api.Environment(returner_cr, SUPERUSER_ID, {})[
+                'asterisk_plus.salt_job'].returner(ret)
+            returner_cr.commit()
+            return {'return': [{'jid': jid, 'minions': ['asterisk']}]}
+
+        with patch.object(Server, '_call_saltapi', side_effect=call_saltapi), \
+                self.registry.cursor() as cr:
+            api.Environment(cr, SUPERUSER_ID, {})[
+                'asterisk_plus.salt_job'].dispatch_outbox([job_id])
+        with self.registry.cursor() as cr:
+            cr.execute('SELECT state FROM asterisk_plus_salt_job '
+                       'WHERE jid = %s', (jid,))
+            self.assertEqual(cr.fetchall(), [('returned',)])
+
+    def test_dispatch_failed(self):
+        job = self.server.local_job('test.ping')
+        with patch.object(Server, '_call_saltapi', return_value={
+                'return': [{}]}):
+            self.salt_job.dispatch_outbox(job.ids)
+        self.assertEqual(job.state, 'failed')
+        self.assertIn('No job ID', job.error)
+
+    def test_batch(self):
+        salt_job = self.env['asterisk_plus.salt_job']
+        with self.server.salt_batch():
+            self.server.local_job('test.ping', res_model='asterisk_plus.server',
+                                  res_method='ping_reply')
+            self.server.ami_action({'Action': 'Ping'})
+            self.assertFalse(salt_job.search([('state', '=', 'queued')]))
+        jobs = salt_job.search([('state', '=', 'queued')])
+        self.assertEqual(jobs.mapped('fun'),
+                         ['test.ping', 'asterisk.manager_action'])
+        with patch.object(Server, '_call_saltapi', return_value={'return': [
+                {'jid': '1', 'minions': ['asterisk']},
+                {'jid': '2', 'minions': ['asterisk']}]}) as call_saltapi:
+            self.salt_job.dispatch_outbox(jobs.ids)
+        call_saltapi.assert_called_once()
+        lowstate = call_saltapi.call_args[1]['lowstate']
+        self.assertEqual([k['fun'] for k in lowstate], jobs.mapped('fun'))
+        self.assertEqual(jobs.mapped('jid'), ['1', '2'])
+        self.assertEqual(jobs[0].res_method, 'ping_reply')
+
+    def test_fan_out(self):
+        other = self.env['asterisk_plus.server'].create({
+            'name': 'Other', 'server_id': 'other'})
+        servers = self.server | other
+        job = servers.fan_out('asterisk.get_banned',
+                              res_model='asterisk_plus.server',
+                              res_method='ping_reply',
+                              pass_back={'uid': self.env.uid})
+        self.assertEqual(job.children.mapped('server'), servers)
+        self.assertEqual(job._get_lowstate()['tgt'], ['asterisk', 'other'])
+        self.assertEqual(job._get_lowstate()['tgt_type'], 'list')
+        with patch.object(Server, '_call_saltapi', return_value={'return': [
+                {'jid': '3', 'minions': ['asterisk']}]}):
+            self.salt_job.dispatch_outbox(job.ids)
+        self.assertEqual(job.state, 'sent')
+        self.assertEqual(job.children.mapped('state'), ['sent', 'failed'])
+        self.salt_job.returner({'jid': '3', 'id': 'asterisk', 'return': [],
+                                'fun': 'asterisk.get_banned', 'success': True})
+        self.assertEqual(job.children.mapped('state'), ['returned', 'failed'])
+        self.assertEqual(job.state, 'returned')
+        self.assertEqual(job.success, 'False')
+        self.assertEqual(job.failed_count, 1)
+
+    def test_expire_jobs(self):
+        job = self.salt_job.create({
+            'server': self.server.id,
+            'fun': 'test.ping',
+            'jid': '4',
+            'sent_date': datetime.utcnow() - timedelta(hours=1),
+            'res_model': 'asterisk_plus.server',
+            'res_method': 'ping_reply',
+            'res_on_timeout': True,
+            'pass_back': json.dumps({'uid': self.env.uid}),
+        })
+        self.salt_job.expire_jobs(seconds=60)
+        self.assertEqual(job.state, 'timeout')
+        self.assertIn(TIMEOUT_RESULT, self.env['bus.bus'].search(
+            [], order='id desc', limit=1).message)
+        # A late return does not call the callback again.
+        self.assertFalse(self.salt_job.returner({
+            'jid': '4', 'id': 'asterisk', 'return': True, 'fun': 'test.ping',
+            'success': True}))
+        self.assertEqual(job.state, 'timeout')
+
+    def test_expire_jobs_callback_opt_in(self):
+        # Callbacks not handling timeouts are not called.
+        job = self.salt_job.create({
+            'server': self.server.id,
+            'fun': 'asterisk.get_config_hashes',
+            'jid': '11',
+            'sent_date': datetime.utcnow() - timedelta(hours=1),
+            'res_model': 'asterisk_plus.server',
+            'res_method': 'sync_configs_response',
+            'pass_back': json.dumps({'direction': 'upload'}),
+        })
+        with patch.object(Server, 'sync_configs_response') as callback:
+            self.salt_job.expire_jobs(seconds=60)
+        self.assertEqual(job.state, 'timeout')
+        callback.assert_not_called()
+
+    def test_expire_legacy_jobs(self):
+        # Jobs sent before sent_date existed.
+        job = self.salt_job.create({'server': self.server.id,
+                                    'fun': 'test.ping', 'jid': '12'})
+        self.env.cr.execute(
+            "UPDATE asterisk_plus_salt_job SET create_date = %s, "
+            "timeout = NULL WHERE id = %s",
+            (datetime.utcnow() - timedelta(hours=1), job.id))
+        job.invalidate_cache()
+        self.salt_job.expire_jobs(seconds=60)
+        self.assertEqual(job.state, 'timeout')
+
+    def test_returned(self):
+        job = self.salt_job.create({'server': self.server.id, 'fun': 'test.ping',
+                                    'jid': '5', 'sent_date': datetime.utcnow()})
+        self.salt_job.returner({'jid': '5', 'id': 'asterisk', 'return': True,
+                                'fun': 'test.ping', 'success': True})
+        self.assertEqual(job.state, 'returned')
+        self.assertEqual(job.ret, 'true')
+        self.assertTrue(job.returned_date)
+        self.assertIn('test.ping', self.salt_job.get_latency_stats())
+        self.env.cr.execute(
+            "UPDATE asterisk_plus_salt_job SET create_date = %s WHERE id = %s",
+            (datetime.utcnow() - timedelta(days=8), job.id))
+        self.assertEqual(self.salt_job.vacuum(days=7), 1)
+        self.assertFalse(job.exists())
+
+    def test_submit_job(self):
+        handle = self.server.submit_job('test.ping')
+        job = self.salt_job.browse(handle['job'])
+        self.assertEqual(job.res_push_uid, self.env.uid)
+        self.assertFalse(self.salt_job.get_result(handle['job'])['done'])
+        job.write({'jid': '6', 'state': 'sent', 'sent_date': datetime.utcnow()})
+        self.salt_job.returner({'jid': '6', 'id': 'asterisk', 'return': [1, 2],
+                                'fun': 'test.ping', 'success': True})
+        res = self.salt_job.get_result(handle['job'])
+        self.assertTrue(res['done'])
+        self.assertEqual(res['result'], [1, 2])
+        self.assertIn('salt_result', self.env['bus.bus'].search(
+            [], order='id desc', limit=1).message)
+
+    def test_server_down(self):
+        with patch.object(Server, '_call_saltapi', return_value={
+                'return': [{'asterisk': False}]}):
+            self.server.check_health()
+        self.assertEqual(self.server.health, 'down')
+        with self.assertRaises(ValidationError):
+            self.server.local_job('test.ping', sync=True)
+        # Jobs wait until the server is up.
+        job = self.server.local_job('test.ping')
+        with patch.object(Server, '_call_saltapi') as call_saltapi:
+            self.salt_job.dispatch_outbox(job.ids)
+            call_saltapi.assert_not_called()
+        self.assertEqual(job.state, 'queued')
+        with patch.object(Server, '_call_saltapi', return_value={
+                'return': [{'asterisk': True}]}):
+            self.server.check_health()
+        self.assertEqual(self.server.health, 'ok')
+
+
+class TestCircuitBreaker(TransactionCase):
+
+    def test_circuit(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=60)
+        breaker.failure('url')
+        self.assertTrue(breaker.allow('url'))
+        breaker.failure('url')
+        self.assertFalse(breaker.allow('url'))
+        self.assertTrue(breaker.is_open('url'))
+        # Half-open after the reset timeout.
+        breaker._state['url'] = (2, time.time() - 61)
+        self.assertTrue(breaker.allow('url'))
+        self.assertFalse(breaker.allow('url'))
+        breaker.success('url')
+        self.assertTrue(breaker.allow('url'))
+        self.assertFalse(breaker.is_open('url'))
+
+    def test_returner_bulk(self):
+        ok = self.salt_job.create({'server': self.server.id, 'fun': 'test.ping',
+                                   'jid': '7', 'sent_date': datetime.utcnow(),
+                                   'res_model': 'asterisk_plus.server',
+                                   'res_method': 'ping_reply',
+                                   'pass_back': json.dumps({'uid': self.env.uid})})
+        broken = self.salt_job.create({'server': self.server.id, 'fun': 'test.ping',
+                                       'jid': '8', 'sent_date': datetime.utcnow(),
+                                       'res_model': 'asterisk_plus.server',
+                                       'res_method': 'no_such_method'})
+        ret = {'id': 'asterisk', 'return': True, 'fun': 'test.ping', 'success': True}
+        results = self.salt_job.returner_bulk([
+            dict(ret, jid='8'), dict(ret, jid='7'), dict(ret, jid='9')])
+        self.assertEqual([k['jid'] for k in results], ['8', '7', '9'])
+        self.assertIn('error', results[0])
+        self.assertNotIn('error', results[1])
+        self.assertEqual(results[2]['result'], False)
+        self.assertEqual(ok.state, 'returned')
+        self.assertEqual(broken.state, 'sent')
+        self.assertEqual(self.salt_job.search([('jid', '=', '9')]).state, 'parked')
@@ -0,0 +1,24 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from odoo.tests.common import TransactionCase
+from odoo.addons.asterisk_plus.models.tracing import trace, get_recent_traces
+
+
+class TestTracing(TransactionCase):
+
+    def test_trace_disabled(self):
+        self.env['asterisk_plus.settings'].set_param('trace_level_ami', 'off')
+
+        def message():
+            raise AssertionError('Message must not be built!')
+
+        trace(self.env['asterisk_plus.channel'], 'ami', message)
+
+    def test_trace_levels(self):
+        settings = self.env['asterisk_plus.settings']
+        settings.set_param('trace_level_salt', 'info')
+        trace(settings, 'salt', 'Job %s', 'debug-level')
+        trace(settings, 'salt', 'Job %s', 'info-level', level='info')
+        messages = [k[4] for k in get_recent_traces(
+            self.env.cr.dbname, subsystem='salt')]
+        self.assertIn('Job info-level', messages)
+        self.assertNotIn('Job debug-level', messages)
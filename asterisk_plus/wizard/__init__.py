@@ -1,2 +1,6 @@
 from . import add_note
+from . import ami_replay
 from . import call
+from . import call_load
+from . import conf_diff
+from . import conf_import
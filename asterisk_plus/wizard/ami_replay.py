@@ -0,0 +1,193 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import base64
+from collections import defaultdict
+from datetime import timezone
+import json
+import logging
+import math
+import time
+import yaml
+from odoo import fields, models, api, registry, SUPERUSER_ID, _
+from odoo.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+def dump_recording(records):
+    """Serialize (time, event) pairs as JSON lines."""
+    return ''.join(json.dumps({'time': t, 'event': event}) + '\n'
+                   for t, event in records).encode()
+
+
+def load_recording(data):
+    """Parse JSON lines written by dump_recording."""
+    res = []
+    for line in data.decode().splitlines():
+        if line.strip():
+            item = json.loads(line)
+            res.append((item['time'], item['event']))
+    return res
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+class AmiReplayWizard(models.TransientModel):
+    _name = 'asterisk_plus.ami_replay_wizard'
+    _description = 'AMI Record / Replay'
+
+    start_date = fields.Datetime(
+        default=lambda self: fields.Datetime.now().replace(
+            hour=0, minute=0, second=0))
+    end_date = fields.Datetime(default=lambda self: fields.Datetime.now())
+    recording = fields.Binary(attachment=False)
+    recording_filename = fields.Char()
+    database = fields.Char(
+        help='Copy of this database to replay the events against. Handlers '
+             'run as its server user, Salt jobs are answered by the mock '
+             'agent and all changes are rolled back.')
+    speed = fields.Float(
+        default=0.0, help='Speed multiplier of the recorded time. '
+                          'Set 0 to replay as fast as possible.')
+    batch_size = fields.Integer(
+        default=1, help='Number of events sent in one on_ami_events call. '
+                        'Set 1 to run the handlers event by event.')
+    report = fields.Text(readonly=True)
+
+    def _reopen(self):
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def record(self):
+        """Save traced AMI events of the period to the recording file."""
+        self.ensure_one()
+        traces = self.env['asterisk_plus.ami_trace'].search([
+            ('received', '>=', self.start_date),
+            ('received', '<=', self.end_date)])
+        if not traces:
+            raise ValidationError(
+                _('No AMI events traced in this period. Enable Trace AMI with '
+                  'Daily Partitions storage to record events.'))
+        self.write({
+            'recording': base64.b64encode(dump_recording([
+                (k.received.replace(tzinfo=timezone.utc).timestamp(),
+                 json.loads(k.message)) for k in traces])),
+            'recording_filename': 'ami_{}.jsonl'.format(
+                self.start_date.strftime('%Y%m%d%H%M%S')),
+        })
+        return self._reopen()
+
+    def replay(self):
+        """Replay the recording and keep the report. All changes of the
+        replayed events are rolled back.
+        """
+        self.ensure_one()
+        if not self.recording:
+            raise ValidationError(_('Record or upload the events first!'))
+        if not self.database or self.database == self.env.cr.dbname:
+            # Handler statistics and metrics of the live database would
+            # include the replayed events.
+            raise ValidationError(
+                _('Replay against a copy of the database, not the live one!'))
+        records = load_recording(base64.b64decode(self.recording))
+        cr = registry(self.database).cursor()
+        try:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            server = env.ref('asterisk_plus.default_server', False) or \
+                env['asterisk_plus.server'].search([], limit=1)
+            env = api.Environment(cr, server.user.id, dict(
+                self.env.context, no_commit=True, mock_agent=True))
+            stats = env[self._name]._replay(
+                records, speed=self.speed, batch_size=self.batch_size)
+        finally:
+            cr.rollback()
+            cr.close()
+        self.report = yaml.dump(stats, default_flow_style=False)
+        return self._reopen()
+
+    @api.model
+    def _replay(self, records, speed=0, batch_size=1):
+        """Feed recorded events through the AMI handlers.
+
+        Args:
+            records (list): (time, event) pairs in the recorded order.
+            speed (float): Recorded time multiplier, 0 to not wait.
+            batch_size (int): Events per on_ami_events call.
+
+        Returns:
+            Statistics dictionary: events/sec and handler latency percentiles
+            and SQL queries per event type.
+        """
+        cr = self.env.cr
+        Channel = self.env['asterisk_plus.channel']
+        handlers = {}
+        for handler in self.env['asterisk_plus.event'].sudo().search([
+                ('source', '=', 'AMI'), ('is_enabled', '=', True)]):
+            handlers.setdefault(handler.name, []).append(handler)
+        timings = defaultdict(list)
+        queries = defaultdict(int)
+        counts = defaultdict(int)
+        errors = 0
+        busy = 0.0
+        batch_size = max(1, batch_size or 1)
+        started = time.time()
+        for pos in range(0, len(records), batch_size):
+            chunk = records[pos:pos + batch_size]
+            if speed:
+                delay = (chunk[0][0] - records[0][0]) / speed - (
+                    time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            events = [k[1] for k in chunk]
+            sql_count = cr.sql_log_count
+            event_started = time.time()
+            if batch_size == 1:
+                key = events[0].get('Event')
+                try:
+                    # Flush inside the savepoint so that every event
+                    # pays for its own queries.
+                    with cr.savepoint():
+                        Channel._run_ami_event_handlers(
+                            self.env, handlers.get(key, []), events[0])
+                except Exception:
+                    logger.exception('Replay event %s error:', key)
+                    errors += 1
+            else:
+                key = 'Batch'
+                errors += len(Channel._process_ami_events(events)[1])
+                self.env['base'].flush()
+            spent = time.time() - event_started
+            busy += spent
+            timings[key].append(spent)
+            queries[key] += cr.sql_log_count - sql_count
+            counts[key] += len(events)
+        total = len(records)
+        res = {
+            'events': total,
+            'errors': errors,
+            'duration': round(time.time() - started, 3),
+            'events_per_second': round(total / busy, 1) if busy else 0,
+            'queries_per_event': round(
+                sum(queries.values()) / total, 1) if total else 0,
+            'handlers': {},
+        }
+        for key, values in timings.items():
+            values.sort()
+            res['handlers'][key] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2),
+                'queries_per_event': round(queries[key] / counts[key], 1),
+            }
+        return res
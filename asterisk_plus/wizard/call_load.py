@@ -0,0 +1,156 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import Counter
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+import yaml
+from odoo import fields, models, api, registry, _
+from odoo.exceptions import ValidationError
+from ..models.mock_agent import (
+    generate_call_events, get_channel_name, random_cause)
+from ..models.server import get_default_server
+from .ami_replay import percentile
+
+logger = logging.getLogger(__name__)
+
+
+def get_latency_stats(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2) if values else 0,
+    }
+
+
+class CallLoadWizard(models.TransientModel):
+    _name = 'asterisk_plus.call_load_wizard'
+    _description = 'Call Load Generator'
+
+    server = fields.Many2one('asterisk_plus.server', required=True,
+                             default=get_default_server)
+    mode = fields.Selection([
+        ('inbound', 'Inbound Calls'),
+        ('originate', 'Click to Call')], default='inbound', required=True,
+        help='Click to Call originates calls from your PBX user.')
+    calls = fields.Integer(default=100, required=True)
+    concurrency = fields.Integer(
+        default=10, required=True,
+        help='Maximum number of calls in progress at the same time.')
+    arrival_rate = fields.Float(
+        default=5.0, required=True, string='Arrival Rate (calls/sec)')
+    talk_time = fields.Float(default=5.0, string='Talk Time (sec)')
+    report = fields.Text(readonly=True)
+
+    def run(self):
+        """Generate the calls with the mock agent and keep the report.
+        Runs in the request, so keep the load test shorter than the
+        HTTP request time limit.
+        """
+        self.ensure_one()
+        if self.calls < 1 or self.concurrency < 1 or self.arrival_rate <= 0:
+            raise ValidationError(
+                _('Calls, concurrency and arrival rate must be positive!'))
+        if self.mode == 'originate' and not self.env.user.asterisk_users:
+            raise ValidationError(_('PBX User is not defined!'))
+        db = self.env.cr.dbname
+        user_channel = self.env['asterisk_plus.user_channel'].search(
+            [('server', '=', self.server.id)], limit=1)
+        # Poisson arrivals.
+        arrivals = queue.Queue()
+        arrival = 0
+        for i in range(self.calls):
+            arrival += random.expovariate(self.arrival_rate)
+            arrivals.put(arrival)
+        call_args = {
+            'db': db,
+            'uid': self.env.uid,
+            'server_uid': self.server.user.id,
+            'system_name': self.server.server_id,
+            'exten': user_channel.asterisk_user.exten or '1001',
+            'peer': user_channel.name or 'SIP/1001',
+            'talk_time': self.talk_time,
+        }
+        make_call = (self._make_originate_call if self.mode == 'originate'
+                     else self._make_inbound_call)
+        results = []
+        started = time.time()
+
+        def worker():
+            while True:
+                try:
+                    arrival = arrivals.get_nowait()
+                except queue.Empty:
+                    return
+                delay = started + arrival - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                # Time the call waited for a free slot.
+                timings = {'start_delay': max(0, -delay)}
+                try:
+                    make_call(timings=timings, **call_args)
+                except Exception:
+                    logger.exception('Call load generator error:')
+                    timings['error'] = True
+                results.append(timings)
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for i in range(min(self.concurrency, self.calls))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - started
+        completed = [k for k in results if 'finalised' in k]
+        report = {
+            'calls': len(results),
+            'completed': len(completed),
+            'errors': len([k for k in results if k.get('error')]),
+            'duration': round(duration, 3),
+            'throughput': round(len(completed) / duration, 2),
+            'causes': dict(Counter(k['cause'] for k in completed)),
+        }
+        for key in ['created', 'finalised', 'originate', 'start_delay']:
+            values = [k[key] for k in results if key in k]
+            if values:
+                report[key] = get_latency_stats(values)
+        self.report = yaml.dump(report, default_flow_style=False)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    @api.model
+    def _make_inbound_call(self, db, server_uid, system_name, exten, peer,
+                           talk_time, timings, **kwargs):
+        events = generate_call_events(
+            uuid.uuid4().hex, uuid.uuid4().hex,
+            get_channel_name('SIP/trunk'), get_channel_name(peer),
+            '+1555{:07d}'.format(random.randrange(10 ** 7)), exten,
+            cause=random_cause(), talk_time=talk_time,
+            recording_path='/var/spool/asterisk/monitor/{}.wav'.format(
+                uuid.uuid4().hex),
+            system_name=system_name)
+        self.env['asterisk_plus.mock_agent']._play_call(
+            db, server_uid, events, timings, talk_time)
+
+    @api.model
+    def _make_originate_call(self, db, uid, talk_time, timings, **kwargs):
+        originate_started = time.time()
+        # The mock agent plays the call after commit in this thread.
+        with registry(db).cursor() as cr:
+            env = api.Environment(cr, uid, {
+                'mock_agent': True, 'mock_agent_wait': True,
+                'mock_agent_timings': timings,
+                'mock_agent_talk_time': talk_time})
+            env['asterisk_plus.server'].originate_call(
+                '+1555{:07d}'.format(random.randrange(10 ** 7)))
+            timings['originate'] = time.time() - originate_started
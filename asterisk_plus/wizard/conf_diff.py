@@ -0,0 +1,60 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import difflib
+from markupsafe import escape
+from odoo import fields, models, api
+
+#: Lines of context around changes.
+DIFF_CONTEXT = 3
+
+
+def html_diff(old, new, from_name, to_name):
+    """Unified diff of two contents as HTML."""
+    lines = []
+    for line in difflib.unified_diff(
+            (old or '').splitlines(), (new or '').splitlines(),
+            from_name, to_name, n=DIFF_CONTEXT, lineterm=''):
+        if line.startswith('+') and not line.startswith('+++'):
+            css = 'text-success'
+        elif line.startswith('-') and not line.startswith('---'):
+            css = 'text-danger'
+        elif line.startswith('@@'):
+            css = 'text-info'
+        else:
+            css = 'text-muted' if line.startswith(('---', '+++')) else ''
+        lines.append('<span class="{}">{}</span>'.format(css, escape(line)))
+    if not lines:
+        return '<p>No differences.</p>'
+    return '<pre>{}</pre>'.format('\n'.join(lines))
+
+
+class ConfDiffWizard(models.TransientModel):
+    _name = 'asterisk_plus.conf_diff_wizard'
+    _description = 'Compare Conf File Revisions'
+
+    conf = fields.Many2one('asterisk_plus.conf', required=True)
+    from_revision = fields.Many2one(
+        'asterisk_plus.conf_revision', required=True,
+        domain="[('conf', '=', conf)]")
+    to_revision = fields.Many2one(
+        'asterisk_plus.conf_revision', domain="[('conf', '=', conf)]",
+        help='Leave empty to compare with the current content.')
+    diff = fields.Html(compute='_get_diff', sanitize=False)
+
+    @api.depends('from_revision', 'to_revision')
+    def _get_diff(self):
+        for rec in self:
+            if not rec.from_revision:
+                rec.diff = False
+                continue
+            if rec.to_revision:
+                new = rec.to_revision.content
+                to_name = 'version {}'.format(rec.to_revision.version)
+            else:
+                new = rec.conf.content
+                to_name = 'current'
+            rec.diff = html_diff(
+                rec.from_revision.content, new,
+                'version {}'.format(rec.from_revision.version), to_name)
+
+    def rollback(self):
+        return self.from_revision.rollback()
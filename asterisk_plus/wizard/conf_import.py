@@ -0,0 +1,36 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import tarfile
+from odoo import fields, models, _
+from odoo.exceptions import ValidationError
+from ..models.conf_archive import base64_to_archive
+
+
+class ConfImportWizard(models.TransientModel):
+    _name = 'asterisk_plus.conf_import_wizard'
+    _description = 'Import Conf Files'
+
+    server = fields.Many2one('asterisk_plus.server', required=True)
+    archive = fields.Binary(required=True, attachment=False)
+    archive_filename = fields.Char()
+
+    def import_archive(self):
+        """Create or update the server files from a tar archive. Changed
+        files are marked as updated to be applied.
+        """
+        self.ensure_one()
+        try:
+            changed = self.env['asterisk_plus.conf'].apply_archive(
+                self.server, base64_to_archive(self.archive), sync=False)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            raise ValidationError(_('Bad archive: {}').format(e))
+        self.env['res.users'].asterisk_plus_notify(
+            _('{} files imported.').format(len(changed)))
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'asterisk_plus.conf',
+            'name': _('Imported Conf Files'),
+            'view_mode': 'tree,form',
+            'domain': [('server', '=', self.server.id),
+                       ('name', 'in', changed)],
+            'target': 'current',
+        }
@@ -6,6 +6,7 @@ import uuid
 from odoo import models, fields, api
 from odoo.addons.asterisk_plus.models.server import get_default_server
 from odoo.addons.asterisk_plus.models.settings import debug
+from odoo.addons.asterisk_plus.models.tracing import trace
 
 logger = logging.getLogger(__name__)
 
@@ -228,9 +229,9 @@ class Callback(models.Model):
 
     @api.model
     def on_callback_done(self, event):
-        debug(self, json.dumps(event, indent=2))
-        channel = self.env['asterisk_plus.channel'].with_context(
-            active_test=False).search([('uniqueid', '=', event['Uniqueid'])])
+        trace(self, 'ami', lambda: json.dumps(event, indent=2))
+        channel = self.env['asterisk_plus.channel']._find_channel(
+            event['Uniqueid'])
         if not channel:
             logger.error('Channel not found for callback: %s', event)
             return False